@@ -6,8 +6,15 @@ Household Datapackage
 
 """
 
+from . import profiling
+from . import telemetry
 from . import download
 from . import read
 from . import validation
 from . import imputation
+from . import chunking
+from . import resampling
+from . import export
+from . import load
+from . import synthetic
 from . import make_json
@@ -0,0 +1,343 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+benchmark.py : time and memory benchmarks of the processing stages on synthetic feeds
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import tracemalloc
+import platform
+import numpy as np
+import pandas as pd
+
+from datetime import datetime, timezone
+from .cache import get_code_hash
+
+HEADERS = ['region', 'household', 'type', 'unit', 'feed']
+
+INFO_COLS = {'utc': 'utc_timestamp',
+             'cet': 'cet_cest_timestamp',
+             'marker': 'interpolated'}
+
+STAGES = ['read_feed', 'read', 'read_cold', 'read_warm', 'validate', 'make_equidistant', 'fill_nan', 'resample',
+          'export', 'process_chunks']
+
+# Maximum number of feeds of a single synthetic household
+HOUSEHOLD_FEEDS = 10
+
+
+def run(days=[30, 365], feeds=[1, 10], stages=STAGES, memory=True, lean=False, chunk='30D', output='benchmark.json',
+        seed=0):
+    '''
+    Benchmark the processing stages on synthetic households of several sizes.
+
+    For each combination of days and feeds, the feeds are generated in a temporary
+    directory and processed by all stages, each measuring its wall time, CPU time
+    and number of resulting rows. The read_cold and read_warm stages read all
+    households through a persistent feed cache, which is empty for the cold read
+    and filled by the previous read for the warm one. If enabled, every stage is
+    run a second time to trace its peak memory allocations, to not distort the
+    timing by the tracing.
+    Sizes up to ten years and 100 feeds, e.g. days=[30, 365, 3650] and
+    feeds=[1, 10, 100], take a long time and several GB of memory.
+
+    Parameters
+    ----------
+    days : list of int, default [30, 365]
+        Lengths of the synthetic feeds in days
+    feeds : list of int, default [1, 10]
+        Total numbers of feeds, split into households of up to 10 feeds
+    stages : list of str
+        Stages to benchmark, all of household.benchmark.STAGES by default
+    memory : boolean, default True
+        Flag, if the peak memory of each stage will be traced
+    lean : boolean, default False
+        Flag, if the values will be processed in the lean float32 mode
+    chunk : str, default '30D'
+        Length of the time windows of the process_chunks stage, which reads, validates, 
+        aggregates and fills the households out-of-core
+    output : str, default 'benchmark.json'
+        Path of the JSON file to write the results to. If None, no file is written
+    seed : int, default 0
+        Seed of the synthetic feeds
+
+    Returns
+    ----------
+    results : dict
+        Results of the benchmark with information about the environment and
+        a list of measurements of each stage and size
+
+    '''
+    results = {
+        'created': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor()
+        },
+        'code': get_code_hash(),
+        'lean': lean,
+        'chunk': chunk,
+        'results': []
+    }
+
+    for size_days in days:
+        for size_feeds in feeds:
+            logger.info('Benchmarking %i feeds of %i days', size_feeds, size_days)
+            for result in run_size(size_days, size_feeds, stages=stages, memory=memory, lean=lean,
+                                   chunk=chunk, seed=seed):
+                results['results'].append(result)
+                logger.info('%-18s %8.2fs wall %8.2fs cpu %10s rows %8s MB', result['stage'],
+                            result['wall_time'], result['cpu_time'], result['rows'],
+                            '{:.1f}'.format(result['memory_peak']/1024**2) if memory else '-')
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    return results
+
+
+def run_size(days, feeds, stages=STAGES, memory=True, lean=False, chunk='30D', seed=0):
+    '''
+    Benchmark the processing stages on synthetic households of a single size.
+
+    Parameters
+    ----------
+    days : int
+        Length of the synthetic feeds in days
+    feeds : int
+        Total number of feeds, split into households of up to 10 feeds
+    stages : list of str
+        Stages to benchmark
+    memory : boolean, default True
+        Flag, if the peak memory of each stage will be traced
+    lean : boolean, default False
+        Flag, if the values will be processed in the lean float32 mode
+    chunk : str, default '30D'
+        Length of the time windows of the process_chunks stage
+    seed : int, default 0
+        Seed of the synthetic feeds
+
+    Returns
+    ----------
+    results : list of dict
+        Measurements of each stage
+
+    '''
+    from .synthetic import write_households
+    from .read import read_households, read_feed
+    from .validation import validate_households
+    from .imputation import make_equidistant, fill_nan
+    from .tools import update_sets
+    from .resampling import resample
+    from .export import write_csv
+    from .chunking import process_chunks
+    from .cache import FeedCache
+
+    results = []
+    def measure(stage, func):
+        wall_time = time.perf_counter()
+        cpu_time = time.process_time()
+        result = func()
+        wall_time = time.perf_counter() - wall_time
+        cpu_time = time.process_time() - cpu_time
+
+        memory_peak = None
+        if memory:
+            tracemalloc.start()
+            func()
+            _, memory_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        results.append({
+            'stage': stage,
+            'days': days,
+            'feeds': feeds,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'memory_peak': memory_peak,
+            'rows': _count_rows(result)
+        })
+        return result
+
+    households_count = -(-feeds//HOUSEHOLD_FEEDS)
+    households_feeds = -(-feeds//households_count)
+
+    benchmark_dir = tempfile.mkdtemp(prefix='household_benchmark_')
+    try:
+        source = os.path.join(benchmark_dir, 'original_data')
+        config_dir = os.path.join(benchmark_dir, 'conf')
+        export_dir = os.path.join(benchmark_dir, 'export')
+        os.makedirs(config_dir)
+        os.makedirs(export_dir)
+
+        households = write_households(source, households=households_count, feeds=households_feeds,
+                                      days=days, seed=seed)
+
+        if 'read_feed' in stages:
+            household = households[0]
+            feed_name, feed_dict = next(iter(household['series'].items()))
+            feed_file = os.path.join(source, household['dir'], 'phptimeseries', 'feed_{}.MYD'.format(feed_dict['id']))
+            measure('read_feed', lambda: read_feed(feed_file, feed_name, cache=None))
+
+        def read():
+            return read_households(households, HEADERS, cache=False, source=source, lean=lean)
+
+        stage_data = measure('read', read) if 'read' in stages else read()
+
+        feed_cache = FeedCache(os.path.join(benchmark_dir, 'feed_cache'))
+        if 'read_cold' in stages:
+            def read_cold():
+                shutil.rmtree(feed_cache.cache_dir, ignore_errors=True)
+                return read_households(households, HEADERS, cache=feed_cache, source=source, lean=lean)
+
+            measure('read_cold', read_cold)
+
+        if 'read_warm' in stages:
+            # Fill the cache, if the cold read was not benchmarked before
+            if 'read_cold' not in stages:
+                read_households(households, HEADERS, cache=feed_cache, source=source, lean=lean)
+
+            measure('read_warm', lambda: read_households(households, HEADERS, cache=feed_cache, source=source, 
+                                                         lean=lean))
+
+        def validate():
+            data, _ = validate_households(households, {k: v.copy() for k, v in stage_data.items()},
+                                          config_dir=config_dir)
+            for household_data in data.values():
+                household_data.columns.names = HEADERS
+            return data
+
+        stage_data = measure('validate', validate) if 'validate' in stages else validate()
+
+        def equidistant():
+            return {h['id']: make_equidistant(h, stage_data[h['id']], 1) for h in households}
+
+        stage_data = measure('make_equidistant', equidistant) if 'make_equidistant' in stages else equidistant()
+
+        def filled():
+            return [fill_nan(stage_data[h['id']].copy(), h['name'], HEADERS, config_dir=config_dir)[0]
+                    for h in households]
+
+        stage_data = measure('fill_nan', filled) if 'fill_nan' in stages else filled()
+
+        data_sets = {}
+        update_sets('1min', stage_data, data_sets)
+
+        def resampled():
+            return resample(data_sets['1min'], ['15min', '60min'])
+
+        data_sets.update(measure('resample', resampled) if 'resample' in stages else resampled())
+
+        if 'export' in stages:
+            for data in data_sets.values():
+                data.index.rename(INFO_COLS['utc'], inplace=True)
+                data.insert(0, INFO_COLS['cet'], data.index.tz_convert('Europe/Berlin'))
+                data[data.columns[0]] = data.iloc[:, 0].dt.strftime('%Y-%m-%dT%H:%M:%S%z')
+
+            def export():
+                for res_key, data in data_sets.items():
+                    filenames = {shape: os.path.join(export_dir, 'household_data_{}_{}.csv'.format(res_key, shape))
+                                 for shape in ['singleindex', 'multiindex', 'stacked']}
+                    write_csv(data, filenames, INFO_COLS)
+                return data_sets
+
+            measure('export', export)
+
+        if 'process_chunks' in stages:
+            def chunked():
+                rows = 0
+                for household in households:
+                    data_filled, _, _ = process_chunks(household, HEADERS, chunk=chunk, config_dir=config_dir, 
+                                                       source=source)
+                    rows += sum(len(data.index) for data in data_filled)
+                return rows
+
+            measure('process_chunks', chunked)
+
+    finally:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+    return results
+
+
+def compare(baseline, results):
+    '''
+    Compare the results of two benchmark runs.
+
+    Parameters
+    ----------
+    baseline : str or dict
+        Path to the JSON file or results of the baseline run
+    results : str or dict
+        Path to the JSON file or results of the run to compare
+
+    Returns
+    ----------
+    comparison : pandas.DataFrame
+        Wall time, CPU time and peak memory of both runs and their ratio
+        for each stage and size
+
+    '''
+    runs = []
+    for run_results in [baseline, results]:
+        if isinstance(run_results, str):
+            with open(run_results, 'r') as f:
+                run_results = json.load(f)
+
+        runs.append(pd.DataFrame(run_results['results']).set_index(['days', 'feeds', 'stage']))
+
+    columns = ['wall_time', 'cpu_time', 'memory_peak']
+    comparison = pd.concat([runs[0][columns], runs[1][columns]], axis=1, keys=['baseline', 'results'], join='inner')
+    for column in columns:
+        comparison[('ratio', column)] = comparison[('results', column)]/comparison[('baseline', column)]
+
+    return comparison
+
+
+def _count_rows(result):
+    if isinstance(result, dict):
+        return sum(_count_rows(r) for r in result.values())
+    if isinstance(result, (list, tuple)):
+        return sum(_count_rows(r) for r in result)
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result.index)
+    if isinstance(result, int):
+        return result
+
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the processing stages on synthetic households')
+    parser.add_argument('--days', type=int, nargs='+', default=[30, 365])
+    parser.add_argument('--feeds', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--no-memory', dest='memory', action='store_false')
+    parser.add_argument('--lean', action='store_true')
+    parser.add_argument('--chunk', default='30D', help='Length of the time windows of the process_chunks stage')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None, help='JSON results of a baseline run to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
+    results = run(days=args.days, feeds=args.feeds, stages=args.stages, memory=args.memory, lean=args.lean,
+                  chunk=args.chunk, output=args.output)
+    if args.compare is not None:
+        print(compare(args.compare, results).to_string())
@@ -0,0 +1,527 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+cache.py : persistent caches of decoded feeds and processing stages
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import json
+import shutil
+import hashlib
+import zipfile
+import numpy as np
+import pandas as pd
+
+# Format of the feed cache entries, to be incremented when it changes
+FEED_FORMAT = 2
+
+
+class FeedCache(object):
+    '''
+    Persistent cache of decoded feeds, stored as uncompressed columns of the
+    timestamps and values in NumPy .npz files.
+
+    The timestamps are stored as unsigned 32 bit seconds and the values as 
+    float32, just like in the phptimeseries source files, which takes 8 bytes 
+    per record, compared to 9 bytes of the source records. Both are restored 
+    losslessly, as the decoded feeds never exceed the precision of their source. 
+    Series that do, e.g. with fractions of seconds, are stored at full precision.
+    The columns are deliberately not compressed, as inflating them takes longer 
+    than decoding the source files again.
+
+    Entries are addressed by the SHA-256 hash of the source files content and 
+    the version of the cache, which includes the format of the entries and the 
+    hash of the decoding code, so that changes of either never return stale feeds.
+    A reference of the files path, size and modification time to its content
+    hash avoids hashing unchanged files again, while renewed or moved copies
+    of the same file are still recognized. Feeds read from members of a zip
+    archive are addressed by the size and CRC-32 checksum of the member.
+    If the total size of all entries exceeds the configured maximum, the least
+    recently used will be evicted.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory path in which the cache entries are stored
+    max_size : int
+        Maximum size in bytes of all cached feeds
+    version : str, default None
+        Version of the decoded feeds. If None, the format of the entries and 
+        the hash of the read module, decoding the feeds, will be used
+
+    '''
+    def __init__(self, cache_dir='feed_cache', max_size=2*1024**3, version=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if version is None:
+            version = '{}:{}'.format(FEED_FORMAT, get_code_hash(['read.py']))
+        self.version = version
+
+    def get(self, filepath, member=None):
+        '''
+        Retrieve the decoded series of a feed, if it is cached.
+
+        Parameters
+        ----------
+        filepath : str
+            Path to the source file of the feed
+        member : str, default None
+            Name of the feeds source file, if filepath is a zip archive
+
+        Returns
+        ----------
+        times : numpy.ndarray or None
+            Timestamps of the feed in nanoseconds since the epoch
+        values : numpy.ndarray or None
+            Values of the feed
+
+        '''
+        entry_file = self._entry_file(filepath, member)
+        try:
+            with np.load(entry_file) as entry:
+                times = entry['times']
+                values = entry['values'].astype(np.float64)
+
+            # Timestamps of whole seconds are stored as unsigned integers
+            if times.dtype == np.uint32:
+                times = times.astype(np.int64)*10**9
+
+            # Mark the entry as recently used
+            os.utime(entry_file)
+
+            return times, values
+
+        except (IOError, ValueError, KeyError, zipfile.BadZipFile):
+            return None, None
+
+    def put(self, filepath, times, values, member=None):
+        '''
+        Store the decoded series of a feed and evict the least recently used
+        entries, if the maximum size of the cache is exceeded.
+
+        Parameters
+        ----------
+        filepath : str
+            Path to the source file of the feed
+        times : numpy.ndarray
+            Timestamps of the feed in nanoseconds since the epoch
+        values : numpy.ndarray
+            Values of the feed
+        member : str, default None
+            Name of the feeds source file, if filepath is a zip archive
+
+        '''
+        entry_file = self._entry_file(filepath, member)
+        try:
+            entry_temp = entry_file + '.' + str(os.getpid()) + '.tmp'
+            with open(entry_temp, 'wb') as f:
+                np.savez(f, times=_compact_times(times), values=_compact_values(values))
+
+            os.replace(entry_temp, entry_file)
+
+        except IOError:
+            logger.warning('Unable to cache feed %s in %s', filepath, entry_file)
+            return
+
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries, until the total size of the
+        cache does not exceed its maximum size.
+        '''
+        entries = []
+        entries_dir = os.path.join(self.cache_dir, 'feeds')
+        for entry_name in os.listdir(entries_dir):
+            if entry_name.endswith('.npz'):
+                entry_stat = os.stat(os.path.join(entries_dir, entry_name))
+                entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry_name))
+
+        entries_size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_name in sorted(entries):
+            if entries_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(entries_dir, entry_name))
+                entries_size -= entry_size
+                logger.debug('Evicted cached feed %s', entry_name)
+
+            except IOError:
+                pass
+
+    def _entry_file(self, filepath, member=None):
+        entries_dir = os.path.join(self.cache_dir, 'feeds')
+        os.makedirs(entries_dir, exist_ok=True)
+
+        entry_key = '{}:{}'.format(self._content_hash(filepath, member), self.version)
+        return os.path.join(entries_dir, hashlib.sha256(entry_key.encode('utf-8')).hexdigest() + '.npz')
+
+    def _content_hash(self, filepath, member=None):
+        if member is not None:
+            with zipfile.ZipFile(filepath) as archive:
+                info = archive.getinfo(member)
+
+            fingerprint = '{}:{}'.format(info.file_size, info.CRC)
+            return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+        stat = os.stat(filepath)
+        fingerprint = '{}:{}:{}'.format(os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+
+        refs_dir = os.path.join(self.cache_dir, 'refs')
+        refs_file = os.path.join(refs_dir, hashlib.sha256(fingerprint.encode('utf-8')).hexdigest())
+        try:
+            with open(refs_file, 'r') as f:
+                return f.read().strip()
+
+        except IOError:
+            pass
+
+        content_hash = get_sha_hash(filepath)
+        try:
+            os.makedirs(refs_dir, exist_ok=True)
+            refs_temp = refs_file + '.' + str(os.getpid()) + '.tmp'
+            with open(refs_temp, 'w') as f:
+                f.write(content_hash)
+
+            os.replace(refs_temp, refs_file)
+
+        except IOError:
+            logger.debug('Unable to write cache reference for %s', filepath)
+
+        return content_hash
+
+
+def _compact_times(times):
+    # Keep the timestamps in nanoseconds, if they are not whole seconds within the range of the source files
+    times = np.asarray(times, dtype=np.int64)
+    seconds = times//10**9
+    if len(times) > 0:
+        if (seconds*10**9 != times).any() or seconds.min() < 0 or seconds.max() > np.iinfo(np.uint32).max:
+            return times
+
+    return seconds.astype(np.uint32)
+
+
+def _compact_values(values):
+    # Keep the values as float64, if they would lose any precision as float32
+    values = np.asarray(values, dtype=np.float64)
+    values_compact = values.astype(np.float32)
+    if not np.array_equal(values_compact, values, equal_nan=True):
+        return values
+
+    return values_compact
+
+
+class StageCache(object):
+    '''
+    Persistent cache of the results of processing stages of each household,
+    replacing the manual pickle checkpoints between the processing steps.
+
+    Entries are addressed by keys, hashed from all inputs of a stage, like 
+    the key of the preceding stage, the fingerprint of the original data, the 
+    households configuration and series adjustments. All keys include the 
+    version of the processing code, to invalidate all stages if it changes.
+    Only the most recent entry of each stage and household will be kept.
+    Results produced in parts, like the time windows of the chunked processing, 
+    may be stored part by part, without ever joining them in memory.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory path in which the cache entries are stored
+    version : str, default None
+        Version of the processing code. If None, the hash of the source 
+        files of the household package will be used
+
+    '''
+    def __init__(self, cache_dir='stage_cache', version=None):
+        self.cache_dir = cache_dir
+        if version is None:
+            version = get_code_hash()
+        self.version = version
+
+    def key(self, stage, *inputs):
+        '''
+        Hash the inputs of a processing stage into the key of its result.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the processing stage, e.g. 'raw', 'fixed' or 'filled'
+        inputs : 
+            JSON serializable inputs of the stage. Dates and other objects 
+            will be serialized by their string representation
+
+        Returns
+        ----------
+        key : str
+            SHA-256 hex digest of the stage, its inputs and the code version
+
+        '''
+        inputs = json.dumps([stage, self.version, inputs], sort_keys=True, default=str)
+        return hashlib.sha256(inputs.encode('utf-8')).hexdigest()
+
+    def contains(self, stage, name, key):
+        '''
+        Check if the result of a stage is cached for the given key.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the processing stage
+        name : str
+            Name of the cached result, e.g. the household id
+        key : str
+            Key of the stage inputs
+
+        Returns
+        ----------
+        contains : boolean
+            True, if the result is cached for the given key
+
+        '''
+        return os.path.isfile(self._entry_file(stage, name, key)) or \
+               os.path.isdir(self._entry_parts(stage, name, key))
+
+    def load(self, stage, name, key=None):
+        '''
+        Load the cached result of a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the processing stage
+        name : str
+            Name of the cached result, e.g. the household id
+        key : str, default None
+            Key of the stage inputs. If None, the most recent entry will be 
+            loaded, regardless of its key
+
+        Returns
+        ----------
+        data : object or None
+            Cached result of the stage, or None if it is not cached.
+            The parts of a result stored in parts are concatenated
+
+        '''
+        if key is None:
+            key = self.keys(stage).get(name)
+            if key is None:
+                return None
+        if os.path.isdir(self._entry_parts(stage, name, key)):
+            parts = list(self.load_parts(stage, name, key))
+            return pd.concat(parts) if len(parts) > 0 else None
+        try:
+            return pd.read_pickle(self._entry_file(stage, name, key))
+
+        except (IOError, EOFError):
+            return None
+
+    def save(self, stage, name, key, data):
+        '''
+        Store the result of a stage and remove previous entries of it.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the processing stage
+        name : str
+            Name of the cached result, e.g. the household id
+        key : str
+            Key of the stage inputs
+        data : object
+            Result of the stage, e.g. a pandas.DataFrame
+
+        '''
+        entry_file = self._entry_file(stage, name, key)
+        entry_temp = entry_file + '.' + str(os.getpid()) + '.tmp'
+        pd.to_pickle(data, entry_temp)
+        os.replace(entry_temp, entry_file)
+
+        self._remove_entries(stage, name, entry_file)
+
+    def load_parts(self, stage, name, key=None):
+        '''
+        Load the cached result of a stage part by part.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the processing stage
+        name : str
+            Name of the cached result, e.g. the household id
+        key : str, default None
+            Key of the stage inputs. If None, the most recent entry will be 
+            loaded, regardless of its key
+
+        Returns
+        ----------
+        parts : generator
+            Parts of the cached result in the order they were stored. A result 
+            stored as a whole is yielded as its only part. Nothing is yielded, 
+            if it is not cached
+
+        '''
+        if key is None:
+            key = self.keys(stage).get(name)
+            if key is None:
+                return
+        entry_parts = self._entry_parts(stage, name, key)
+        if not os.path.isdir(entry_parts):
+            data = self.load(stage, name, key)
+            if data is not None:
+                yield data
+            return
+
+        for part_file_name in sorted(os.listdir(entry_parts)):
+            if part_file_name.endswith('.pickle'):
+                yield pd.read_pickle(os.path.join(entry_parts, part_file_name))
+
+    def save_parts(self, stage, name, key, parts):
+        '''
+        Store the result of a stage part by part, while the parts are produced, 
+        and remove previous entries of it. Only a single part is kept in memory.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the processing stage
+        name : str
+            Name of the cached result, e.g. the household id
+        key : str
+            Key of the stage inputs
+        parts : iterable
+            Parts of the result of the stage, e.g. a generator of pandas.DataFrame
+
+        Returns
+        ----------
+        count : int
+            Number of stored parts
+
+        '''
+        entry_parts = self._entry_parts(stage, name, key)
+        entry_temp = entry_parts + '.' + str(os.getpid()) + '.tmp'
+        if os.path.isdir(entry_temp):
+            shutil.rmtree(entry_temp)
+        os.makedirs(entry_temp)
+        try:
+            count = 0
+            for part in parts:
+                pd.to_pickle(part, os.path.join(entry_temp, '{:08d}.pickle'.format(count)))
+                count += 1
+
+            if os.path.isdir(entry_parts):
+                shutil.rmtree(entry_parts)
+            os.replace(entry_temp, entry_parts)
+
+        except:
+            shutil.rmtree(entry_temp, ignore_errors=True)
+            raise
+
+        self._remove_entries(stage, name, entry_parts)
+
+        return count
+
+    def keys(self, stage):
+        '''
+        Retrieve the keys of all cached results of a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the processing stage
+
+        Returns
+        ----------
+        keys : dict
+            Keys of the most recent entries of the stage by their names
+
+        '''
+        stage_dir = os.path.join(self.cache_dir, stage)
+        if not os.path.isdir(stage_dir):
+            return {}
+
+        entries = []
+        for entry_file_name in os.listdir(stage_dir):
+            entry = _parse_entry(entry_file_name)
+            if entry is not None:
+                entry_mtime = os.stat(os.path.join(stage_dir, entry_file_name)).st_mtime_ns
+                entries.append((entry_mtime,) + entry)
+
+        return {entry_name: entry_key for _, entry_name, entry_key in sorted(entries)}
+
+    def _entry_file(self, stage, name, key):
+        stage_dir = os.path.join(self.cache_dir, stage)
+        os.makedirs(stage_dir, exist_ok=True)
+
+        return os.path.join(stage_dir, name + '.' + key + '.pickle')
+
+    def _entry_parts(self, stage, name, key):
+        return os.path.join(self.cache_dir, stage, name + '.' + key + '.parts')
+
+    def _remove_entries(self, stage, name, entry_path):
+        # Remove all other entries of the stage and name, stored as a whole or in parts
+        stage_dir = os.path.dirname(entry_path)
+        for entry_file_name in os.listdir(stage_dir):
+            entry = _parse_entry(entry_file_name)
+            if entry is None or entry[0] != name or entry_file_name == os.path.basename(entry_path):
+                continue
+
+            entry_file = os.path.join(stage_dir, entry_file_name)
+            if os.path.isdir(entry_file):
+                shutil.rmtree(entry_file)
+            else:
+                os.remove(entry_file)
+            logger.debug('Removed outdated %s stage of %s', stage, name)
+
+
+def _parse_entry(entry_file_name):
+    for entry_ext in ['.pickle', '.parts']:
+        if entry_file_name.endswith(entry_ext):
+            entry_name, _, entry_key = entry_file_name[:-len(entry_ext)].rpartition('.')
+            return entry_name, entry_key
+
+    return None
+
+
+def get_code_hash(files=None):
+    '''
+    Hash the source files of the household package, as version of the 
+    processing code. If a list of file names is passed, only these files 
+    of the package will be hashed.
+    '''
+    sha_hasher = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for file_name in sorted(os.listdir(package_dir)):
+        if file_name.endswith('.py') and (files is None or file_name in files):
+            with open(os.path.join(package_dir, file_name), 'rb') as f:
+                sha_hasher.update(f.read())
+
+    return sha_hasher.hexdigest()
+
+
+def get_file_hash(path):
+    '''
+    Hash the content of a file, e.g. a series adjustments configuration, 
+    or return None if it does not exist.
+    '''
+    if not os.path.isfile(path):
+        return None
+
+    return get_sha_hash(path)
+
+
+def get_sha_hash(path, blocksize=1048576):
+    sha_hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        buffer = f.read(blocksize)
+        while len(buffer) > 0:
+            sha_hasher.update(buffer)
+            buffer = f.read(blocksize)
+
+        return sha_hasher.hexdigest()
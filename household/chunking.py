@@ -0,0 +1,282 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+chunking.py : out-of-core processing of the feeds in time windows
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+from .telemetry import Telemetry
+
+
+def process_chunks(household, headers, chunk='30D', interval=1, config_dir='conf', source='original_data',
+                   start_from_user=None, end_from_user=None, path=None, telemetry=None):
+    '''
+    Read, validate, aggregate and fill the feeds of a household in time windows,
+    without keeping any feed in memory as a whole.
+
+    Each stage processes the windows of a feed one after another, while looking
+    at as much of the surrounding data, as its rules need to see:
+    the detection of decreasing values looks back to the last steady increase of
+    the values and ahead for the following values to recover, the interpolation
+    onto the regular index looks at the data points adjacent to a window and the
+    imputation by prior days looks back as many days as it needs. Statistics of
+    whole feeds, like the standard deviation and the power quantile, are derived in
+    separate passes. Intermediate results are spilled to a temporary directory, which
+    is removed after the last window was yielded.
+
+    The results equal the ones of read_households(), validate_households(),
+    make_equidistant() and fill_nan(), up to the rounding of the standard deviation.
+    The values are always processed as float64 and no verbose output is written.
+    The peak memory depends on the length of the windows, but grows with gaps
+    longer than a window, as their imputation is not split.
+
+    Parameters
+    ----------
+    household : dict
+        Configuration dictionary of the household
+    headers : list
+        List of strings indicating the level names of the pandas.MultiIndex
+        for the columns of the dataframe
+    chunk : str, default '30D'
+        Length of the time windows, e.g. '7D'
+    interval : int, default 1
+        Interval of the regular index in minutes
+    config_dir : str
+         directory path where all configurations can be found
+    source : str, default 'original_data'
+        Directory of the original data, or the path to the original_data.zip archive
+    start_from_user : datetime.date, default None
+        Start of period for which to read the data
+    end_from_user : datetime.date, default None
+        End of period for which to read the data
+    path : str, default None
+        Directory to create the temporary directory of the spilled data in.
+        If None, the default temporary directory of the system is used
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the stages of each feed and window
+
+    Returns
+    ----------
+    data_filled: generator of pandas.DataFrame
+        Filled data of the consecutive windows, each with the marker column of the household appended
+    data_nan: pandas.DataFrame
+        Contains detailed information about missing data
+    errors: pandas.DataFrame
+        Number of deleted values per feed, as returned by validate_households()
+
+    '''
+    from .read import open_feeds
+    from .validation import validate_chunks
+    from .imputation import make_equidistant_chunks, fill_nan_chunks
+
+    if telemetry is None:
+        telemetry = Telemetry()
+
+    spill_dir = tempfile.TemporaryDirectory(prefix='household_chunks_', dir=path)
+    try:
+        logger.info('Reading %s series', household['name'])
+        feeds = open_feeds(household, source, start_from_user, end_from_user, path=spill_dir.name)
+        feeds = {feed_name: feed for feed_name, feed in feeds.items() if feed.start <= feed.end}
+
+        windows = []
+        if len(feeds) > 0:
+            windows = get_windows(min(feed.start for feed in feeds.values()),
+                                  max(feed.end for feed in feeds.values()), chunk)
+
+        logger.info('Validate %s series', household['name'])
+        validated = {}
+        errors = []
+        for feed_name in household['series'].keys():
+            if feed_name not in feeds:
+                continue
+
+            validated[feed_name], feed_errors = validate_chunks(household, feed_name, feeds[feed_name], windows,
+                                                                os.path.join(spill_dir.name, feed_name),
+                                                                config_dir=config_dir, telemetry=telemetry)
+            errors.append(dict(household=household['name'], feed=feed_name, **feed_errors))
+
+            telemetry.progress('validate', len(errors), len(feeds))
+
+        errors = pd.DataFrame(errors, columns=['household', 'feed', 'std', 'inc', 'qnt', 'unusual'])
+        errors = errors.set_index(['household', 'feed'])
+
+        equidistant, regions = make_equidistant_chunks(household, validated, windows, interval, spill_dir.name,
+                                                       telemetry=telemetry)
+
+        data_filled, data_nan = fill_nan_chunks(household, equidistant, regions, windows, headers, spill_dir.name,
+                                                telemetry=telemetry)
+
+    except:
+        spill_dir.cleanup()
+        raise
+
+    return _spilled(data_filled, spill_dir), data_nan, errors
+
+
+def _spilled(chunks, spill_dir):
+    # Keep the spilled data until all windows were yielded
+    with spill_dir:
+        for chunk in chunks:
+            yield chunk
+
+
+def get_windows(start, end, chunk='30D'):
+    '''
+    Split a time range into consecutive windows of a fixed length,
+    beginning at midnight UTC of its first day.
+
+    Parameters
+    ----------
+    start : int
+        First timestamp of the range in nanoseconds since the epoch
+    end : int
+        Last timestamp of the range in nanoseconds since the epoch
+    chunk : str, default '30D'
+        Length of the windows, e.g. '7D'
+
+    Returns
+    ----------
+    windows : list of tuple
+        Start and exclusive end of each window in nanoseconds since the epoch
+
+    '''
+    length = pd.Timedelta(chunk).value
+    if length <= 0:
+        raise ValueError('Invalid length of time windows: {}'.format(chunk))
+
+    origin = pd.Timestamp(start, tz='UTC').normalize().value
+
+    return [(origin + i*length, origin + (i+1)*length) for i in range((end - origin)//length + 1)]
+
+
+class Spill(object):
+    '''
+    Series of a feed, spilled to files to be processed in parts, without keeping
+    it in memory as a whole.
+
+    Irregular series store the timestamps of their values, appended window by
+    window in the order of time, as well as the offset of each window. Regular
+    series, e.g. on an equidistant index, may be written at any position and only
+    store their values, as their timestamps derive from the first one and the period.
+
+    Parameters
+    ----------
+    path : str
+        Path of the spill files, without their extension
+    start : int, default None
+        First timestamp of a regular series in nanoseconds since the epoch
+    period : int, default None
+        Period of a regular series in nanoseconds. If None, the series is irregular
+
+    '''
+    def __init__(self, path, start=None, period=None):
+        self.path = path
+        self.start = start
+        self.period = period
+        self.size = 0
+        self.windows = [0]
+
+        open(self.path + '.values', 'wb').close()
+        if self.period is None:
+            open(self.path + '.times', 'wb').close()
+
+    def __len__(self):
+        return self.size
+
+    def append(self, times, values):
+        '''
+        Append the values of the next window to an irregular series.
+
+        Parameters
+        ----------
+        times : numpy.ndarray
+            Sorted timestamps of the values in nanoseconds since the epoch
+        values : numpy.ndarray
+            Values of the window
+
+        '''
+        with open(self.path + '.times', 'ab') as f:
+            np.asarray(times, dtype=np.int64).tofile(f)
+        with open(self.path + '.values', 'ab') as f:
+            np.asarray(values, dtype=np.float64).tofile(f)
+
+        self.size += len(values)
+        self.windows.append(self.size)
+
+    def write(self, position, values):
+        '''
+        Write values of a regular series, beginning at a position.
+
+        Parameters
+        ----------
+        position : int
+            Position of the first value
+        values : numpy.ndarray
+            Values to write
+
+        '''
+        with open(self.path + '.values', 'r+b') as f:
+            f.seek(position*8)
+            np.asarray(values, dtype=np.float64).tofile(f)
+
+        self.size = max(self.size, position + len(values))
+
+    def read(self, start, stop):
+        '''
+        Read the values of a range of positions.
+
+        Parameters
+        ----------
+        start : int
+            First position to read
+        stop : int
+            Position to read up to, exclusive
+
+        Returns
+        ----------
+        times: numpy.ndarray
+            Timestamps of the values in nanoseconds since the epoch
+        values: numpy.ndarray
+            Values of the positions
+
+        '''
+        start = max(start, 0)
+        stop = min(stop, self.size)
+        if start >= stop:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        values = np.fromfile(self.path + '.values', dtype=np.float64, count=stop - start, offset=start*8)
+        if self.period is not None:
+            times = self.start + np.arange(start, stop, dtype=np.int64)*self.period
+        else:
+            times = np.fromfile(self.path + '.times', dtype=np.int64, count=stop - start, offset=start*8)
+
+        return times, values
+
+    def read_window(self, window):
+        '''
+        Read the values of an irregular series, appended for a window.
+
+        Parameters
+        ----------
+        window : int
+            Number of the window
+
+        Returns
+        ----------
+        times: numpy.ndarray
+            Timestamps of the values in nanoseconds since the epoch
+        values: numpy.ndarray
+            Values of the window
+
+        '''
+        return self.read(self.windows[window], self.windows[window+1])
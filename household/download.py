@@ -10,20 +10,47 @@ import logging
 logger = logging.getLogger(__name__)
 
 import os
+import json
 import zipfile
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from .cache import get_sha_hash
 
+DOWNLOAD_URL = 'http://data.open-power-system-data.org/household_data/'
 
-def download(out_path, version=None):
+# Size in bytes of the chunks to stream the response content in
+CHUNK_SIZE = 1024**2
+
+
+def download(out_path, version=None, extract=True, checksum=None, segments=1, server=DOWNLOAD_URL,
+             require_checksum=False):
     """
     Download archived data from the OPSD server.
 
+    The archive is streamed into a partial file next to the destination and 
+    only renamed to it, after it was completely downloaded and verified. 
+    Interrupted downloads will be resumed with HTTP range requests, as long as 
+    the archive on the server did not change.
+
     Parameters
     ----------
     out_path : str
         Base download directory in which to save all downloaded files.
     version: str
         OPSD Data Package Version to download original data from.
+    extract: boolean
+        Flag, if the archive should be extracted. The feeds may also be read
+        directly from the archive, by passing it as source to the read function.
+    checksum: str
+        SHA-256 hex digest to verify the archive against. If None, the checksum
+        will be looked up in the checksums.txt published with the version.
+    segments: int
+        Number of byte ranges to download in parallel, if supported by the server.
+    server: str
+        Base URL of the server to download the data package versions from.
+    require_checksum: boolean, default False
+        Flag, if the download should fail, if no checksum is passed or published
+        to verify the archive against.
 
     Returns
     ----------
@@ -34,14 +61,20 @@ def download(out_path, version=None):
     filename = 'original_data.zip'
     filepath = os.path.join(out_path, filename)
 
+    url = server + '{}/original_data/{}'.format(version, filename)
+    if checksum is None:
+        checksum = read_checksum(server + '{}/checksums.txt'.format(version), filename)
+    if checksum is None and require_checksum:
+        raise IOError('Unable to verify {} without a checksum'.format(url))
+
+    if os.path.exists(filepath) and checksum is not None and get_sha_hash(filepath) != checksum:
+        logger.warning('%s does not match the published checksum and will be downloaded again',
+                       filepath)
+        os.remove(filepath)
+
     if not os.path.exists(filepath):
-        url = ('http://data.open-power-system-data.org/household_data/'
-               '{}/original_data/{}'.format(version, filename))
-        logger.info('Downloading and extracting archived data from %s', url)
-        resp = requests.get(url)
-        with open(filepath, 'wb') as output_file:
-            for chunk in resp.iter_content(1024):
-                output_file.write(chunk)
+        logger.info('Downloading archived data from %s', url)
+        download_file(url, filepath, checksum=checksum, segments=segments)
 
     else:
         logger.info('%s already exists. Delete it if you want to download again',
@@ -49,11 +82,186 @@ def download(out_path, version=None):
 
     myzipfile = zipfile.ZipFile(filepath)
     if myzipfile.namelist()[0] == 'original_data/':
-        myzipfile.extractall()
-        logger.info('Extracted data to %s.', os.path.join(os.getcwd(), 'original_data'))
+        if extract:
+            myzipfile.extractall()
+            logger.info('Extracted data to %s.', os.path.join(os.getcwd(), 'original_data'))
     else:
         logger.warning('%s has unexpected content. Please check manually',
                        filepath)
 
     return
 
+
+def download_file(url, filepath, checksum=None, segments=1):
+    """
+    Download a file in chunks and resume a previously interrupted download.
+
+    The entity tag or modification time of the file on the server is kept next 
+    to the partial files. Partial files are discarded, if the file changed since 
+    the interrupted download, and the remaining byte ranges are only requested 
+    on condition that it still did not change, with an If-Range header.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file to download
+    filepath : str
+        Path of the downloaded file
+    checksum : str, default None
+        SHA-256 hex digest to verify the downloaded file against
+    segments : int, default 1
+        Number of byte ranges to download in parallel, if supported by the server
+
+    Returns
+    ----------
+    None
+
+    """
+    part_path = filepath + '.part'
+
+    resp = requests.head(url, allow_redirects=True, timeout=60)
+    resp.raise_for_status()
+    size = int(resp.headers.get('Content-Length', 0))
+
+    if size <= segments or resp.headers.get('Accept-Ranges') != 'bytes':
+        segments = 1
+
+    # Partial files of a previous attempt may only be resumed, if the file on the server did not change since
+    # and it is split into the same segments. Without a validator of the server, only a checksum will reveal 
+    # a changed file after the download
+    validator = _validator(resp.headers)
+    state = json.dumps({'validator': validator, 'segments': segments})
+    state_path = part_path + '.state'
+    state_previous = None
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as state_file:
+            state_previous = state_file.read()
+
+    partial_paths = _partial_paths(part_path)
+    if len(partial_paths) > 0 and (state != state_previous or validator is None and checksum is None):
+        logger.warning('Discarding the partial download of %s, as it may have changed on the server', url)
+        for partial_path in partial_paths:
+            os.remove(partial_path)
+
+    with open(state_path, 'w') as state_file:
+        state_file.write(state)
+
+    if segments > 1:
+        bounds = [size*s//segments for s in range(segments+1)]
+        segment_paths = [part_path + str(s) for s in range(segments)]
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            futures = [executor.submit(_download_range, url, segment_path, 
+                                       bounds[s], bounds[s+1]-1, validator)
+                       for s, segment_path in enumerate(segment_paths)]
+            for future in futures:
+                future.result()
+
+        with open(part_path, 'wb') as part_file:
+            for segment_path in segment_paths:
+                with open(segment_path, 'rb') as segment_file:
+                    for chunk in iter(lambda: segment_file.read(CHUNK_SIZE), b''):
+                        part_file.write(chunk)
+
+        for segment_path in segment_paths:
+            os.remove(segment_path)
+    else:
+        _download_range(url, part_path, 0, None, validator)
+
+    if size > 0 and os.path.getsize(part_path) != size:
+        raise IOError('Incomplete download of {}: {} of {} bytes'
+                      .format(url, os.path.getsize(part_path), size))
+
+    if checksum is not None and get_sha_hash(part_path) != checksum:
+        os.remove(part_path)
+        os.remove(state_path)
+        raise IOError('Downloaded file {} does not match the checksum {}'.format(url, checksum))
+
+    os.replace(part_path, filepath)
+    os.remove(state_path)
+
+
+def read_checksum(url, filename):
+    """
+    Read the published checksum of a file from a checksums.txt file,
+    listing the file names and their SHA-256 hashes, separated by commas.
+
+    Parameters
+    ----------
+    url : str
+        URL of the checksums.txt file
+    filename : str
+        Name of the file to look up the checksum for
+
+    Returns
+    ----------
+    checksum : str or None
+        SHA-256 hex digest of the file, or None if it is not published
+
+    """
+    try:
+        resp = requests.get(url, timeout=60)
+        resp.raise_for_status()
+
+    except requests.RequestException:
+        logger.warning('No checksums published at %s, the download will not be verified', url)
+        return None
+
+    for line in resp.text.splitlines():
+        entry = line.strip().split(',')
+        if len(entry) == 2 and entry[0] == filename:
+            return entry[1].strip().lower()
+
+    logger.warning('No checksum published for %s, the download will not be verified', filename)
+    return None
+
+
+def _download_range(url, filepath, start, end, validator=None):
+    # Continue after the bytes of a previous attempt, if the file already exists
+    offset = start
+    if os.path.exists(filepath):
+        offset += os.path.getsize(filepath)
+
+    if end is not None and offset > end:
+        return
+
+    headers = {}
+    if offset > 0 or end is not None:
+        headers['Range'] = 'bytes={}-{}'.format(offset, end if end is not None else '')
+    if offset > start and validator is not None:
+        # Only receive the remaining range, if the file on the server is still the same
+        headers['If-Range'] = validator
+
+    with requests.get(url, headers=headers, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        if resp.status_code == 206:
+            mode = 'ab'
+        elif start == 0 and end is None:
+            # The server ignored the range request or the file changed and it sends the complete file
+            mode = 'wb'
+        else:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            raise IOError('Unable to download the byte range {}-{} of {}, as the file changed or the '
+                          'server does not support range requests'.format(start, end, url))
+
+        with open(filepath, mode) as output_file:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                output_file.write(chunk)
+
+
+def _validator(headers):
+    # Weak entity tags may not be used to validate byte ranges
+    etag = headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+
+    return headers.get('Last-Modified')
+
+
+def _partial_paths(part_path):
+    # The partial file and the partial segments of previous attempts
+    part_dir = os.path.dirname(os.path.abspath(part_path))
+    part_name = os.path.basename(part_path)
+
+    return [os.path.join(part_dir, name) for name in sorted(os.listdir(part_dir))
+            if name == part_name or name.startswith(part_name) and name[len(part_name):].isdigit()]
@@ -0,0 +1,580 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+export.py : write the household data sets to disk.
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import json
+import shutil
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from pandas.api.types import is_float_dtype, is_datetime64_any_dtype
+from .telemetry import Telemetry
+from .tools import LEAN_DECIMALS
+
+SHAPES = ['singleindex', 'multiindex', 'stacked']
+
+
+def write_csv(df, filenames, info_cols, float_format='%.3f', date_format='%Y-%m-%dT%H:%M:%SZ',
+              chunk_size=100000, telemetry=None):
+    """
+    Write the different shapes of a data set to CSV files.
+
+    The files are byte-identical to the output of pandas.DataFrame.to_csv() for
+    each shape, but the rows are formatted in vectorized chunks directly into bytes
+    and streamed to disk, to bound the memory. Rows of the SingleIndex and MultiIndex
+    shape only differ in their header and are formatted once for both files, while
+    the Stacked shape is written column by column, without stacking the DataFrame.
+    Marker bitmasks are expanded and lean float32 values converted for each chunk.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame in MultiIndex shape, with the timestamps as index and the 
+        marker bitmasks of each household, or a single column of expanded markers
+    filenames : dict of str
+        Paths of the files to write, with their shape as keys,
+        e.g. 'singleindex', 'multiindex' or 'stacked'
+    info_cols : dict of strings
+        Names for non-data columns such as for the index, for additional
+        timestamps or the marker column
+    float_format : str
+        Format string for floating point numbers
+    date_format : str
+        Format string for the timestamps of the index
+    chunk_size : int
+        Number of rows to format at once
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the export of all shapes
+
+    Returns
+    ----------
+    None
+
+    """
+    from household.imputation import expand_markers
+
+    for shape in filenames:
+        if shape not in SHAPES:
+            raise ValueError('Unknown shape of the data set: {}'.format(shape))
+
+    if telemetry is None:
+        telemetry = Telemetry()
+
+    with telemetry.measure('export', format='csv', rows_in=len(df.index)) as record:
+        files = {}
+        try:
+            for shape, filename in filenames.items():
+                files[shape] = open(filename, 'wb')
+
+            header = expand_markers(df.iloc[:0])
+            headers = {
+                'singleindex': _header(header.set_axis(get_singleindex_columns(header, info_cols), axis=1),
+                                       float_format, date_format),
+                'multiindex': _header(header, float_format, date_format)
+            }
+            for shape in ['singleindex', 'multiindex']:
+                if shape in files:
+                    files[shape].write(headers[shape])
+
+            if 'singleindex' in files or 'multiindex' in files:
+                for chunk in range(0, len(df.index), chunk_size):
+                    rows = _format_rows(expand_markers(df.iloc[chunk:chunk+chunk_size]), float_format, date_format)
+                    for shape in ['singleindex', 'multiindex']:
+                        if shape in files:
+                            files[shape].write(rows)
+
+            if 'stacked' in files:
+                _write_stacked(files['stacked'], df, info_cols, float_format, date_format, chunk_size)
+
+        finally:
+            for f in files.values():
+                f.close()
+
+        record['rows_out'] = len(df.index)
+
+
+def write_parquet(df, res_key, info_cols, path='household_data_parquet', compression='snappy', telemetry=None):
+    """
+    Write a data set to Parquet files, partitioned by resolution, household and year.
+
+    The files are stored in hive style directories, e.g.
+    household_data_parquet/resolution=1min/household=residential1/year=2016/part-0.parquet,
+    so a single household and year can be read without parsing any other data.
+    Each partition holds the UTC timestamps, the CET timestamps, the feeds of the
+    household in its valid time range, named like the SingleIndex columns, and the
+    marker bitmask of the household. The MultiIndex levels of each column are kept
+    as field metadata and the marker lists the feeds of its bits.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame in MultiIndex shape, with a marker bitmask column per household
+    res_key : str
+        Resolution of the data set, e.g. '1min', '15min' or '60min'
+    info_cols : dict of strings
+        Names for non-data columns such as for the index, for additional
+        timestamps or the marker column
+    path : str
+        Directory path in which the partitions are stored
+    compression : str
+        Compression codec of the Parquet files
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the export of each household
+
+    Returns
+    ----------
+    None
+
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    from household.imputation import get_marker_feeds
+
+    if telemetry is None:
+        telemetry = Telemetry()
+
+    res_path = os.path.join(path, 'resolution=' + res_key)
+    if os.path.isdir(res_path):
+        shutil.rmtree(res_path)
+
+    names = get_singleindex_columns(df, info_cols)
+    households = [h for h in df.columns.get_level_values('household').unique() if h != '']
+    for household in households:
+        with telemetry.measure('export', household=household, format='parquet', resolution=res_key, 
+                               rows_in=len(df.index)) as record:
+            columns = [i for i, col in enumerate(df.columns)
+                       if col[df.columns.names.index('household')] == household and col[0] != info_cols['marker']]
+
+            # Only write the time range in which the household has any valid data
+            valid = np.flatnonzero(df.iloc[:, columns].notnull().values.any(axis=1))
+            if len(valid) == 0:
+                record['rows_out'] = 0
+                continue
+            data = df.iloc[valid[0]:valid[-1]+1]
+
+            fields = [(info_cols['utc'], data.index, {})]
+            fields += [(col[0], data.iloc[:, i], {}) for i, col in enumerate(df.columns) if col[0] == info_cols['cet']]
+            fields += [(names[i], _output_values(data.iloc[:, i]), dict(zip(df.columns.names, df.columns[i])))
+                       for i in columns]
+
+            marker = (info_cols['marker'], household) + ('',)*(df.columns.nlevels-2)
+            if marker in df.columns:
+                marker_feeds = [feed[df.columns.names.index('feed')] for feed in get_marker_feeds(df.columns, household)]
+                fields.append((info_cols['marker'], data.iloc[:, df.columns.get_loc(marker)],
+                               {'feeds': json.dumps(marker_feeds)}))
+
+            arrays = [pa.array(values) for _, values, _ in fields]
+            schema = pa.schema([pa.field(name, array.type, metadata={k: str(v) for k, v in metadata.items()} or None)
+                                for (name, _, metadata), array in zip(fields, arrays)],
+                               metadata={'resolution': res_key, 'household': household,
+                                         'levels': json.dumps(list(df.columns.names))})
+            table = pa.Table.from_arrays(arrays, schema=schema)
+
+            # Split the partitions at the turn of each year in UTC
+            years = data.index.year.values
+            years_start = np.flatnonzero(np.diff(years, prepend=years[0]-1))
+            for year_start, year_end in zip(years_start, list(years_start[1:]) + [len(years)]):
+                year_path = os.path.join(res_path, 'household=' + household, 'year=' + str(years[year_start]))
+                os.makedirs(year_path, exist_ok=True)
+
+                pq.write_table(table.slice(year_start, year_end - year_start),
+                               os.path.join(year_path, 'part-0.parquet'), compression=compression)
+
+            logger.debug('Wrote %s data of %s to %i Parquet partitions', res_key, household, len(years_start))
+            record['rows_out'] = len(data.index)
+
+
+def write_sqlite(df, res_key, info_cols, path='household_data.sqlite', stacked=False, chunk_size=100000,
+                 telemetry=None):
+    """
+    Write a data set to a table of a SQLite database in SingleIndex shape.
+
+    All rows are bulk inserted with prepared statements in a single transaction,
+    with journaling and synchronization reduced for the duration of the export.
+    The table household_data_<res_key>_singleindex replaces any previous one and
+    is keyed by the UTC timestamps, to allow time range queries without scanning
+    the whole table. Optionally, the feeds are written in stacked shape to the
+    table household_data_<res_key>_stacked, keyed by the feed and timestamp.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame in MultiIndex shape, with the timestamps as index and the 
+        marker bitmasks of each household, or a single column of expanded markers
+    res_key : str
+        Resolution of the data set, e.g. '1min', '15min' or '60min'
+    info_cols : dict of strings
+        Names for non-data columns such as for the index, for additional
+        timestamps or the marker column
+    path : str
+        Path to the SQLite database file
+    stacked : boolean, default False
+        Flag, if the feeds are additionally written to a stacked table
+    chunk_size : int
+        Number of rows to insert at once
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the export of the tables
+
+    Returns
+    ----------
+    None
+
+    """
+    from household.imputation import expand_markers
+
+    header = expand_markers(df.iloc[:0])
+    names = get_singleindex_columns(header, info_cols)
+    types = ['REAL' if is_float_dtype(dtype) else 'TEXT' for dtype in header.dtypes]
+
+    table = 'household_data_{}_singleindex'.format(res_key)
+    table_stacked = 'household_data_{}_stacked'.format(res_key)
+
+    if telemetry is None:
+        telemetry = Telemetry()
+
+    with telemetry.measure('export', format='sqlite', resolution=res_key, rows_in=len(df.index)) as record:
+        connection = sqlite3.connect(path, isolation_level=None)
+        try:
+            connection.execute('PRAGMA journal_mode = MEMORY')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('PRAGMA temp_store = MEMORY')
+            connection.execute('PRAGMA cache_size = -262144')
+
+            # Commit all tables at once or roll them back on errors
+            with connection:
+                connection.execute('BEGIN')
+                connection.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+                connection.execute('CREATE TABLE "{}" ("{}" TEXT PRIMARY KEY, {})'.format(
+                    table, info_cols['utc'], ', '.join('"{}" {}'.format(n, t) for n, t in zip(names, types))))
+
+                insert = 'INSERT INTO "{}" VALUES ({})'.format(table, ', '.join(['?']*(len(names)+1)))
+                for chunk in range(0, len(df.index), chunk_size):
+                    chunk_df = expand_markers(df.iloc[chunk:chunk+chunk_size])
+                    chunk_columns = [_unpack(_format_dates(chunk_df.index, '%Y-%m-%dT%H:%M:%SZ'))]
+                    chunk_columns += [np.where(pd.isnull(chunk_df.iloc[:, i].values), None,
+                                               _output_values(chunk_df.iloc[:, i].values).astype(object)).tolist()
+                                      for i in range(len(names))]
+
+                    connection.executemany(insert, zip(*chunk_columns))
+
+                if stacked:
+                    connection.execute('DROP TABLE IF EXISTS "{}"'.format(table_stacked))
+                    connection.execute('CREATE TABLE "{}" (feed TEXT, "{}" TEXT, data REAL, '
+                                       'PRIMARY KEY (feed, "{}")) WITHOUT ROWID'.format(
+                                           table_stacked, info_cols['utc'], info_cols['utc']))
+
+                    insert = 'INSERT INTO "{}" VALUES (?, ?, ?)'.format(table_stacked)
+                    stacked_names = get_singleindex_columns(df, info_cols)
+                    for i, col in enumerate(df.columns):
+                        if col[0] in info_cols.values():
+                            continue
+
+                        values = _output_values(df.iloc[:, i].values)
+                        for chunk in range(0, len(values), chunk_size):
+                            chunk_values = values[chunk:chunk+chunk_size]
+                            chunk_valid = pd.notnull(chunk_values)
+                            if not chunk_valid.any():
+                                continue
+
+                            chunk_times = _unpack(_format_dates(df.index[chunk:chunk+chunk_size][chunk_valid],
+                                                                '%Y-%m-%dT%H:%M:%SZ'))
+                            connection.executemany(insert, zip([stacked_names[i]]*len(chunk_times), chunk_times,
+                                                               chunk_values[chunk_valid].tolist()))
+
+        finally:
+            connection.close()
+
+        record['rows_out'] = len(df.index)
+
+    logger.debug('Wrote %i rows of %s data to %s', len(df.index), res_key, path)
+
+
+def get_singleindex_columns(df, info_cols):
+    """
+    Get the column names of the SingleIndex shape of a data set,
+    composed of the region, household and feed of each column.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame in MultiIndex shape
+    info_cols : dict of strings
+        Names for non-data columns such as for the index, for additional
+        timestamps or the marker column
+
+    Returns
+    ----------
+    columns : list of str
+        Column names of the SingleIndex shape
+
+    """
+    regions = df.columns.get_level_values('region')
+    households = df.columns.get_level_values('household')
+    feeds = df.columns.get_level_values('feed')
+
+    return [col[0] if col[0] in info_cols.values()
+            else next(iter([l for l in col if l in regions] or []), None) + \
+                    '_' + next(iter([l for l in col if l in households] or []), None) + \
+                    '_' + next(iter([l for l in col if l in feeds] or []), None)
+            for col in df.columns.values]
+
+
+def _header(df, float_format, date_format):
+    return df.to_csv(float_format=float_format, date_format=date_format).encode('utf-8')
+
+
+def _write_stacked(f, df, info_cols, float_format, date_format, chunk_size):
+    from household.imputation import get_marker_columns, get_marker_names
+
+    columns_names = df.columns.droplevel(['region', 'type', 'unit'])
+    columns_levels = [l for l, name in enumerate(df.columns.names) if name not in ['region', 'type', 'unit']]
+
+    # Only data columns and the marker are stacked, the timestamps are part of the index.
+    # Marker bitmasks of the households are stacked as a single column of expanded markers
+    markers = [df.columns.get_loc(marker) for marker in get_marker_columns(df)]
+    columns = []
+    for i, col in enumerate(df.columns):
+        if col[0] == info_cols['cet'] or i in markers[1:]:
+            continue
+        if i in markers[:1]:
+            marker = ('interpolated',) + ('',)*(df.columns.nlevels-1)
+            columns.append((tuple(marker[l] for l in columns_levels), get_marker_names(df).values))
+        else:
+            columns.append((columns_names[i], df.iloc[:, i].values))
+
+    # Values are only formatted, if all of them are floating point numbers.
+    # Otherwise the stacked data column has the object type and numbers are written as is
+    columns_float = all(is_float_dtype(values.dtype) for _, values in columns)
+
+    header = pd.DataFrame(columns=['data'], index=pd.MultiIndex.from_arrays(
+        [[]]*(columns_names.nlevels+1), names=list(columns_names.names) + [df.index.name]))
+    f.write(_header(header, float_format, date_format))
+
+    terminator = os.linesep.encode('utf-8')
+    for names, values in columns:
+        names = names if columns_names.nlevels > 1 else (names,)
+        names = [_format_objects(np.array([name], dtype=object))[0] for name in names]
+
+        for chunk in range(0, len(values), chunk_size):
+            chunk_values = values[chunk:chunk+chunk_size]
+            chunk_valid = pd.notnull(chunk_values)
+            if not chunk_valid.any():
+                continue
+
+            chunk_values = chunk_values[chunk_valid]
+            chunk_cells = [(np.tile(name, len(chunk_values)), np.full(len(chunk_values), len(name)))
+                           for name in names]
+            chunk_cells.append(_format_dates(df.index[chunk:chunk+chunk_size][chunk_valid], date_format))
+            if columns_float:
+                chunk_cells.append(_format_floats(chunk_values, float_format))
+            elif is_float_dtype(chunk_values.dtype):
+                chunk_cells.append(_format_floats(chunk_values, None))
+            else:
+                chunk_cells.append(_format_objects(chunk_values))
+
+            f.write(_join_cells(chunk_cells, terminator))
+
+
+def _format_rows(df, float_format, date_format):
+    cells = [_format_dates(df.index, date_format)]
+    for i in range(len(df.columns)):
+        values = df.iloc[:, i].values
+        if is_float_dtype(values.dtype):
+            cells.append(_format_floats(values, float_format))
+        elif is_datetime64_any_dtype(df.dtypes.iloc[i]):
+            cells.append(_format_dates(pd.DatetimeIndex(df.iloc[:, i]), date_format))
+        else:
+            cells.append(_format_objects(values.astype(object)))
+
+    return _join_cells(cells, os.linesep.encode('utf-8'))
+
+
+def _output_values(values):
+    # Lean float32 values are written as float64, rounded to the decimals they keep
+    if values.dtype == np.float32:
+        return np.round(values.astype(np.float64), LEAN_DECIMALS)
+
+    return values
+
+
+# Each formatted column of cells is a tuple of the characters of all cells,
+# packed into a single array of bytes, and the length of each cell
+
+def _format_dates(index, date_format):
+    nulls = index.isnull()
+    if date_format == '%Y-%m-%dT%H:%M:%SZ':
+        # Format the local wall time of the timestamps, as the format contains no time zone
+        if index.tz is not None:
+            index = index.tz_localize(None)
+        if not nulls.any() and (index.asi8 % 10**9 == 0).all() and \
+                ((index.year >= 1000) & (index.year <= 9999)).all():
+            return _format_iso(index)
+
+    return _format_objects(np.array(index.strftime(date_format), dtype=object), nulls)
+
+
+def _format_iso(index):
+    seconds = index.asi8//10**9
+    days = (seconds//86400).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    fields = [
+        (0, 4, days.astype('datetime64[Y]').astype(np.int64) + 1970),
+        (5, 2, months.astype(np.int64) % 12 + 1),
+        (8, 2, (days - months).astype(np.int64) + 1),
+        (11, 2, seconds % 86400//3600),
+        (14, 2, seconds % 3600//60),
+        (17, 2, seconds % 60)
+    ]
+    chars = np.empty((len(index), 20), dtype=np.uint8)
+    for pos, char in [(4, '-'), (7, '-'), (10, 'T'), (13, ':'), (16, ':'), (19, 'Z')]:
+        chars[:, pos] = ord(char)
+    for pos, width, values in fields:
+        for p in range(width):
+            chars[:, pos + width-1-p] = values//10**p % 10 + 48
+
+    return chars.ravel(), np.full(len(index), 20)
+
+
+def _format_floats(values, float_format):
+    values = _output_values(values)
+
+    float_precision = re.fullmatch(r'%\.(\d+)f', float_format or '')
+    if float_precision is not None:
+        return _format_fixed(values, int(float_precision.group(1)))
+
+    nulls = np.isnan(values)
+    if float_format is not None:
+        cells = [float_format % v for v in values]
+    else:
+        cells = list(map(repr, values.tolist()))
+
+    return _format_objects(cells, nulls)
+
+
+def _format_fixed(values, precision):
+    # Format each number with its digits right aligned in a matrix of bytes,
+    # as the integer of its value, scaled by the precision
+    scale = 10**precision
+    scaled = np.abs(values)*scale
+    rounded = np.rint(scaled)
+
+    # Numbers, close to the middle between two rounded numbers, may have been rounded
+    # differently than their exact decimal value and are formatted as they are
+    valid = ~np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        exact = valid & (scaled < 2**50) & \
+                (np.abs(scaled - np.floor(scaled) - .5) > scaled*2**-48 + 2**-32)
+
+    integers = np.where(exact, rounded, 0).astype(np.int64)
+    integers_digits = len(str(integers.max()//scale)) if len(integers) > 0 else 1
+    width = 1 + integers_digits + (1 if precision > 0 else 0) + precision
+
+    digits = np.zeros((len(values), width), dtype=np.uint8)
+    lengths = np.zeros(len(values), dtype=np.int64)
+
+    pos = width - 1
+    for p in range(precision):
+        digits[:, pos] = integers % 10 + 48
+        integers = integers//10
+        pos -= 1
+    if precision > 0:
+        digits[:, pos] = ord('.')
+        pos -= 1
+
+    integers_length = np.ones(len(values), dtype=np.int64)
+    for p in range(integers_digits):
+        digits[:, pos] = integers % 10 + 48
+        integers = integers//10
+        integers_length += (integers > 0) & (p+1 < integers_digits)
+        pos -= 1
+
+    lengths[exact] = integers_length[exact] + (1 if precision > 0 else 0) + precision
+    signed = exact & np.signbit(values)
+    lengths[signed] += 1
+    digits[signed, width - lengths[signed]] = ord('-')
+
+    # Format the remaining numbers individually
+    inexact = np.flatnonzero(valid & ~exact)
+    if len(inexact) > 0:
+        inexact_bytes = [('%.{}f'.format(precision) % values[i]).encode('utf-8') for i in inexact]
+        inexact_width = max(len(b) for b in inexact_bytes)
+        if inexact_width > width:
+            digits = np.concatenate((np.zeros((len(values), inexact_width - width), dtype=np.uint8), digits), axis=1)
+            width = inexact_width
+
+        for i, b in zip(inexact, inexact_bytes):
+            digits[i, width-len(b):] = np.frombuffer(b, dtype=np.uint8)
+            lengths[i] = len(b)
+
+    return digits[np.arange(width) >= (width - lengths)[:, None]], lengths
+
+
+def _format_objects(values, nulls=None):
+    if nulls is None:
+        nulls = pd.isnull(values)
+
+    cells = ['' if null else str(value) for value, null in zip(values, nulls)]
+
+    # Quote cells like the csv module, only if any of them contains special characters
+    text = ''.join(cells)
+    if any(c in text for c in ',"\r\n'):
+        cells = ['"' + cell.replace('"', '""') + '"' if any(c in cell for c in ',"\r\n') else cell
+                 for cell in cells]
+        text = ''.join(cells)
+
+    return _pack(cells, text)
+
+
+def _pack(cells, text):
+    if text.isascii():
+        lengths = np.fromiter(map(len, cells), dtype=np.int64, count=len(cells))
+        return np.frombuffer(text.encode('ascii'), dtype=np.uint8), lengths
+
+    cells = [cell.encode('utf-8') for cell in cells]
+    lengths = np.fromiter(map(len, cells), dtype=np.int64, count=len(cells))
+    return np.frombuffer(b''.join(cells), dtype=np.uint8), lengths
+
+
+def _unpack(cells):
+    chars, lengths = cells
+    text = chars.tobytes()
+    ends = np.cumsum(lengths).tolist()
+    if text.isascii():
+        text = text.decode('ascii')
+        return [text[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+    return [text[start:end].decode('utf-8') for start, end in zip([0] + ends[:-1], ends)]
+
+
+def _join_cells(cells, terminator):
+    rows_length = sum(lengths for _, lengths in cells) + len(cells) - 1 + len(terminator)
+    rows_end = np.cumsum(rows_length)
+    rows_start = rows_end - rows_length
+
+    buffer = np.empty(rows_end[-1] if len(rows_end) > 0 else 0, dtype=np.uint8)
+    pos = rows_start
+    for c, (chars, lengths) in enumerate(cells):
+        # Move the characters of each cell from its packed position to its row
+        chars_start = np.cumsum(lengths) - lengths
+        buffer[np.repeat(pos - chars_start, lengths) + np.arange(len(chars))] = chars
+
+        pos = pos + lengths
+        if c < len(cells) - 1:
+            buffer[pos] = ord(',')
+            pos += 1
+
+    for t, char in enumerate(terminator):
+        buffer[pos + t] = char
+
+    return buffer.tobytes()
@@ -9,73 +9,275 @@ imputation.py : fill functions for imputation of missing data.
 import logging
 logger = logging.getLogger(__name__)
 
+import os
+import bisect
+import pytz
 import numpy as np
 import pandas as pd
 
+from pandas.api.types import is_unsigned_integer_dtype
+
 from datetime import timedelta
-from .tools import update_progress
+from .tools import assemble, restore_dtype
+from .chunking import Spill
+from .telemetry import Telemetry
+
+# Number of days of prior data, that is read before the regions of missing values of a 
+# time window at first, as the imputation of a week needs at least two weeks before it
+IMPUTATION_HALO = 15
 
 
-def make_equidistant(household, household_data, interval):
-    equidistant = pd.DataFrame()
+def make_equidistant(household, household_data, interval, telemetry=None):
+    equidistant = []
     resolution = str(interval) + 'min'
     
+    if telemetry is None:
+        telemetry = Telemetry()
+    
     logger.info('Aggregate %s intervals for %s series', resolution, household['name'])
     feeds_columns = household_data.columns.get_level_values('feed')
     feeds_existing = len(household_data.columns)
     feeds_success = 0
     
-    for feed_name in household['series'].keys():
-        feed = household_data.loc[:, feeds_columns == feed_name].dropna()
-        
-        if(len(feed.index) != 0):
-            # Find measurement outages, longer than 15 minutes
-            index_delta = pd.Series(feed.index, index=feed.index)
-            index_delta = (index_delta.shift(-1) - index_delta)/np.timedelta64(1, 'm')
-            outage = index_delta.loc[index_delta > 15]
-            
-            # Extend index to have a regular frequency
-            minute = feed.index[0].minute + (interval - feed.index[0].minute % interval)
-            hour = feed.index[0].hour
-            if(minute > 59):
-                minute = 0
-                hour += 1
-            feed_start = feed.index[0].replace(hour=hour, minute=minute, second=0)
-            
-            minute = feed.index[-1].minute - (feed.index[-1].minute % interval)
-            hour = feed.index[-1].hour
-            if(minute > 59):
-                minute = 0
-                hour += 1
-            feed_end = feed.index[-1].replace(hour=hour, minute=minute, second=0)
-            
-            feed_index = pd.date_range(start=feed_start, end=feed_end, freq=resolution)
-            feed = feed.combine_first(pd.DataFrame(index=feed_index, columns=feed.columns))
-            feed.index.name = 'timestamp'
+    with telemetry.measure('make_equidistant', household=household['id'], 
+                           rows_in=len(household_data.index)) as record:
+        for feed_name in household['series'].keys():
+            with telemetry.measure('make_equidistant', household=household['id'], feed=feed_name) as feed_record:
+                feed = household_data.loc[:, feeds_columns == feed_name].dropna()
+                feed_record['rows_in'] = len(feed.index)
+                
+                if(len(feed.index) != 0):
+                    feed_start, feed_end = _equidistant_range(feed.index[0], feed.index[-1], interval)
+                    feed_index = pd.date_range(start=feed_start, end=feed_end, freq=resolution)
+                    # Interpolate the values between the irregular data points onto the regular index, 
+                    # to receive an index that is sure to be continuous, in order to later expose 
+                    # remaining gaps in the data.
+                    feed_values = _interpolate_index(feed.index.asi8, feed.values[:,0].astype(np.float64), 
+                                                     feed_index.asi8)
+                    
+                    # Data points off the regular index are dropped, valid rows without a data point imputed
+                    feed_match = np.isin(feed_index.asi8, feed.index.asi8, assume_unique=True)
+                    feed_record['rows_dropped'] = len(feed.index) - np.count_nonzero(feed_match)
+                    feed_record['rows_imputed'] = np.count_nonzero(~feed_match & ~np.isnan(feed_values))
+                    
+                    feed = pd.DataFrame(restore_dtype(feed_values, feed.dtypes.iloc[0]), 
+                                        index=feed_index, columns=feed.columns)
+                    
+                    equidistant.append(feed)
+                
+                feed_record['rows_out'] = len(feed.index)
             
-            # Drop rows with outages longer than 15 minutes
-            for i in outage.index:
-                error = feed[i:i+timedelta(minutes=outage.loc[i])][1:-1]
-                feed = feed.drop(error.index)
+            record['rows_dropped'] = (record['rows_dropped'] or 0) + (feed_record['rows_dropped'] or 0)
+            record['rows_imputed'] = (record['rows_imputed'] or 0) + (feed_record['rows_imputed'] or 0)
             
-            # Interpolate the values between the irregular data points and drop them afterwards, 
-            # to receive a regular index that is sure to be continuous, in order to later expose 
-            # remaining gaps in the data.
-            feed = feed.interpolate()
-            feed = feed.reindex(index=feed_index)
+            feeds_success += 1
+            telemetry.progress('make_equidistant', feeds_success, feeds_existing)
+        
+        # Feeds without any value on the regular index are only kept after the first feed with values
+        while len(equidistant) > 1 and equidistant[0].empty:
+            equidistant.pop(0)
+        
+        equidistant = assemble(equidistant)
+        
+        # The union of the regular indexes keeps their frequency, as long as it is continuous
+        if len(equidistant.index) > 0 and equidistant.index.freq is None:
+            index_delta = np.diff(equidistant.index.asi8)
+            if (index_delta == pd.Timedelta(minutes=interval).value).all():
+                equidistant.index = pd.date_range(start=equidistant.index[0], periods=len(equidistant.index), 
+                                                  freq=resolution, name=equidistant.index.name)
+        
+        record['rows_out'] = len(equidistant.index)
+    
+    return equidistant
+
+
+def make_equidistant_chunks(household, feeds, windows, interval, path, telemetry=None):
+    '''
+    Interpolate the validated feeds of a household onto a regular index in time windows,
+    equivalent to make_equidistant(), without keeping the feeds in memory.
+
+    Each window is interpolated from its data points and the adjacent data point before 
+    and after it, as they are all the interpolation and the outage rule need to look at.
+    The regions of missing values of each feed are collected along, to be filled by 
+    fill_nan_chunks().
+
+    Parameters
+    ----------
+    household : dict
+        Configuration dictionary of the household
+    feeds : dict of household.chunking.Spill
+        Validated data points of the feeds, appended for each window, by feed name
+    windows : list of tuple
+        Consecutive time windows, see household.chunking.get_windows()
+    interval : int
+        Interval of the regular index in minutes
+    path : str
+        Directory of the spill files
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the aggregation of each feed and the household
+
+    Returns
+    ----------
+    equidistant : dict of household.chunking.Spill
+        Values of the feeds on the regular index, without leading feeds without values
+    regions : dict of tuple
+        Timestamps of the first and last missing value of each region in nanoseconds, 
+        between the first and last valid value of each feed
+
+    '''
+    equidistant = {}
+    regions = {}
+    resolution = str(interval) + 'min'
+    period = pd.Timedelta(minutes=interval).value
+    
+    if telemetry is None:
+        telemetry = Telemetry()
+    
+    logger.info('Aggregate %s intervals for %s series', resolution, household['name'])
+    feeds_existing = len(feeds)
+    feeds_success = 0
+    
+    with telemetry.measure('make_equidistant', household=household['id'], rows_dropped=0, rows_imputed=0) as record:
+        for feed_name, feed in feeds.items():
+            with telemetry.measure('make_equidistant', household=household['id'], feed=feed_name, 
+                                   rows_in=len(feed), rows_out=0) as feed_record:
+                if len(feed) != 0:
+                    feed_start, feed_end = _equidistant_range(pd.Timestamp(feed.read(0, 1)[0][0], tz=pytz.utc), 
+                                                              pd.Timestamp(feed.read(len(feed)-1, len(feed))[0][0], 
+                                                                           tz=pytz.utc), interval)
+                    feed_size = max((feed_end.value - feed_start.value)//period + 1, 0)
+                    feed_index = Spill(os.path.join(path, feed_name + '_equidistant'), 
+                                       start=feed_start.value, period=period)
+                    
+                    feed_match = 0
+                    feed_imputed = 0
+                    nan_starts = []
+                    nan_tills = []
+                    nan_start = None
+                    valid_before = False
+                    for i, (start, end) in enumerate(windows):
+                        index_start = min(max(-(-(start - feed_start.value)//period), 0), feed_size)
+                        index_end = min(max(-(-(end - feed_start.value)//period), 0), feed_size)
+                        if index_start == index_end:
+                            continue
+                        
+                        index = feed_start.value + np.arange(index_start, index_end, dtype=np.int64)*period
+                        times, values = feed.read(feed.windows[i]-1, feed.windows[i+1]+1)
+                        
+                        index_values = _interpolate_index(times, values, index)
+                        index_match = np.isin(index, times, assume_unique=True)
+                        feed_match += np.count_nonzero(index_match)
+                        feed_imputed += np.count_nonzero(~index_match & ~np.isnan(index_values))
+                        
+                        feed_index.write(index_start, index_values)
+                        
+                        # Continue the regions of missing values of the previous windows, 
+                        # but not before the first valid value
+                        index_nan = np.isnan(index_values)
+                        if not valid_before:
+                            valid = np.flatnonzero(~index_nan)
+                            if len(valid) == 0:
+                                continue
+                            
+                            index_nan[:valid[0]] = False
+                            valid_before = True
+                        
+                        nan_edges = np.diff(np.concatenate(([int(nan_start is not None)], index_nan.view(np.int8))))
+                        window_starts = list(np.flatnonzero(nan_edges == 1) + index_start)
+                        window_tills = list(np.flatnonzero(nan_edges == -1) + index_start - 1)
+                        if nan_start is not None:
+                            window_starts.insert(0, nan_start)
+                        
+                        # Regions after the last valid value are never closed
+                        nan_start = window_starts.pop() if index_nan[-1] else None
+                        nan_starts += window_starts
+                        nan_tills += window_tills
+                    
+                    feed_record['rows_dropped'] = len(feed) - feed_match
+                    feed_record['rows_imputed'] = feed_imputed
+                    feed_record['rows_out'] = feed_size
+                    
+                    equidistant[feed_name] = feed_index
+                    regions[feed_name] = (feed_start.value + np.array(nan_starts, dtype=np.int64)*period, 
+                                          feed_start.value + np.array(nan_tills, dtype=np.int64)*period)
             
-            if equidistant.empty:
-                equidistant = feed
-            else:
-                equidistant = equidistant.combine_first(feed)
+            record['rows_dropped'] += feed_record['rows_dropped'] or 0
+            record['rows_imputed'] += feed_record['rows_imputed'] or 0
             
-        feeds_success += 1
-        update_progress(feeds_success, feeds_existing)
+            feeds_success += 1
+            telemetry.progress('make_equidistant', feeds_success, feeds_existing)
+        
+        # Feeds without any value on the regular index are only kept after the first feed with values
+        while len(equidistant) > 1 and len(next(iter(equidistant.values()))) == 0:
+            del equidistant[next(iter(equidistant))]
+        
+        record['rows_out'] = sum(len(feed) for feed in equidistant.values())
     
-    return equidistant
+    return equidistant, regions
+
+
+def _equidistant_range(first, last, interval):
+    # Extend index to have a regular frequency
+    minute = first.minute + (interval - first.minute % interval)
+    if(minute > 59):
+        minute = 60
+    feed_start = first.replace(minute=0, second=0) + timedelta(minutes=minute)
+    
+    minute = last.minute - (last.minute % interval)
+    feed_end = last.replace(minute=minute, second=0)
+    
+    return feed_start, feed_end
+
+
+def _interpolate_index(times, values, index, outage=15):
+    '''
+    Interpolate the values between the irregular data points onto a regular index, 
+    leaving measurement outages longer than the given number of minutes empty.
+
+    The values are interpolated linearly by their position within the union of the 
+    data points and the index, as the interpolation of the combined series would.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Sorted timestamps of the data points in nanoseconds since the epoch
+    values : numpy.ndarray
+        Values of the data points
+    index : numpy.ndarray
+        Sorted timestamps of the regular index in nanoseconds since the epoch
+    outage : int
+        Minimum length in minutes of gaps between data points to be left empty
+
+    Returns
+    ----------
+    values_index: numpy.ndarray
+        Interpolated values of the regular index
+
+    '''
+    if len(times) == 0 or len(index) == 0:
+        return np.full(len(index), np.NaN)
+    
+    # Mask the index within measurement outages, as well as before the first data point
+    times_next = np.searchsorted(times, index, side='right')
+    times_gaps = np.append(np.diff(times) > outage*60*10**9, False)
+    index_outage = (times_next == 0) | times_gaps[np.maximum(times_next-1, 0)] & \
+                   (times[np.maximum(times_next-1, 0)] < index)
+    
+    # Rows of the index, not matching any data point, shift the positions of all later rows
+    times_prev = np.searchsorted(times, index, side='left')
+    index_match = times[np.minimum(times_prev, len(times)-1)] == index
+    index_extra = index[~index_match & ~index_outage]
+    
+    times_pos = np.arange(len(times)) + np.searchsorted(index_extra, times, side='left')
+    index_pos = times_prev + np.searchsorted(index_extra, index, side='left')
+    
+    values_index = np.interp(index_pos.astype(float), times_pos.astype(float), values)
+    values_index[index_outage] = np.NaN
+    
+    return values_index
 
 
-def fill_nan(df, name, headers, config_dir='conf'):
+def fill_nan(df, name, headers, config_dir='conf', telemetry=None):
     '''
     Search for missing values in a DataFrame and optionally apply further 
     functions on each column.
@@ -91,107 +293,471 @@ def fill_nan(df, name, headers, config_dir='conf'):
         for the columns of the dataframe
     config_dir : str
          directory path where all configurations can be found
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the filling of each feed and the household, with the 
+        valid values in and out, as well as the imputed values
 
     Returns
     ----------    
     data_filled: pandas.DataFrame
-        original df or df with gaps patched and marker column appended
+        original df or df with gaps patched and a marker column for each household appended.
+        The markers are bitmasks of the households interpolated feeds, see get_marker_feeds()
     data_nan: pandas.DataFrame
         Contains detailed information about missing data
 
     '''
-    data_nan = pd.DataFrame()
-    data_filled = pd.DataFrame()
+    data_nan = []
+    data_filled = []
 
     df.index = df.index.tz_convert('UTC')
-    col_marker = pd.Series(np.NaN, index=df.index)
+    col_markers = {}
+    for household in df.columns.get_level_values('household').unique():
+        if len(get_marker_feeds(df.columns, household)) > 64:
+            raise ValueError('Unable to mark more than 64 feeds of household {}'.format(household))
+        
+        col_markers[household] = np.zeros(len(df.index), dtype=np.uint64)
 
     logger.info('Process %s gaps', name)
 
+    if telemetry is None:
+        telemetry = Telemetry()
+
     feeds_existing = len(df.columns)
     feeds_success = 0
 
-    # Get the frequency/length of one period of df
-    one_period = df.index[1] - df.index[0]
-    for col_name, col in df.iteritems():
-        col = col.to_frame()
+    households = list(col_markers)
+    with telemetry.measure('fill_nan', household=households[0] if len(households) == 1 else None, 
+                           rows_in=len(df.index)) as record:
+        # Get the frequency/length of one period of df
+        one_period = df.index[1] - df.index[0]
+        for col_name, col in df.iteritems():
+            household = col_name[df.columns.names.index('household')]
+            with telemetry.measure('fill_nan', household=household, feed=col_name[df.columns.names.index('feed')], 
+                                   rows_in=col.count()) as feed_record:
+                # Impute lean float32 values with full precision
+                col_dtype = col.dtype
+                col = col.to_frame().astype(np.float64, copy=False)
 
-        # skip this column if it has no entries at all
-        if col.empty:
-            continue
+                # skip this column if it has no entries at all
+                if col.empty:
+                    continue
+
+                # find all regions of consecutive NaN values in the data
+                # (but not before first or after last actual entry)
+                nan_starts, nan_tills = _nan_regions(col.iloc[:, 0].values)
+
+                if len(nan_starts) == 0:
+                    #logger.debug('Nothing to fill in for column %s', col_name_str)
+                    
+                    nan_list = _nan_list(None, col.columns)
+
+                else:
+                    nan_blocks = _nan_blocks(col.index[nan_starts], col.index[nan_tills], one_period)
+                    
+                    marker_bit = get_marker_feeds(df.columns, household).get_loc(col_name)
+                    
+                    col, col_markers[household] = _interpolate(name, col, col_name, col_markers[household], 
+                                                               marker_bit, nan_blocks, one_period)
+                    
+                    # Excel does not support datetimes with timezones, hence they need to be removed
+                    nan_list = _nan_list(nan_blocks, col.columns)
+                
+                col = restore_dtype(col, col_dtype)
+                data_filled.append(col)
+                data_nan.append(nan_list)
+                
+                feed_record['rows_out'] = col.iloc[:, 0].count()
+                feed_record['rows_imputed'] = feed_record['rows_out'] - feed_record['rows_in']
+            
+            record['rows_imputed'] = (record['rows_imputed'] or 0) + (feed_record['rows_imputed'] or 0)
+            
+            feeds_success += 1
+            telemetry.progress('fill_nan', feeds_success, feeds_existing)
 
-        # tag all occurences of NaN in the data with True
-        # (but not before first or after last actual entry)
-        col['tag'] = (
-            (col.index >= col.first_valid_index()) &
-            (col.index <= col.last_valid_index()) &
-            col.isnull().transpose().values
-        ).transpose()
+        data_filled = assemble(data_filled)
+        data_nan = assemble(data_nan)
+        record['rows_out'] = len(data_filled.index)
 
-        # make another DF to hold info about each region
-        nan_blocks = pd.DataFrame()
+    # append the markers of each household to the DataFrame
+    tuples = [('interpolated', household, '', '', '') for household in col_markers]
+    col_markers = pd.DataFrame(col_markers, index=df.index)
+    col_markers.columns = pd.MultiIndex.from_tuples(tuples, names=headers)
+    data_filled = pd.concat([data_filled, col_markers], axis=1)
+
+    # set the level names for the output
+    data_nan.columns.names = headers
+    data_filled.columns.names = headers
 
-        # first row of consecutive region is a True preceded by a False in tags
-        nan_blocks['start_idx'] = col.index[col['tag'] & ~col['tag'].shift(1).fillna(False)]
+    return data_filled, data_nan
 
-        # last row of consecutive region is a False preceded by a True
-        nan_blocks['till_idx'] = col.index[col['tag'] & ~col['tag'].shift(-1).fillna(False)]
 
-        nan_blocks = nan_blocks.sort_values('till_idx').reset_index()
+def fill_nan_chunks(household, feeds, regions, windows, headers, path, telemetry=None):
+    '''
+    Fill the regions of missing values of the equidistant feeds of a household in time 
+    windows, equivalent to fill_nan(), without keeping the feeds in memory.
 
-        if not col['tag'].any():
-            #logger.debug('Nothing to fill in for column %s', col_name_str)
-            
-            col.drop('tag', axis=1, inplace=True)
-            nan_idx = pd.MultiIndex.from_arrays([
-                [0, 0, 0, 0],
-                ['count', 'span', 'start_idx', 'till_idx']])
-            nan_list = pd.DataFrame(index=nan_idx, columns=col.columns)
+    Each region is filled with the window it begins in, which is extended to the end 
+    of regions exceeding it. Regions longer than one hour are imputed with the prior 
+    days before them, which are looked back to as far as the imputation needs, while the 
+    counter offsets of all imputed regions are carried on to the following windows. 
+    The filled values are spilled, to be the prior days of the following windows. 
+    As a region only adds its mark to rows of other feeds marked before, if it overlaps 
+    any of them, the markers are derived from the regions of all feeds in advance.
+
+    Parameters
+    ----------
+    household : dict
+        Configuration dictionary of the household
+    feeds : dict of household.chunking.Spill
+        Values of the feeds on the regular index, see make_equidistant_chunks()
+    regions : dict of tuple
+        Timestamps of the first and last missing value of each region of the feeds
+    windows : list of tuple
+        Consecutive time windows, see household.chunking.get_windows()
+    headers : list
+        List of strings indicating the level names of the pandas.MultiIndex
+        for the columns of the dataframe
+    path : str
+        Directory of the spill files
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the filling of each window, with the valid values in 
+        and out, as well as the imputed values
+
+    Returns
+    ----------
+    data_filled: generator of pandas.DataFrame
+        Filled data of each window with rows, with a marker column for the household appended
+    data_nan: pandas.DataFrame
+        Contains detailed information about missing data
 
+    '''
+    if telemetry is None:
+        telemetry = Telemetry()
+    
+    name = household['name']
+    household_id = household['id']
+    
+    columns = []
+    for feed_name in feeds.keys():
+        column = {
+            'region': household['region'],
+            'household': household_id,
+            'type': household['type'],
+            'unit': household['series'][feed_name]['unit'],
+            'feed': feed_name
+        }
+        columns.append(tuple(column[level] for level in headers))
+    
+    columns = pd.MultiIndex.from_tuples(columns, names=headers)
+    if len(columns) > 1:
+        columns = columns.unique().sort_values()
+    
+    if len(get_marker_feeds(columns, household_id)) > 64:
+        raise ValueError('Unable to mark more than 64 feeds of household {}'.format(household_id))
+    
+    logger.info('Process %s gaps', name)
+    
+    # The union of the regular indexes of all feeds, as intervals of the same period
+    period = max([feed.period for feed in feeds.values()] or [0])
+    union = _union_intervals([feed.start for feed in feeds.values() if len(feed) > 0], 
+                             [feed.start + (len(feed)-1)*feed.period for feed in feeds.values() if len(feed) > 0])
+    
+    # Get the frequency/length of one period of the union
+    one_period = None
+    if len(union[0]) > 0 and union[1][0] > union[0][0]:
+        one_period = pd.Timedelta(period)
+    elif len(union[0]) > 1:
+        one_period = pd.Timedelta(union[0][1] - union[0][0])
+    
+    data_nan = []
+    fills = []
+    marked = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    for column in columns:
+        feed_name = column[headers.index('feed')]
+        feed = feeds[feed_name]
+        nan_starts, nan_tills = regions[feed_name]
+        col_columns = pd.Series(dtype=np.float64, name=column).to_frame().columns
+        
+        if len(nan_starts) == 0:
+            nan_blocks = None
+            
+            data_nan.append(_nan_list(None, col_columns))
+            marks = (nan_starts, nan_tills)
         else:
-            # how long is each region
-            nan_blocks['span'] = (
-                nan_blocks['till_idx'] - nan_blocks['start_idx'] + one_period)
-            nan_blocks['count'] = (nan_blocks['span'] / one_period)
+            nan_blocks = _nan_blocks(pd.DatetimeIndex(nan_starts.view('datetime64[ns]')).tz_localize(pytz.utc), 
+                                     pd.DatetimeIndex(nan_tills.view('datetime64[ns]')).tz_localize(pytz.utc), 
+                                     one_period)
+            data_nan.append(_nan_list(nan_blocks, col_columns))
+            
+            # Regions, already marked for other columns, only add the mark to existing markers
+            comment_again, comment_before = _intersect_intervals(marked, nan_starts, nan_tills)
+            marks = _union_intervals(np.concatenate((nan_starts[~comment_again], comment_before[0])), 
+                                     np.concatenate((nan_tills[~comment_again], comment_before[1])))
+            marked = _union_intervals(np.concatenate((marked[0], marks[0])), 
+                                      np.concatenate((marked[1], marks[1])))
+            
+            logger.debug('Interpolated %s %s gaps: %i blocks of NaN values', name, feed_name, len(nan_starts))
+        
+        fills.append({
+            'column': column,
+            'feed': feed,
+            'filled': Spill(os.path.join(path, feed_name + '_filled'), start=feed.start, period=feed.period),
+            'nan_starts': nan_starts,
+            'nan_tills': nan_tills,
+            'nan_blocks': nan_blocks,
+            'nan_next': 0,
+            'offsets': ([], []),
+            'marks': marks,
+            'marker_bit': get_marker_feeds(columns, household_id).get_loc(column),
+            'done': union[0][0] if len(union[0]) > 0 else 0
+        })
+    
+    data_nan = assemble(data_nan)
+    data_nan.columns.names = headers
+    
+    return _fill_chunks(name, household_id, fills, union, period, windows, one_period, headers, telemetry), data_nan
+
+
+def _fill_chunks(name, household_id, fills, union, period, windows, one_period, headers, telemetry):
+    if len(union[0]) == 0:
+        return
+    
+    first = union[0][0]
+    for window, (start, end) in enumerate(windows):
+        times = _interval_times(union, period, start, end)
+        if len(times) == 0:
+            continue
+        
+        with telemetry.measure('fill_nan', household=household_id, chunk=window, 
+                               rows_in=0, rows_out=0) as record:
+            index = pd.DatetimeIndex(times.view('datetime64[ns]')).tz_localize(pytz.utc).tz_convert('UTC')
+            marker = np.zeros(len(times), dtype=np.uint64)
+            
+            data_filled = []
+            for fill in fills:
+                _fill_chunk(name, fill, union, end, first, one_period)
+                
+                values = np.full(len(times), np.NaN)
+                record['rows_in'] += _spilled_values(values, times, fill['feed'], start, end)
+                _spilled_values(values, times, fill['filled'], start, end)
+                if len(fill['offsets'][0]) > 0:
+                    offsets = (list(np.searchsorted(times, fill['offsets'][0], side='left')), fill['offsets'][1])
+                    values += _offsets_at(offsets, np.arange(len(times)))
+                
+                record['rows_out'] += np.count_nonzero(~np.isnan(values))
+                data_filled.append(pd.Series(values, index=index, name=fill['column']).to_frame())
+                
+                marks_pos = np.searchsorted(fill['marks'][0], times, side='right') - 1
+                marks_now = (marks_pos >= 0) & (times <= fill['marks'][1][np.maximum(marks_pos, 0)]) \
+                            if len(fill['marks'][0]) > 0 else np.zeros(len(times), dtype=bool)
+                marker[marks_now] |= np.uint64(1 << fill['marker_bit'])
             
-            col.drop('tag', axis=1, inplace=True)
+            record['rows_imputed'] = record['rows_out'] - record['rows_in']
             
-            col, col_marker = _interpolate(df, name, col, col_name, col_marker, nan_blocks, one_period)
+            data_filled = assemble(data_filled)
             
-            nan_list = nan_blocks.copy()
-            # Excel does not support datetimes with timezones, hence they need to be removed
-            nan_list['start_idx'] = nan_list['start_idx'].dt.tz_convert('UTC').dt.tz_localize(None)
-            nan_list['till_idx'] = nan_list['till_idx'].dt.tz_convert('UTC').dt.tz_localize(None)
-            nan_list = nan_list.stack().to_frame()
-            nan_list.columns = col.columns
+            # append the marker of the household to the DataFrame
+            markers = pd.DataFrame({household_id: marker}, index=index)
+            markers.columns = pd.MultiIndex.from_tuples([('interpolated', household_id, '', '', '')], names=headers)
+            data_filled = pd.concat([data_filled, markers], axis=1)
+            data_filled.columns.names = headers
         
-        if data_filled.empty:
-            data_filled = col
-        else:
-            data_filled = data_filled.combine_first(col)
+        yield data_filled
 
-        if data_nan.empty:
-            data_nan = nan_list
-        else:
-            data_nan = data_nan.combine_first(nan_list)
+
+def _fill_chunk(name, fill, union, end, first, one_period):
+    '''
+    Fill the regions of missing values of a feed, beginning before the end of a time window,
+    and spill the filled values without counter offsets up to the end of the window, or 
+    the end of the last region exceeding it.
+    '''
+    feed = fill['feed']
+    done = fill['done']
+    if done >= end:
+        return
+    
+    nan_starts = fill['nan_starts']
+    nan_tills = fill['nan_tills']
+    nan_next = fill['nan_next']
+    nan_end = nan_next
+    while nan_end < len(nan_starts) and nan_starts[nan_end] < end:
+        end = max(end, nan_tills[nan_end] + 2*feed.period)
+        nan_end += 1
+    
+    if nan_end == nan_next:
+        pos_start, pos_end = _spilled_range(feed, done, end)
+        fill['filled'].write(pos_start, feed.read(pos_start, pos_end)[1])
+        fill['done'] = end
+        return
+    
+    # The halo covers all values not yet spilled, even if they precede the first region by more than its length
+    halo_start = max(first, min(done, nan_starts[nan_next] - pd.Timedelta(days=IMPUTATION_HALO).value))
+    while True:
+        times = _interval_times(union, feed.period, halo_start, end)
+        values = np.full(len(times), np.NaN)
+        _spilled_values(values, times, fill['filled'], halo_start, done)
+        _spilled_values(values, times, feed, done, end)
+        
+        col = pd.DataFrame(values, index=pd.DatetimeIndex(times.view('datetime64[ns]')).tz_localize(pytz.utc), 
+                           columns=[fill['column']])
         
-        feeds_success += 1
-        update_progress(feeds_success, feeds_existing)
+        # Offsets of prior regions, imputed before the halo, apply to all of its values
+        offsets = (list(np.searchsorted(times, fill['offsets'][0], side='left')), list(fill['offsets'][1]))
+        values, offsets, lookback = _impute(name, col, fill['column'], fill['nan_blocks'].iloc[nan_next:nan_end], 
+                                            np.searchsorted(times, nan_starts[nan_next:nan_end]), 
+                                            np.searchsorted(times, nan_tills[nan_next:nan_end]), 
+                                            one_period, offsets, first)
+        
+        # Look further back, if the imputation probed prior days before the halo
+        if lookback is None or lookback >= halo_start or halo_start <= first:
+            break
+        
+        halo_start = max(first, lookback)
+    
+    offsets_count = len(fill['offsets'][0])
+    fill['offsets'][0].extend(times[offsets[0][offsets_count:]])
+    fill['offsets'][1].extend(offsets[1][offsets_count:])
+    
+    pos_start, pos_end = _spilled_range(feed, done, end)
+    if pos_end > pos_start:
+        fill['filled'].write(pos_start, values[np.searchsorted(times, feed.start + np.arange(pos_start, pos_end)*feed.period)])
+    
+    fill['nan_next'] = nan_end
+    fill['done'] = end
 
-    # append the marker to the DataFrame
-    tuples = [('interpolated', '', '', '', '')]
-    col_marker = col_marker.to_frame()
-    col_marker.columns = pd.MultiIndex.from_tuples(tuples, names=headers)
-    data_filled = pd.concat([data_filled, col_marker], axis=1)
 
-    # set the level names for the output
-    data_nan.columns.names = headers
-    data_filled.columns.names = headers
+def _spilled_range(feed, start, end):
+    # Positions of the values of a regular spilled series within a time range
+    pos_start = min(max(-(-(start - feed.start)//feed.period), 0), len(feed))
+    pos_end = min(max(-(-(end - feed.start)//feed.period), 0), len(feed))
+    
+    return pos_start, max(pos_start, pos_end)
 
-    return data_filled, data_nan
+
+def _spilled_values(values, times, feed, start, end):
+    # Place the values of a regular spilled series within a time range at their timestamps
+    feed_times, feed_values = feed.read(*_spilled_range(feed, start, end))
+    values[np.searchsorted(times, feed_times)] = feed_values
+    
+    return np.count_nonzero(~np.isnan(feed_values))
 
 
-def _interpolate(df, name, col, col_name, col_marker, nan_blocks, one_period):
+def _union_intervals(starts, tills):
+    # Merge overlapping intervals of timestamps, including their first and last one
+    starts = np.asarray(starts, dtype=np.int64)
+    tills = np.asarray(tills, dtype=np.int64)
+    if len(starts) == 0:
+        return starts, tills
+    
+    order = np.argsort(starts, kind='stable')
+    starts, tills = starts[order], tills[order]
+    
+    merged = np.flatnonzero(np.concatenate(([True], starts[1:] > np.maximum.accumulate(tills)[:-1])))
+    
+    return starts[merged], np.maximum.reduceat(tills, merged)
+
+
+def _intersect_intervals(intervals, starts, tills):
+    # Intersect merged intervals with several others, returning which of them overlap any at all
+    lower = np.searchsorted(intervals[1], starts, side='left')
+    upper = np.searchsorted(intervals[0], tills, side='right')
+    counts = np.maximum(upper - lower, 0)
+    
+    regions = np.repeat(np.arange(len(starts)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lower, counts)
+    
+    return counts > 0, (np.maximum(starts[regions], intervals[0][positions]), 
+                        np.minimum(tills[regions], intervals[1][positions]))
+
+
+def _interval_times(intervals, period, start, end):
+    # Timestamps of merged regular intervals within a time range
+    times = []
+    for interval_start, interval_till in zip(*intervals):
+        first = max(interval_start, interval_start + -(-(start - interval_start)//period)*period)
+        last = min(interval_till, end - 1)
+        if first <= last:
+            times.append(np.arange(first, last + 1, period, dtype=np.int64))
+    
+    return np.concatenate(times) if len(times) > 0 else np.empty(0, dtype=np.int64)
+
+
+def _nan_regions(values):
+    '''
+    Find regions of consecutive missing values, by run-length encoding the NaN values 
+    between the first and the last valid value.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values of the column to inspect
+
+    Returns
+    ----------
+    nan_starts : numpy.ndarray
+        Positions of the first missing value of each region
+    nan_tills : numpy.ndarray
+        Positions of the last missing value of each region
+
+    '''
+    nan_tags = np.isnan(values)
+    valid = np.flatnonzero(~nan_tags)
+    if len(valid) == 0:
+        return valid, valid
+    
+    nan_tags[:valid[0]] = False
+    nan_tags[valid[-1]+1:] = False
+    
+    nan_edges = np.diff(np.concatenate(([0], nan_tags.view(np.int8), [0])))
+    nan_starts = np.flatnonzero(nan_edges == 1)
+    nan_tills = np.flatnonzero(nan_edges == -1) - 1
+    
+    return nan_starts, nan_tills
+
+
+def _nan_blocks(nan_starts, nan_tills, one_period):
+    # make another DF to hold info about each region
+    nan_blocks = pd.DataFrame()
+    nan_blocks['start_idx'] = nan_starts
+    nan_blocks['till_idx'] = nan_tills
+    
+    # how long is each region
+    nan_blocks['span'] = (
+        nan_blocks['till_idx'] - nan_blocks['start_idx'] + one_period)
+    nan_blocks['count'] = (nan_blocks['span'] / one_period)
+    
+    return nan_blocks
+
+
+def _nan_list(nan_blocks, columns):
+    '''
+    Build the report of all regions of missing data of one column, with one row for 
+    the number, start, end, span and count of each region.
+    '''
+    if nan_blocks is None:
+        nan_idx = pd.MultiIndex.from_arrays([
+            [0, 0, 0, 0],
+            ['count', 'span', 'start_idx', 'till_idx']])
+        return pd.DataFrame(index=nan_idx, columns=columns)
+    
+    nan_fields = ['index', 'start_idx', 'till_idx', 'span', 'count']
+    nan_count = len(nan_blocks.index)
+    
+    nan_values = np.empty((nan_count, len(nan_fields)), dtype=object)
+    nan_values[:, 0] = np.arange(nan_count)
+    nan_values[:, 1] = list(nan_blocks['start_idx'].dt.tz_convert('UTC').dt.tz_localize(None))
+    nan_values[:, 2] = list(nan_blocks['till_idx'].dt.tz_convert('UTC').dt.tz_localize(None))
+    nan_values[:, 3] = list(nan_blocks['span'])
+    nan_values[:, 4] = nan_blocks['count'].values
+    
+    nan_idx = pd.MultiIndex.from_arrays([
+        np.repeat(np.arange(nan_count), len(nan_fields)),
+        np.tile(nan_fields, nan_count)])
+    
+    return pd.DataFrame(nan_values.reshape(-1, 1), index=nan_idx, columns=columns)
+
+
+def _interpolate(name, col, col_name, col_marker, marker_bit, nan_blocks, one_period):
     '''
     Choose the appropriate function for filling a region of missing values.
 
@@ -201,9 +767,11 @@ def _interpolate(df, name, col, col_name, col_marker, nan_blocks, one_period):
         A column from frame as a separate DataFrame
     col_name : tuple
         tuple of header levels of column to inspect
-    col_marker : pandas.DataFrame
-        An n*1 DataFrame specifying for each row which of the previously treated 
-        columns have been patched
+    col_marker : numpy.ndarray
+        Bitmasks specifying for each row which of the previously treated 
+        columns of the household have been patched
+    marker_bit : int
+        Bit of col in the marker of the household
     nan_blocks : pandas.DataFrame
         DataFrame with each row representing a region of missing data in col
     one_period : pandas.Timedelta
@@ -214,43 +782,105 @@ def _interpolate(df, name, col, col_name, col_marker, nan_blocks, one_period):
     col : pandas.DataFrame
         An n*1 DataFrame containing col with nan_blocks filled
         and another column for the marker
-    col_marker: pandas.DataFrame
-        Definition as under Parameters, but now appended with markers for col 
+    col_marker: numpy.ndarray
+        Definition as under Parameters, but now with the bit of col set
 
     '''
-    for i, nan_block in nan_blocks.iterrows():
-        # Interpolate missing value spans up to 2 hours
-        if nan_block['span'] <= timedelta(hours=1):
-            col = _interpolate_hour(i, nan_block, col, one_period)
-        
-        elif col_name[4] == 'pv':
-            col = _impute_by_day(i, nan_block, col, col_name, one_period, 1)
-        else:
-            col = _impute_by_day(i, nan_block, col, col_name, one_period, 7)
-        
-        # Create a marker column to mark where data has been interpolated
-        comment_now = slice(nan_block['start_idx'], nan_block['till_idx'])
-        comment_before = col_marker.notnull()
-        comment_again = comment_before.loc[comment_now]
-        
-        col_name_str = next(iter([level for level in col_name if level in df.columns.get_level_values('region')] or []), None) + '_' + \
-                        next(iter([level for level in col_name if level in df.columns.get_level_values('household')] or []), None).replace(' ', '').lower() + '_' + \
-                        next(iter([level for level in col_name if level in df.columns.get_level_values('feed')] or []), None)
-        
-        if comment_again.any():
-            col_marker[comment_before & comment_again] = col_marker + ' | ' + col_name_str
-        else:
-            col_marker.loc[comment_now] = col_name_str
+    nan_starts = col.index.get_indexer(nan_blocks['start_idx'])
+    nan_tills = col.index.get_indexer(nan_blocks['till_idx'])
+    
+    values, offsets, _ = _impute(name, col, col_name, nan_blocks, nan_starts, nan_tills, one_period)
+    if len(offsets[0]) > 0:
+        values += _offsets_at(offsets, np.arange(len(values)))
+    
+    col[col.columns[0]] = values
+    
+    # Regions, already marked for other columns, only add the mark to existing markers
+    comment_before = col_marker != 0
+    comment_count = np.concatenate(([0], np.cumsum(comment_before)))
+    comment_again = comment_count[nan_tills+1] - comment_count[nan_starts] > 0
+    
+    comment_now = _regions_mask(len(col_marker), nan_starts[~comment_again], nan_tills[~comment_again])
+    comment_now |= _regions_mask(len(col_marker), nan_starts[comment_again], nan_tills[comment_again]) & comment_before
+    
+    col_marker[comment_now] |= np.uint64(1 << marker_bit)
     
     logger.debug('Interpolated %s %s gaps: %i blocks of NaN values', name, col_name[4], nan_blocks.shape[0])
     
     return col, col_marker
 
 
-def _interpolate_hour(i, nan_block, col, one_period):
+def _impute(name, col, col_name, nan_blocks, nan_starts, nan_tills, one_period, offsets=None, first=None):
+    '''
+    Fill the regions of missing values of a column, by interpolating spans up to one
+    hour and imputing longer spans based on prior data.
+
+    Parameters
+    ----------  
+    nan_starts : numpy.ndarray
+        Positions of the first missing value of each region in col
+    nan_tills : numpy.ndarray
+        Positions of the last missing value of each region in col
+    offsets : tuple, default None
+        Sorted lists of positions and counter offsets of spans, imputed before the 
+        regions, if col is only a part of the column
+    first : int, default None
+        First timestamp of the whole column in nanoseconds, if col is only a part of it
+    See _interpolate() for info on other parameters.
+
+    Returns
+    ----------  
+    values : numpy.ndarray
+        Values of col with the regions filled, without the counter offsets
+    offsets : tuple
+        Sorted lists of positions and counter offsets of all imputed spans
+    lookback : int or None
+        Earliest timestamp of prior data in nanoseconds, that was probed to impute
+        the spans longer than one hour
+
+    '''
+    # Interpolate all missing value spans up to 1 hour at once
+    nan_hours = (nan_blocks['span'] <= timedelta(hours=1)).values
+    col = _interpolate_hours(col, nan_starts[nan_hours], nan_tills[nan_hours])
+    
+    values = col.iloc[:, 0].values.copy()
+    
+    # Counter offsets of imputed spans, applied to all following values
+    if offsets is None:
+        offsets = ([], [])
+    
+    lookback = None
+    if not nan_hours.all():
+        # Count missing values before each position, to skip probing prior 
+        # spans for missing values, if none were missing before imputing
+        nan_count = np.concatenate(([0], np.cumsum(np.isnan(values))))
+        
+        for i, nan_block in nan_blocks.loc[~nan_hours].iterrows():
+            if col_name[4] == 'pv':
+                block_lookback = _impute_by_day(i, nan_block, col.index, values, nan_count, offsets, col_name, 
+                                                one_period, 1, first)
+            else:
+                block_lookback = _impute_by_day(i, nan_block, col.index, values, nan_count, offsets, col_name, 
+                                                one_period, 7, first)
+            
+            if block_lookback is not None:
+                lookback = block_lookback if lookback is None else min(lookback, block_lookback)
+    
+    return values, offsets, lookback
+
+
+def _regions_mask(size, starts, tills):
+    regions = np.zeros(size+1, dtype=int)
+    np.add.at(regions, starts, 1)
+    np.add.at(regions, tills+1, -1)
+    
+    return np.cumsum(regions[:-1]) > 0
+
+
+def _interpolate_hours(col, nan_starts, nan_tills):
     '''
-    Interpolate one missing value region in one column as described by 
-    nan_block.
+    Interpolate several missing value regions in one column linearly, between the 
+    valid values enclosing each region.
 
     The default pd.Series.interpolate() function does not work if
     interpolation is to be restricted to periods of a certain length.
@@ -259,34 +889,40 @@ def _interpolate_hour(i, nan_block, col, one_period):
 
     Parameters
     ----------
-    i : int
-        Counter for total number of regions of missing data
-    nan_block : pandas.Series
-        Contains information on one region of missing data in col
-        count: 
-        span:
-        start_idx:
-        till_idx:
-    See _interpolate() for info on other parameters.
+    col : pandas.DataFrame
+        A column from frame as a separate DataFrame
+    nan_starts : numpy.ndarray
+        Positions of the first missing value of each region
+    nan_tills : numpy.ndarray
+        Positions of the last missing value of each region
 
     Returns
     ----------
     col : pandas.DataFrame
-        The column with the treated nan_block
+        The column with the treated regions
 
     '''
-    to_fill = slice(nan_block['start_idx'] - one_period,
-                    nan_block['till_idx'] + one_period)
-
-    col.iloc[:, 0].loc[to_fill] = col.iloc[:, 0].loc[to_fill].interpolate()
+    if len(nan_starts) == 0:
+        return col
+    
+    values = col.iloc[:, 0].values.copy()
+    valid = np.flatnonzero(~np.isnan(values))
+    to_fill = np.flatnonzero(_regions_mask(len(values), nan_starts, nan_tills))
+    
+    values[to_fill] = np.interp(to_fill, valid, values[valid])
+    col[col.columns[0]] = values
 
     return col
 
 
-def _impute_by_day(i, nan_block, col, col_name, one_period, days):
+def _impute_by_day(i, nan_block, index, values, nan_count, offsets, col_name, one_period, days, first=None):
     '''
     Impute missing value spans longer than one hour based on prior data.
     
+    To not shift all following values for each imputed span, the counter offsets 
+    are only collected as a step function of positions and their cumulative offset 
+    and need to be added to the values, after all spans were treated.
+    
     Parameters
     ----------
     i : int
@@ -297,75 +933,231 @@ def _impute_by_day(i, nan_block, col, col_name, one_period, days):
         span:
         start_idx:
         till_idx:
+    index : pandas.DatetimeIndex
+        Index of the column
+    values : numpy.ndarray
+        Values of the column, without the collected offsets.
+        Will be modified in place
+    nan_count : numpy.ndarray
+        Number of missing values before each position, before any span was imputed
+    offsets : tuple
+        Sorted lists of positions and the offset of all values from this position on.
+        Will be extended with the offsets of the treated nan_block
+    first : int, default None
+        First timestamp of the whole column in nanoseconds, if index is only a part of it
     See _interpolate() for info on other parameters.
 
     Returns
     ----------
-    col : pandas.DataFrame
-        The column with the treated nan_block
+    lookback : int or None
+        Earliest timestamp of prior data in nanoseconds, that was probed to impute the span
     '''
-    start = nan_block['start_idx']
-    till = nan_block['till_idx']
-    if (till - start).days > days:
-        till = start + timedelta(days=days) - one_period
+    times = index.asi8
+    if first is None:
+        first = times[0]
+    
+    lookback = None
+    one_day = pd.Timedelta(days=1).value
+    one_period = pd.Timedelta(one_period).value
     
-    while till <= nan_block['till_idx']:
+    block_start = nan_block['start_idx'].value
+    block_till = nan_block['till_idx'].value
     
+    start = block_start
+    till = block_till
+    if (till - start)//one_day > days:
+        till = start + days*one_day - one_period
+    
+    while till <= block_till:
+        
         days_offset = days
-        while col.iloc[:, 0].loc[start:till].isnull().values.any():
-            if start-timedelta(days=days_offset) < col.iloc[:, 0].index[0]:
+        fill_start = np.searchsorted(times, start, side='left')
+        fill_end = np.searchsorted(times, till, side='right')
+        while np.isnan(values[fill_start:fill_end]).any():
+            if start - days_offset*one_day < first:
                 if days > 1:
                     logger.debug("Problem filling %i. gap in %s %s for %i prior days. Attempting with %i prior days.", 
                                 i+1, col_name[1], col_name[4], days, days-1) 
-                                #start-timedelta(days=days_offset), 
-                                #till-timedelta(days=days_offset))
                     days -= 1
                     days_offset = days
-                    if (till - start).days > days:
-                        till = start + timedelta(days=days) - one_period
+                    if (till - start)//one_day > days:
+                        till = start + days*one_day - one_period
+                        fill_end = np.searchsorted(times, till, side='right')
                     
                     continue
                 
                 break
             
-            elif till-timedelta(days=days_offset) > nan_block['start_idx']:
+            elif till - days_offset*one_day > block_start:
                 days_offset += days
                 continue
             
-            #logger.debug("Filling %i. gap in %s %s with data from %s to %s", i+1, col_name[1], col_name[4],
-            #             start-timedelta(days=days_offset), till-timedelta(days=days_offset))
-            
-            col_fill = col.iloc[:, 0].loc[start - timedelta(days=days_offset) - one_period:
-                                          till - timedelta(days=days_offset) + one_period]
+            prior_time = start - days_offset*one_day - one_period
+            lookback = prior_time if lookback is None else min(lookback, prior_time)
             
-            if col_fill.isnull().values.any():
+            prior_start = np.searchsorted(times, prior_time, side='left')
+            prior_end = np.searchsorted(times, till - days_offset*one_day + one_period, side='right')
+            if nan_count[prior_end] > nan_count[prior_start] and \
+                    np.isnan(values[prior_start:prior_end]).any():
                 logger.debug("Problem filling %i. gap in %s %s with data from %s to %s", i+1, col_name[1], col_name[4],
-                            col_fill.index[0], col_fill.index[-1])
+                            index[prior_start], index[prior_end-1])
                 days_offset += days
                 continue
             
-            col_fill = col_fill - col_fill.iloc[0] + col.iloc[:, 0].loc[start-one_period]
-            col_fill.index += timedelta(days=days_offset)
-            col_delta = col_fill.iloc[-1] - col.iloc[:, 0].loc[nan_block['till_idx']+one_period]
+            prior_values = values[prior_start:prior_end] + _offsets_at(offsets, np.arange(prior_start, prior_end))
+            prior_values = prior_values - prior_values[0] + _value_at(index, values, offsets, start - one_period)
+            prior_delta = prior_values[-1] - _value_at(index, values, offsets, block_till + one_period)
+            
+            # Align the prior values by their shifted timestamps, as gaps in the index may differ
+            prior_times = times[fill_start:fill_end] - days_offset*one_day
+            prior_pos = np.searchsorted(times, prior_times, side='left')
+            prior_pos = np.minimum(prior_pos, len(times)-1)
+            prior_valid = (times[prior_pos] == prior_times) & (prior_pos >= prior_start) & (prior_pos < prior_end)
+            
+            fill_values = np.full(fill_end - fill_start, np.NaN)
+            fill_values[prior_valid] = prior_values[prior_pos[prior_valid] - prior_start]
             
-            col.iloc[:, 0].loc[start:till] = col_fill
-            col.iloc[:, 0].loc[till+one_period:] += col_delta
+            values[fill_start:fill_end] = fill_values - _offsets_at(offsets, np.arange(fill_start, fill_end))
+            
+            offset_start = np.searchsorted(times, till + one_period, side='left')
+            offset_pos = bisect.bisect_right(offsets[0], offset_start)
+            offsets[0].insert(offset_pos, offset_start)
+            offsets[1].insert(offset_pos, prior_delta)
             
             days_offset += days
         
-        if till == nan_block['till_idx']:
+        if till == block_till:
             break;
         
-        start += timedelta(days=days)
-        till += timedelta(days=days)
-        if till > nan_block['till_idx']:
-            till = nan_block['till_idx']
+        start += days*one_day
+        till += days*one_day
+        if till > block_till:
+            till = block_till
     
-    if col.iloc[:, 0].loc[nan_block['start_idx']:nan_block['till_idx']].isnull().values.any():
+    block_start = np.searchsorted(times, block_start, side='left')
+    block_end = np.searchsorted(times, block_till, side='right')
+    if np.isnan(values[block_start:block_end]).any():
         logger.warn("Unable to fill %i. gap in %s %s from %s to %s", i+1, col_name[1], col_name[4], 
                     nan_block['start_idx'], nan_block['till_idx'])
     
-    return col
+    return lookback
+
+
+def _offsets_at(offsets, positions):
+    offsets_pos = np.searchsorted(offsets[0], positions, side='right')
+    return np.concatenate(([0], np.cumsum(offsets[1])))[offsets_pos]
+
+
+def _value_at(index, values, offsets, time):
+    pos = index.get_loc(pd.Timestamp(time, tz=index.tz))
+    return values[pos] + _offsets_at(offsets, pos)
+
+
+def get_marker_feeds(columns, household):
+    '''
+    Get the feed columns of a household, which the bits of its marker column refer to.
+    The lowest bit of a marker marks the first feed column in sorted order.
+
+    Parameters
+    ----------
+    columns : pandas.MultiIndex
+        Columns of the DataFrame, containing the feeds of the household
+    household : str
+        Household to get the marked feed columns for
+
+    Returns
+    ----------
+    feeds : pandas.MultiIndex
+        Sorted feed columns of the household
+
+    '''
+    feeds = columns[(columns.get_level_values('household') == household) & 
+                    (columns.get_level_values(0) != 'interpolated')]
+    
+    return feeds.sort_values()
+
+
+def expand_markers(df):
+    '''
+    Expand the marker bitmasks of all households into a single marker column,
+    listing the names of all interpolated feeds separated by ' | '.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame with a marker column for each household
+
+    Returns
+    ----------
+    df : pandas.DataFrame
+        DataFrame with the marker columns replaced by a single column of strings
+
+    '''
+    markers = get_marker_columns(df)
+    if len(markers) == 0:
+        return df
+    
+    marker_names = get_marker_names(df)
+    
+    marker_pos = df.columns.get_loc(markers[0])
+    df = df.drop(columns=markers)
+    df.insert(marker_pos, ('interpolated',) + ('',)*(df.columns.nlevels-1), marker_names)
+    
+    return df
+
+
+def get_marker_columns(df):
+    '''
+    Get the marker bitmask columns of all households of a DataFrame.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame with a marker column for each household
+
+    Returns
+    ----------
+    markers : pandas.MultiIndex
+        Columns of the marker bitmasks, without already expanded marker columns
+
+    '''
+    return df.columns[(df.columns.get_level_values(0) == 'interpolated') & 
+                      np.array([is_unsigned_integer_dtype(dtype) for dtype in df.dtypes], dtype=bool)]
+
+
+def get_marker_names(df):
+    '''
+    Get the names of the interpolated feeds of all households for each row, 
+    separated by ' | ', as the expanded marker column.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame with a marker column for each household
+
+    Returns
+    ----------
+    marker_names : pandas.Series
+        Names of the interpolated feeds of each row, or NaN if none were interpolated
+
+    '''
+    marker_names = pd.Series(np.NaN, index=df.index, dtype=object)
+    for marker in get_marker_columns(df):
+        household = marker[df.columns.names.index('household')]
+        feeds = [dict(zip(df.columns.names, feed)) for feed in get_marker_feeds(df.columns, household)]
+        feeds = [feed['region'] + '_' + feed['household'].replace(' ', '').lower() + '_' + feed['feed'] 
+                 for feed in feeds]
+        
+        # Only a few distinct combinations of interpolated feeds exist, that need to be joined
+        masks, masks_inverse = np.unique(df[marker].values.astype(np.uint64), return_inverse=True)
+        masks_names = np.array([' | '.join(feed for bit, feed in enumerate(feeds) if int(mask) >> bit & 1) or np.NaN
+                                for mask in masks], dtype=object)
+        
+        names = pd.Series(masks_names[masks_inverse], index=df.index)
+        marker_names = marker_names.where(names.isnull(), 
+                                          (marker_names + ' | ' + names).fillna(names))
+    
+    return marker_names
 
 
 def resample_markers(group):
@@ -379,21 +1171,9 @@ def resample_markers(group):
 
     Returns
     ----------
-    aggregated_marker : str or np.nan
-        If there were any markers in group: the unique values from the marker
-        column group joined together in one string, np.nan otherwise
+    aggregated_marker : numpy.uint64
+        The bitwise OR of all markers in group, marking each feed that was 
+        interpolated in any of its values
 
     '''
-
-    if group.notnull().values.any():
-        # unpack string of marker s into a list
-        unpacked = [mark for line in group if type(line) is str
-                    for mark in line.split(' | ')]  # [:-1]]
-        # keep only unique values from the list
-        aggregated_marker = ' | '.join(set(unpacked))  # + ' | '
-
-    else:
-        aggregated_marker = np.NaN
-
-    return aggregated_marker
-
+    return np.bitwise_or.reduce(group.values.astype(np.uint64))
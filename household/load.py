@@ -0,0 +1,328 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+load.py : load selected feeds and time ranges of the published data sets.
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import io
+import re
+import sqlite3
+import zipfile
+import numpy as np
+import pandas as pd
+
+INFO_COLS = {'utc': 'utc_timestamp',
+             'cet': 'cet_cest_timestamp',
+             'marker': 'interpolated'}
+
+TIMEZONES = {'UTC': 'UTC',
+             'CET': 'Europe/Berlin'}
+
+SOURCES = ['parquet', 'sqlite', 'csv']
+
+
+def load(resolution, households=None, feeds=None, start=None, end=None, timezone='UTC',
+         path='.', source=None):
+    '''
+    Load the feeds of households in a time range of a published data set.
+
+    Only the selected columns and rows are read, from the first available source of:
+    the Parquet partitions of each household and year, the keyed table of the
+    SQLite database or the SingleIndex CSV file. To read a time range of the CSV file,
+    the byte offsets of its timestamps are indexed once and stored next to the file.
+
+    Parameters
+    ----------
+    resolution : str
+        Resolution of the data set, e.g. '1min', '15min' or '60min'
+    households : list of str, default None
+        Households to load, e.g. ['residential1', 'industrial3']. If None,
+        all households will be loaded
+    feeds : list of str, default None
+        Feeds to load, e.g. ['grid_import', 'pv']. If None, all feeds will be loaded
+    start : str or datetime, default None
+        Start of the time range, inclusive. Timestamps without time zone are
+        interpreted in the given timezone
+    end : str or datetime, default None
+        End of the time range, exclusive. Timestamps without time zone are
+        interpreted in the given timezone
+    timezone : str, default 'UTC'
+        Time zone of the time range and index of the loaded data, 'UTC' or 'CET'
+    path : str, default '.'
+        Directory path of the published data set
+    source : str, default None
+        Source to load the data from, 'parquet', 'sqlite' or 'csv'. If None,
+        the first available source will be used
+
+    Returns
+    ----------
+    data : pandas.DataFrame
+        DataFrame with the selected feeds as SingleIndex columns,
+        e.g. DE_KN_residential1_grid_import
+
+    '''
+    if timezone not in TIMEZONES:
+        raise ValueError('Unknown timezone: {}'.format(timezone))
+
+    start = _localize(start, TIMEZONES[timezone])
+    end = _localize(end, TIMEZONES[timezone])
+
+    if source is None:
+        source = next((s for s in SOURCES if os.path.exists(_source_path(path, resolution, s))), None)
+        if source is None:
+            raise FileNotFoundError('Unable to find data set of {} resolution in {}'.format(resolution, path))
+
+    elif source not in SOURCES:
+        raise ValueError('Unknown source: {}'.format(source))
+
+    if source == 'parquet':
+        data = _load_parquet(path, resolution, households, feeds, start, end)
+    elif source == 'sqlite':
+        data = _load_sqlite(path, resolution, households, feeds, start, end)
+    else:
+        data = _load_csv(path, resolution, households, feeds, start, end)
+
+    logger.debug('Loaded %i rows of %i feeds from %s', len(data.index), len(data.columns), source)
+
+    if timezone != 'UTC':
+        data.index = data.index.tz_convert(TIMEZONES[timezone])
+        data.index.name = INFO_COLS['cet']
+
+    return data
+
+
+def _localize(time, timezone):
+    if time is None:
+        return None
+
+    time = pd.Timestamp(time)
+    if time.tzinfo is None:
+        time = time.tz_localize(timezone)
+
+    return time.tz_convert('UTC')
+
+
+def _source_path(path, resolution, source):
+    if source == 'parquet':
+        return os.path.join(path, 'household_data_parquet', 'resolution=' + resolution)
+    elif source == 'sqlite':
+        return os.path.join(path, 'household_data.sqlite')
+    else:
+        return os.path.join(path, 'household_data_{}_singleindex.csv'.format(resolution))
+
+
+def _select_columns(columns, households, feeds):
+    # SingleIndex columns are composed of the region, household and feed, e.g. DE_KN_residential1_grid_import
+    selected = []
+    for column in columns:
+        match = re.match(r'^(.+?)_([a-z]+\d+)_(.+)$', column)
+        if match is None:
+            continue
+
+        _, household, feed = match.groups()
+        if (households is None or household in households) and (feeds is None or feed in feeds):
+            selected.append(column)
+
+    return selected
+
+
+def _select_rows(data, start, end):
+    if start is not None:
+        data = data[data.index >= start]
+    if end is not None:
+        data = data[data.index < end]
+
+    return data
+
+
+def _load_parquet(path, resolution, households, feeds, start, end):
+    import pyarrow.parquet as pq
+
+    res_path = _source_path(path, resolution, 'parquet')
+
+    data = []
+    for household_dir in sorted(os.listdir(res_path)):
+        household = household_dir.split('=', 1)[1]
+        if households is not None and household not in households:
+            continue
+
+        household_data = []
+        for year_dir in sorted(os.listdir(os.path.join(res_path, household_dir))):
+            year = int(year_dir.split('=', 1)[1])
+            if (start is not None and year < start.year) or (end is not None and year > end.year):
+                continue
+
+            year_file = os.path.join(res_path, household_dir, year_dir, 'part-0.parquet')
+            columns = _select_columns(pq.read_schema(year_file).names, households, feeds)
+            if len(columns) == 0:
+                continue
+
+            year_data = pq.read_table(year_file, columns=[INFO_COLS['utc']] + columns).to_pandas()
+            year_data = year_data.set_index(INFO_COLS['utc'])
+            household_data.append(_select_rows(year_data, start, end))
+
+        if len(household_data) > 0:
+            data.append(pd.concat(household_data, axis=0))
+
+    return _concat(data)
+
+
+def _load_sqlite(path, resolution, households, feeds, start, end):
+    table = 'household_data_{}_singleindex'.format(resolution)
+
+    connection = sqlite3.connect(_source_path(path, resolution, 'sqlite'))
+    try:
+        columns = [c[1] for c in connection.execute('PRAGMA table_info("{}")'.format(table))]
+        columns = _select_columns(columns, households, feeds)
+
+        # Timestamps are stored as ISO-8601 strings, that can be compared lexicographically
+        query = 'SELECT {} FROM "{}"'.format(', '.join('"{}"'.format(c) for c in [INFO_COLS['utc']] + columns), table)
+        where = []
+        params = []
+        if start is not None:
+            where.append('"{}" >= ?'.format(INFO_COLS['utc']))
+            params.append(start.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        if end is not None:
+            where.append('"{}" < ?'.format(INFO_COLS['utc']))
+            params.append(end.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        if len(where) > 0:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY "{}"'.format(INFO_COLS['utc'])
+
+        data = pd.read_sql_query(query, connection, params=params, index_col=INFO_COLS['utc'])
+
+    finally:
+        connection.close()
+
+    data.index = pd.to_datetime(data.index, format='%Y-%m-%dT%H:%M:%SZ', utc=True)
+
+    return data.astype(float)
+
+
+def _load_csv(path, resolution, households, feeds, start, end):
+    csv_file = _source_path(path, resolution, 'csv')
+
+    with open(csv_file, 'rb') as f:
+        header = f.readline().decode('utf-8').rstrip('\r\n').split(',')
+    columns = _select_columns(header, households, feeds)
+
+    offsets, times = index_csv(csv_file)
+
+    # Read from the last indexed line before the start, until the first indexed line after the end
+    offset_start = 0
+    offset_end = len(times)
+    if start is not None:
+        offset_start = max(np.searchsorted(times, start.strftime('%Y-%m-%dT%H:%M:%SZ').encode('utf-8'), 'right') - 1, 0)
+    if end is not None:
+        offset_end = np.searchsorted(times, end.strftime('%Y-%m-%dT%H:%M:%SZ').encode('utf-8'), 'left')
+
+    with open(csv_file, 'rb') as f:
+        f.seek(offsets[offset_start])
+        buffer = f.read(max(offsets[offset_end] - offsets[offset_start], 0))
+
+    if len(buffer) == 0:
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], tz='UTC', name=INFO_COLS['utc']), dtype=float)
+
+    data = pd.read_csv(io.BytesIO(buffer), header=None, names=header,
+                       usecols=[INFO_COLS['utc']] + columns, index_col=INFO_COLS['utc'],
+                       dtype={c: float for c in columns})
+    data = data[columns]
+    data.index = pd.to_datetime(data.index, format='%Y-%m-%dT%H:%M:%SZ', utc=True)
+
+    return _select_rows(data, start, end)
+
+
+def index_csv(csv_file, step=1440, blocksize=2**26):
+    '''
+    Index the byte offsets of the timestamps of every step-th line of a CSV file.
+
+    The index is stored in a .idx.npz file next to the CSV file and
+    will be renewed, if the size or modification time of the file changes.
+    It is replaced atomically, so that interrupted or concurrent runs never
+    leave a truncated index behind.
+
+    Parameters
+    ----------
+    csv_file : str
+        Path to the CSV file, starting with a header line and
+        the sorted timestamps in the first column
+    step : int, default 1440
+        Number of lines between two indexed lines
+    blocksize : int
+        Number of bytes to scan at once
+
+    Returns
+    ----------
+    offsets : numpy.ndarray
+        Byte offsets of the indexed lines, followed by the size of the file
+    times : numpy.ndarray
+        Timestamps of the indexed lines as bytes
+
+    '''
+    stat = os.stat(csv_file)
+    fingerprint = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    index_file = csv_file + '.idx.npz'
+    try:
+        with np.load(index_file) as index:
+            if np.array_equal(index['fingerprint'], fingerprint) and index['step'] == step:
+                return index['offsets'], index['times']
+
+    except (IOError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+
+    offsets = []
+    with open(csv_file, 'rb') as f:
+        header = f.readline()
+
+        line = 0
+        line_start = True
+        block_offset = len(header)
+        block = f.read(blocksize)
+        while len(block) > 0:
+            # Lines start after each line break within the block
+            lines_start = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n')) + 1
+            lines_start = lines_start[lines_start < len(block)]
+            if line_start:
+                lines_start = np.concatenate(([0], lines_start))
+            line_start = block.endswith(b'\n')
+
+            lines_indexed = lines_start[(line + np.arange(len(lines_start))) % step == 0]
+            offsets.extend((block_offset + lines_indexed).tolist())
+
+            line += len(lines_start)
+            block_offset += len(block)
+            block = f.read(blocksize)
+
+        times = []
+        for offset in offsets:
+            f.seek(offset)
+            times.append(f.readline().split(b',', 1)[0])
+
+    offsets = np.array(offsets + [stat.st_size], dtype=np.int64)
+    times = np.array(times, dtype='S')
+    try:
+        # Write the index to a temporary file first, to never leave a truncated index behind
+        index_temp = index_file + '.' + str(os.getpid()) + '.tmp'
+        with open(index_temp, 'wb') as f:
+            np.savez(f, offsets=offsets, times=times, fingerprint=fingerprint, step=step)
+
+        os.replace(index_temp, index_file)
+
+    except IOError:
+        logger.warning('Unable to store index of %s', csv_file)
+
+    return offsets, times
+
+
+def _concat(data):
+    if len(data) == 0:
+        return pd.DataFrame(index=pd.DatetimeIndex([], tz='UTC', name=INFO_COLS['utc']))
+
+    return pd.concat(data, axis=1, join='outer').sort_index()
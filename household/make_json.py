@@ -97,6 +97,19 @@ resource_template = '''
         format: csv
 '''
 
+parquet_template = '''
+- path: household_data_parquet/resolution={res_key}
+  format: parquet
+  mediatype: application/vnd.apache.parquet
+  description: {res_key} data partitioned by household and year, with one file at
+      household={{household}}/year={{year}}/part-0.parquet for each partition.
+      Columns are named like the fields of the {res_key} schema, while the marker
+      column holds a bitmask of the interpolated feeds of the household.
+  partitioning:
+      - household
+      - year
+'''
+
 schemas_template = '''
 {res_key}:
     primaryKey: {utc}
@@ -181,7 +194,7 @@ default: Energy in {unit}
 # as this makes for  more readable code.
 
 
-def make_json(data_sets, info_cols, version, changes, headers):
+def make_json(data_sets, info_cols, version, changes, headers, parquet=False):
     '''
     Create a datapackage.json file that complies with the Frictionless
     data JSON Table Schema from the information in the column-MultiIndex.
@@ -201,6 +214,9 @@ def make_json(data_sets, info_cols, version, changes, headers):
     headers : list
         List of strings indicating the level names of the pandas.MultiIndex
         for the columns of the dataframe.
+    parquet : boolean, default False
+        Flag, if the partitioned Parquet files of each dataset are listed
+        as additional resources
 
     Returns
     ----------
@@ -223,6 +239,9 @@ def make_json(data_sets, info_cols, version, changes, headers):
         # Both datasets (15min and 60min) get an antry in the resource list
         resource_list = resource_list + resource_template.format(
             res_key=res_key)
+        if parquet:
+            resource_list = resource_list + parquet_template.format(
+                res_key=res_key)
 
         # Create the list of of columns in a file, starting with the index
         # field
@@ -0,0 +1,236 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+profiling.py : opt-in profiles of selected processing stages, households and feeds
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import sys
+import threading
+
+from contextlib import contextmanager
+
+MODES = ['deterministic', 'sampling']
+
+# Environment variables to enable the profiling without changing any code
+ENV_STAGES = 'HOUSEHOLD_PROFILE'
+ENV_HOUSEHOLDS = 'HOUSEHOLD_PROFILE_HOUSEHOLDS'
+ENV_FEEDS = 'HOUSEHOLD_PROFILE_FEEDS'
+ENV_MODE = 'HOUSEHOLD_PROFILE_MODE'
+ENV_INTERVAL = 'HOUSEHOLD_PROFILE_INTERVAL'
+ENV_DIR = 'HOUSEHOLD_PROFILE_DIR'
+
+
+class Profiler(object):
+    '''
+    Opt-in profiler of selected stages, households and feeds.
+
+    Deterministic profiles are recorded with cProfile and saved as .pstats files,
+    to be inspected with pstats or e.g. snakeviz. Sampling profiles record the
+    stack of the profiled thread in a fixed interval with less overhead and are
+    saved as collapsed stacks, to be rendered as flame graphs. Profiles are named
+    by their stage, household and feed, e.g. fill_nan_industrial3.pstats or
+    validate_residential1_pv.collapsed, and replace profiles of previous runs.
+
+    Blocks of whole households and blocks of single feeds are exclusive, as profiles
+    can not be nested: if feeds are selected, only their blocks are profiled, otherwise
+    the blocks of households and of stages processing all households, e.g. resample.
+
+    Parameters
+    ----------
+    stages : list of str, default None
+        Stages to profile, e.g. ['fill_nan']. If None, all stages will be profiled
+    households : list of str, default None
+        Ids of the households to profile, e.g. ['industrial3']. If None,
+        all households and stages processing all households will be profiled
+    feeds : list of str or boolean, default None
+        Feeds to profile, e.g. ['pv']. If True, all feeds will be profiled
+        and if None, the households as a whole
+    mode : str, default 'deterministic'
+        Mode of the profiler, 'deterministic' or 'sampling'
+    interval : float, default 0.001
+        Interval in seconds between two samples of the sampling profiler
+    path : str, default 'profiles'
+        Directory path in which the profiles are stored
+
+    '''
+    def __init__(self, stages=None, households=None, feeds=None, mode='deterministic', interval=0.001,
+                 path='profiles'):
+        if mode not in MODES:
+            raise ValueError('Unknown profiling mode: {}'.format(mode))
+
+        self.stages = stages
+        self.households = households
+        self.feeds = feeds
+        self.mode = mode
+        self.interval = interval
+        self.path = path
+        self._active = False
+
+    @classmethod
+    def from_env(cls):
+        '''
+        Create a profiler from the environment variables, if HOUSEHOLD_PROFILE is set.
+
+        HOUSEHOLD_PROFILE is a comma separated list of the stages to profile, or 'all'.
+        HOUSEHOLD_PROFILE_HOUSEHOLDS and HOUSEHOLD_PROFILE_FEEDS optionally select the
+        households and feeds, where '*' selects all feeds. HOUSEHOLD_PROFILE_MODE,
+        HOUSEHOLD_PROFILE_INTERVAL and HOUSEHOLD_PROFILE_DIR configure the mode,
+        sampling interval and directory of the profiles.
+
+        Returns
+        ----------
+        profiler : household.profiling.Profiler or None
+            Profiler as configured by the environment, or None if profiling is disabled
+
+        '''
+        stages = _split(os.environ.get(ENV_STAGES))
+        if stages is None:
+            return None
+        if stages == ['all']:
+            stages = None
+
+        feeds = _split(os.environ.get(ENV_FEEDS))
+        if feeds == ['*']:
+            feeds = True
+
+        return cls(stages=stages,
+                   households=_split(os.environ.get(ENV_HOUSEHOLDS)),
+                   feeds=feeds,
+                   mode=os.environ.get(ENV_MODE, 'deterministic'),
+                   interval=float(os.environ.get(ENV_INTERVAL, 0.001)),
+                   path=os.environ.get(ENV_DIR, 'profiles'))
+
+    def selects(self, stage, household=None, feed=None):
+        '''
+        Check if a block of a stage, household and feed is selected to be profiled.
+
+        Returns
+        ----------
+        selected : boolean
+            True, if the block will be profiled
+
+        '''
+        if self.stages is not None and stage not in self.stages:
+            return False
+
+        if self.households is not None and household not in self.households:
+            return False
+
+        if feed is None:
+            return self.feeds is None
+
+        return self.feeds is True or self.feeds is not None and feed in self.feeds
+
+    @contextmanager
+    def profile(self, stage, household=None, feed=None, **values):
+        '''
+        Profile a block, if it is selected and no other profile is active.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, e.g. 'read' or 'fill_nan'
+        household : str, default None
+            Id of the profiled household
+        feed : str, default None
+            Name of the profiled feed
+        values :
+            Further values of the block, of which the resolution and format
+            are added to the name of the profile
+
+        '''
+        if self._active or not self.selects(stage, household, feed):
+            yield
+            return
+
+        name = [stage, household, feed] + [values.get(k) for k in ['resolution', 'format']]
+        name = '_'.join(re.sub(r'[^\w\-]+', '-', str(n)) for n in name if n is not None)
+
+        self._active = True
+        try:
+            if self.mode == 'sampling':
+                with self._sample(name):
+                    yield
+            else:
+                with self._trace(name):
+                    yield
+        finally:
+            self._active = False
+
+    def run(self, stage, household, feed, func, *args, **kwargs):
+        '''
+        Call a function and profile it, if the stage, household and feed are selected,
+        e.g. to profile tasks in a worker process.
+
+        Returns
+        ----------
+        result :
+            Result of the function
+
+        '''
+        with self.profile(stage, household, feed):
+            return func(*args, **kwargs)
+
+    @contextmanager
+    def _trace(self, name):
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+            profile_file = self._file(name, '.pstats')
+            profile.dump_stats(profile_file)
+            logger.debug('Saved profile %s', profile_file)
+
+    @contextmanager
+    def _sample(self, name):
+        samples = {}
+        thread_id = threading.get_ident()
+        sampling = threading.Event()
+
+        def sample():
+            while not sampling.wait(self.interval):
+                frame = sys._current_frames().get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append('{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+
+                stack = ';'.join(reversed(stack))
+                samples[stack] = samples.get(stack, 0) + 1
+
+        sampler = threading.Thread(target=sample, name='household-profiler', daemon=True)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampling.set()
+            sampler.join()
+
+            profile_file = self._file(name, '.collapsed')
+            with open(profile_file, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(samples.items()):
+                    f.write('{} {}\n'.format(stack, count))
+            logger.debug('Saved profile %s of %i samples', profile_file, sum(samples.values()))
+
+    def _file(self, name, extension):
+        os.makedirs(self.path, exist_ok=True)
+        return os.path.join(self.path, name + extension)
+
+
+def _split(value):
+    if value is None or value.strip() == '':
+        return None
+
+    return [v.strip() for v in value.split(',') if v.strip() != '']
@@ -11,15 +11,35 @@ logger = logging.getLogger(__name__)
 
 import os
 import pytz
+import hashlib
+import shutil
+import zipfile
+import numpy as np
 import pandas as pd
 
-from struct import unpack
 from datetime import datetime, time
-from .tools import update_progress
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .tools import assemble
+from .cache import FeedCache
+from .telemetry import Telemetry, measure, add
+
+# Layout of a single 9 byte MyISAM record of the phptimeseries feeds:
+# a flag byte, followed by the little-endian unix timestamp and value
+MYD_DTYPE = np.dtype([('flag', 'u1'), ('timestamp', '<u4'), ('value', '<f4')])
+
+# First valid unix timestamp, as values of the year 1970 are considered invalid
+MYD_EPOCH = 31536000
+
+# Number of records, summarized by a single entry of the sparse feed index
+INDEX_BLOCK_SIZE = 4096
+
+# Directory of the sparse feed indexes, next to the entries of the default feed cache
+INDEX_DIR = os.path.join('feed_cache', 'index')
 
 
 def read(household_name, household_dir, household_region, household_type, feeds, headers, 
-         start_from_user=None, end_from_user=None):
+         start_from_user=None, end_from_user=None, workers=None, cache=True, source='original_data',
+         lean=False, telemetry=None):
     """
     For the households specified in the households.yml file, read 
 
@@ -41,7 +61,18 @@ def read(household_name, household_dir, household_region, household_type, feeds,
     start_from_user : datetime.date, default None
         Start of period for which to read the data
     end_from_user : datetime.date, default None
-        End of period for which to read the data
+        End of period for which to read the data.
+        Both boundaries are pushed down to the reading of each feed, to only
+        map the necessary byte range of the files
+    workers : int, default None
+        Number of processes to read the feeds in parallel.
+        If None or 1, all feeds will be read sequentially
+    cache : household.cache.FeedCache or boolean, default True
+        Persistent cache of decoded feeds to use. If True, the default cache
+        location will be used, if False, all feeds will be decoded
+    source : str, default 'original_data'
+        Directory of the original data, or the path to the original_data.zip 
+        archive, to read the feeds directly from without extracting it
 
     Returns
     ----------
@@ -49,59 +80,440 @@ def read(household_name, household_dir, household_region, household_type, feeds,
         A DataFrame containing the combined data for household 
 
     """
-    data_set = pd.DataFrame()
-    columns_map = {}
+    household = {
+        'id': household_name.replace(' ', '').lower(),
+        'name': household_name,
+        'dir': household_dir,
+        'region': household_region,
+        'type': household_type,
+        'series': feeds
+    }
+    data_sets = read_households([household], headers, 
+                                start_from_user=start_from_user, 
+                                end_from_user=end_from_user, 
+                                workers=workers,
+                                cache=cache,
+                                source=source,
+                                lean=lean,
+                                telemetry=telemetry)
 
-    household_id = household_name.replace(' ', '').lower()
-    feeds_dir = os.path.join('original_data', household_dir, 'phptimeseries')
+    return data_sets[household['id']]
 
-    logger.info('Reading %s series', household_name)
 
-    feeds_existing = len(feeds)
-    feeds_success = 0
+def read_households(households, headers, start_from_user=None, end_from_user=None, 
+                    workers=None, cache=True, source='original_data', lean=False, telemetry=None):
+    """
+    Read the feeds of several households, as configured in the households.yml file.
+    All feeds of all households are read as independent tasks, optionally fanned
+    out over a pool of processes.
+
+    Parameters
+    ----------
+    households : list of dict
+        Configuration dictionaries of the households to read
+    headers : list
+        List of strings indicating the level names of the pandas.MultiIndex
+        for the columns of the dataframe
+    start_from_user : datetime.date, default None
+        Start of period for which to read the data
+    end_from_user : datetime.date, default None
+        End of period for which to read the data
+    workers : int, default None
+        Number of processes to read the feeds in parallel.
+        If None or 1, all feeds will be read sequentially
+    cache : household.cache.FeedCache or boolean, default True
+        Persistent cache of decoded feeds to use. If True, the default cache
+        location will be used, if False, all feeds will be decoded
+    source : str, default 'original_data'
+        Directory of the original data, or the path to the original_data.zip 
+        archive, to read the feeds directly from without extracting it
+    lean : boolean, default False
+        Flag, if the values will be kept as float32, as stored in the feeds.
+        All following stages keep the float32 values of a feed, as long as 
+        their magnitude allows to keep the published decimals. The output of
+        the lean mode is not identical to the published files
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the reading of each feed and household. The rows in 
+        of a feed are the records of its file, of which invalid and duplicate records, 
+        as well as records outside the selected period are dropped
+
+    Returns
+    ----------
+    data_sets: dict of pandas.DataFrame
+        A DataFrame containing the combined data for each household id
+
+    """
+    start_from_user, end_from_user = _convert_period(start_from_user, end_from_user)
+
+    if cache is True:
+        cache = FeedCache()
+    elif cache is False:
+        cache = None
+
+    if telemetry is None:
+        telemetry = Telemetry()
+
+    archive = _read_archive_info(source)
+
+    feeds_tasks = []
+    for household in households:
+        logger.info('Reading %s series', household['name'])
+        feeds_tasks += _feeds_tasks(household, source, archive)
+
+    feeds_data, feeds_records = _read_feeds(feeds_tasks, start_from_user, end_from_user, workers, cache, lean, 
+                                            telemetry)
+
+    data_sets = {}
+    for household in households:
+        household_id = household.get('id', household['name'].replace(' ', '').lower())
+        household_records = [r for r in feeds_records if r['household'] == household_id]
+        
+        # The household is measured by the time of its feeds, that may have been read in parallel
+        with telemetry.measure('read', household=household_id, 
+                               rows_in=sum(r['rows_out'] for r in household_records)) as record:
+            data_sets[household_id] = _combine_feeds(household, feeds_data, headers)
+            
+            for feed_record in household_records:
+                add(record, feed_record)
+            record['rows_out'] = len(data_sets[household_id].index)
+
+    return data_sets
+
+
+def read_fingerprint(household, source='original_data'):
+    """
+    Fingerprint the source files of all feeds of a household, to recognize 
+    changes of the original data without reading it.
+
+    Parameters
+    ----------
+    household : dict
+        Configuration of the household, as in the households.yml file
+    source : str, default 'original_data'
+        Directory of the original data, or the path to the original_data.zip 
+        archive
+
+    Returns
+    ----------
+    fingerprint: list
+        Sizes and modification times, or CRC-32 checksums of archive members,
+        of each feeds source file
+
+    """
+    archive = _read_archive_info(source)
+
+    fingerprint = []
+    for feed_name, feed_dict in household['series'].items():
+        feed_file = 'feed_'+str(feed_dict['id'])+'.MYD'
+        if archive is not None:
+            member = '/'.join(['original_data', household['dir'], 'phptimeseries', feed_file])
+            if member in archive:
+                fingerprint.append([feed_name, archive[member].file_size, archive[member].CRC])
+                continue
+        else:
+            filepath = os.path.join(source, household['dir'], 'phptimeseries', feed_file)
+            if os.path.isfile(filepath):
+                stat = os.stat(filepath)
+                fingerprint.append([feed_name, stat.st_size, stat.st_mtime_ns])
+                continue
+
+        fingerprint.append([feed_name, None, None])
+
+    return fingerprint
+
+
+def open_feeds(household, source='original_data', start_from_user=None, end_from_user=None, path=None):
+    """
+    Open the feeds of a household, to be read in time windows without decoding
+    them as a whole. Feeds of a zip archive are extracted to a directory first,
+    to be memory-mapped like the files of the original data directory.
+
+    Parameters
+    ----------
+    household : dict
+        Configuration of the household, as in the households.yml file
+    source : str, default 'original_data'
+        Directory of the original data, or the path to the original_data.zip 
+        archive
+    start_from_user : datetime.date, default None
+        Start of period for which to read the data
+    end_from_user : datetime.date, default None
+        End of period for which to read the data
+    path : str, default None
+        Directory to extract the feeds of an archive to. 
+        Required, if the source is a zip archive
+
+    Returns
+    ----------
+    feeds: dict of household.read.FeedReader
+        Readers of the existing feeds of the household by their names
+
+    """
+    start_from_user, end_from_user = _convert_period(start_from_user, end_from_user)
+
+    archive = _read_archive_info(source)
+
+    feeds = {}
+    for _, feed_name, filepath, member, _ in _feeds_tasks(household, source, archive):
+        index_dir = INDEX_DIR
+        if member is not None:
+            # Keep the indexes of extracted feeds with them, as they will be removed together
+            filepath = _extract_feed(filepath, member, path)
+            index_dir = path
+
+        feeds[feed_name] = FeedReader(filepath, feed_name, start=start_from_user, end=end_from_user, 
+                                      index_dir=index_dir)
+
+    return feeds
+
+
+class FeedReader(object):
+    """
+    Reader of the records of a single feed in time windows, to process the feed
+    in parts. Only the byte range of the records of a window will be decoded, 
+    as located by the sparse sidecar index of the feeds file.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the feeds .MYD file
+    name : str
+        Name of the feed
+    start : datetime.datetime, default None
+        Timezone aware start of the period for which to read the data
+    end : datetime.datetime, default None
+        Timezone aware end of the period for which to read the data
+    index_dir : str, default 'feed_cache/index'
+        Directory of the sparse feed indexes
+
+    """
+    def __init__(self, filepath, name, start=None, end=None, index_dir=INDEX_DIR):
+        self.filepath = filepath
+        self.name = name
+
+        # First and last valid timestamp of the feed in nanoseconds, limited to the period
+        feed_index = read_index(filepath, index_dir=index_dir)
+        blocks = feed_index['lower'] <= feed_index['upper']
+        if blocks.any():
+            self.start = int(feed_index['lower'][blocks].min())*10**9
+            self.end = int(feed_index['upper'][blocks].max())*10**9
+        else:
+            self.start = 0
+            self.end = -1
+
+        if start is not None:
+            self.start = max(self.start, -(-pd.Timestamp(start).value//10**9)*10**9)
+        if end is not None:
+            self.end = min(self.end, pd.Timestamp(end).value//10**9*10**9)
+
+    def read(self, start, end):
+        """
+        Read the valid records of a time window, in the order of their timestamps.
+
+        Parameters
+        ----------
+        start : int
+            First timestamp of the window in nanoseconds since the epoch
+        end : int
+            Last timestamp of the window in nanoseconds since the epoch, inclusive
+
+        Returns
+        ----------
+        times: numpy.ndarray
+            Timestamps of the records in nanoseconds since the epoch
+        values: numpy.ndarray
+            Values of the records
+
+        """
+        start = max(start, self.start)
+        end = min(end, self.end)
+        if start > end:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        feed = read_feed(self.filepath, self.name, start=pd.Timestamp(start, tz='UTC'), 
+                         end=pd.Timestamp(end, tz='UTC'))
+        times = feed.index.asi8
+        values = feed.values[:,0]
+
+        valid = ~np.isnan(values)
+        times, values = times[valid], values[valid]
+        if np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='stable')
+            times, values = times[order], values[order]
+
+        return times, values
+
+
+def _convert_period(start_from_user, end_from_user):
+    # Convert userinput to UTC time to conform with the feeds index
+    if start_from_user:
+        start_from_user = (
+            pytz.timezone('Europe/Berlin')
+            .localize(datetime.combine(start_from_user, time()))
+            .astimezone(pytz.timezone('UTC')))
+
+    if end_from_user:
+        end_from_user = (
+            pytz.timezone('Europe/Berlin')
+            .localize(datetime.combine(end_from_user, time()))
+            .astimezone(pytz.timezone('UTC')))
+
+    return start_from_user, end_from_user
+
+
+def _extract_feed(archive, member, path):
+    filepath = os.path.join(path, *member.split('/'))
+    if not os.path.isdir(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+
+    with zipfile.ZipFile(archive) as archive_file:
+        with archive_file.open(member) as member_file, open(filepath, 'wb') as f:
+            shutil.copyfileobj(member_file, f, 1024*1024)
+
+    return filepath
+
+
+def _read_archive_info(source):
+    if os.path.isfile(source) and zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive_file:
+            return {info.filename: info for info in archive_file.infolist()}
+
+    return None
+
+
+def _feeds_tasks(household, source, archive=None):
+    tasks = []
+    if archive is not None:
+        # Members of the archive are stored relative to the original_data directory
+        feeds_dir = '/'.join(['original_data', household['dir'], 'phptimeseries'])
+        feeds_exist = any(name.startswith(feeds_dir + '/') for name in archive)
+    else:
+        feeds_dir = os.path.join(source, household['dir'], 'phptimeseries')
+        feeds_exist = os.path.exists(feeds_dir)
 
     # Check if there is a feeds folder for household_dir
-    if not os.path.exists(feeds_dir):
+    if not feeds_exist:
         logger.warning('Feeds directory not found for %s',
-                       household_dir)
-        return data_set
-
-    # For each specified feed, read the MySQL file
-    for feed_name, feed_dict in feeds.items():
-        feed_id = feed_dict['id']
-        feed_unit = feed_dict['unit']
+                       household['dir'])
+        return tasks
 
-        filepath = os.path.join(feeds_dir, 'feed_'+str(feed_id)+'.MYD')
+    # For each specified feed, locate the MySQL file
+    for feed_name, feed_dict in household['series'].items():
+        feed_file = 'feed_'+str(feed_dict['id'])+'.MYD'
+        if archive is not None:
+            filepath = source
+            member = feeds_dir + '/' + feed_file
+            filesize = archive[member].file_size if member in archive else 0
+        else:
+            filepath = os.path.join(feeds_dir, feed_file)
+            member = None
+            filesize = os.path.getsize(filepath)
 
         # Check if file is not empty
-        if os.path.getsize(filepath) < 128:
+        if filesize < 128:
             logger.warning('%s \n file is smaller than 128 Byte. It is probably'
                            ' empty and will thus be skipped from reading',
-                           filepath)
+                           member or filepath)
+        else:
+            tasks.append((household, feed_name, filepath, member, filesize))
+
+    return tasks
+
+
+def _read_feeds(tasks, start, end, workers, cache, lean, telemetry):
+    feeds_data = {}
+    feeds_records = []
+    feeds_existing = len(tasks)
+    feeds_success = 0
+
+    def record_feed(task, feed_data, feed_values):
+        household, feed_name, _, _, filesize = task
+        household_id = household.get('id', household['name'].replace(' ', '').lower())
+        feed_records = filesize//MYD_DTYPE.itemsize
+        
+        feeds_data[(household['name'], feed_name)] = feed_data
+        feeds_records.append(telemetry.record('read', household=household_id, feed=feed_name, 
+                                              rows_in=feed_records, 
+                                              rows_out=len(feed_data.index), 
+                                              rows_dropped=feed_records - len(feed_data.index), 
+                                              **feed_values))
+
+    def read_task(task):
+        household, feed_name, filepath, member, _ = task
+        household_id = household.get('id', household['name'].replace(' ', '').lower())
+        return telemetry.profiled(_read_task, 'read', household_id, feed_name), \
+            filepath, member, feed_name, start, end, cache, lean
+
+    if workers is None or workers <= 1:
+        for task in tasks:
+            record_feed(task, *measure(*read_task(task)))
+            feeds_success += 1
+            telemetry.progress('read', feeds_success, feeds_existing)
+
+        return feeds_data, feeds_records
+
+    # Every task opens its own handle of files or archives, which allows 
+    # stored as well as compressed archive members to be read concurrently
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(measure, *read_task(task)) for task in tasks]
+
+        for _ in as_completed(futures):
+            feeds_success += 1
+            telemetry.progress('read', feeds_success, feeds_existing)
+
+        # Collect the results in the order of the tasks, to keep the assembly deterministic
+        for task, future in zip(tasks, futures):
+            record_feed(task, *future.result())
+
+    return feeds_data, feeds_records
+
+
+def _read_task(filepath, member, feed_name, start, end, cache, lean):
+    if member is not None:
+        feed = read_archive_feed(filepath, member, feed_name, start=start, end=end, cache=cache)
+    else:
+        feed = read_feed(filepath, feed_name, start=start, end=end, cache=cache)
+
+    # Values of the feeds are stored as float32 and can be converted back without any loss
+    if lean:
+        feed = feed.astype(np.float32)
+
+    return feed
+
+
+def _combine_feeds(household, feeds_data, headers):
+    feeds_frames = []
+    columns_map = {}
+
+    household_name = household['name']
+    household_id = household.get('id', household_name.replace(' ', '').lower())
+
+    for feed_name, feed_dict in household['series'].items():
+        if (household_name, feed_name) not in feeds_data:
+            continue
+
+        data_to_add = feeds_data[(household_name, feed_name)]
+
+        columns_map[feed_name] = {
+            'region': household['region'],
+            'household': household_id,
+            'type': household['type'],
+            'unit': feed_dict['unit'],
+            'feed': feed_name
+        }
+
+        feeds_frames.append(data_to_add)
+        
+        if data_to_add.empty:
+            logger.debug('No data of series %s for %s in the selected period',
+                         household_name, feed_name)
         else:
-            data_to_add = read_feed(filepath, feed_name)
-
-            columns_map[feed_name] = {
-                'region': household_region,
-                'household': household_id,
-                'type': household_type,
-                'unit': feed_unit,
-                'feed': feed_name
-            }
-
-            if data_set.empty:
-                data_set = data_to_add
-            else:
-                data_set = data_set.combine_first(data_to_add)
-            
             logger.debug('Read data series %s for %s from %s to %s',
                          household_name, feed_name,
                          data_to_add.index[0].strftime('%d.%m.%Y %H:%M'),
                          data_to_add.index[-1].strftime('%d.%m.%Y %H:%M'))
-            
-            feeds_success += 1
-            update_progress(feeds_success, feeds_existing)
 
+    data_set = assemble(feeds_frames)
     if data_set.empty:
         logger.warning('Returned empty DataFrame for %s', household_name)
         return data_set
@@ -111,48 +523,276 @@ def read(household_name, household_dir, household_region, household_type, feeds,
               for col in data_set.columns]
     data_set.columns = pd.MultiIndex.from_tuples(tuples, names=headers)
 
-    # Cut off the data outside of [start_from_user:end_from_user]
-    # First, convert userinput to UTC time to conform with data_set.index
-    if start_from_user:
-        start_from_user = (
-            pytz.timezone('Europe/Berlin')
-            .localize(datetime.combine(start_from_user, time()))
-            .astimezone(pytz.timezone('UTC')))
-        data_set = data_set.loc[data_set.index >= start_from_user]
+    return data_set
+
+
+def read_feed(filepath, name, start=None, end=None, index=True, cache=None):
+    """
+    Read a phptimeseries MyISAM data file into a DataFrame.
+
+    The file is memory-mapped and decoded into a structured NumPy array, with
+    invalid and duplicate timestamps being removed as array masks.
+    If a period is specified, only the byte range of the file containing
+    records of this period will be decoded.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the feeds .MYD file
+    name : str
+        Name of the feed to be used as column name
+    start : datetime.datetime, default None
+        Timezone aware start of the period for which to read the data
+    end : datetime.datetime, default None
+        Timezone aware end of the period for which to read the data
+    index : boolean, default True
+        Flag, if a sparse sidecar index of the timestamps should be used and
+        created if necessary, to locate the byte range of the period
+    cache : household.cache.FeedCache, default None
+        Persistent cache of decoded feeds. Completely read feeds will be added 
+        to the cache, while the period of cached feeds will be selected from it
+
+    Returns
+    ----------
+    feed: pandas.DataFrame
+        A DataFrame containing the decoded series of the feed
+
+    """
+    # Convert the boundaries to unix timestamps, including only full seconds
+    if start is not None:
+        start = -(-pd.Timestamp(start).value//10**9)
+    if end is not None:
+        end = pd.Timestamp(end).value//10**9
+    
+    if cache is not None:
+        times, values = cache.get(filepath)
+        if times is not None:
+            return _select_feed(times, values, name, start, end)
+    
+    records = _map_feed(filepath)
+    if start is None and end is None:
+        feed = _decode_feed(records, name)
+        if cache is not None:
+            cache.put(filepath, feed.index.asi8, feed.values[:,0])
         
-    if end_from_user:
-        end_from_user = (
-            pytz.timezone('Europe/Berlin')
-            .localize(datetime.combine(end_from_user, time()))
-            .astimezone(pytz.timezone('UTC')))
-        data_set = data_set.loc[data_set.index <= end_from_user]
+        return feed
+    
+    if index and len(records) > 0:
+        feed_index = read_index(filepath, records, 
+                                index_dir=os.path.join(cache.cache_dir, 'index') if cache is not None else INDEX_DIR)
+        records = records[_index_range(feed_index, start, end)]
+    
+    return _decode_feed(records, name, start, end)
 
-    return data_set
 
+def read_archive_feed(archive, member, name, start=None, end=None, cache=None):
+    """
+    Read a phptimeseries MyISAM data file from a zip archive into a DataFrame.
 
-def read_feed(filepath, name):
-    times = []
-    data = []
-    with open(filepath, 'rb') as file:
-        line = file.read(9)
-        while line:
-            line_tuple = unpack("<xIf", line)
-            
-            timestamp = int(line_tuple[0])
-            if timestamp > 0:
-                times.append(datetime.utcfromtimestamp(timestamp))                                
-                value = float(line_tuple[1])
-                data.append(value)
-            
-            line = file.read(9)
+    The member is streamed from the archive directly into a structured NumPy 
+    array and decoded, without extracting it to disk.
+
+    Parameters
+    ----------
+    archive : str
+        Path to the zip archive
+    member : str
+        Name of the feeds .MYD file in the archive
+    name : str
+        Name of the feed to be used as column name
+    start : datetime.datetime, default None
+        Timezone aware start of the period for which to read the data
+    end : datetime.datetime, default None
+        Timezone aware end of the period for which to read the data
+    cache : household.cache.FeedCache, default None
+        Persistent cache of decoded feeds. Completely read feeds will be added 
+        to the cache, while the period of cached feeds will be selected from it
+
+    Returns
+    ----------
+    feed: pandas.DataFrame
+        A DataFrame containing the decoded series of the feed
+
+    """
+    if start is not None:
+        start = -(-pd.Timestamp(start).value//10**9)
+    if end is not None:
+        end = pd.Timestamp(end).value//10**9
     
-    feed = pd.DataFrame(data=data, index=times, columns=[name])
-    feed.index = feed.index.tz_localize(pytz.utc)
-    feed.index.name = 'timestamp'
-    feed = feed.loc[feed.index.year > 1970]
+    if cache is not None:
+        times, values = cache.get(archive, member=member)
+        if times is not None:
+            return _select_feed(times, values, name, start, end)
     
-    # Drop rows with duplicate index, as this produces problems with reindexing
-    feed = feed[~feed.index.duplicated(keep='last')]
+    with zipfile.ZipFile(archive) as archive_file:
+        count = archive_file.getinfo(member).file_size//MYD_DTYPE.itemsize
+        records = np.empty(count, dtype=MYD_DTYPE)
+        
+        buffer = memoryview(records.view(np.uint8))
+        with archive_file.open(member) as member_file:
+            offset = 0
+            while offset < len(buffer):
+                length = member_file.readinto(buffer[offset:])
+                if not length:
+                    break
+                offset += length
+        
+        records = records[:offset//MYD_DTYPE.itemsize]
+    
+    feed = _decode_feed(records, name)
+    if cache is not None:
+        cache.put(archive, feed.index.asi8, feed.values[:,0], member=member)
+    
+    if start is not None or end is not None:
+        feed = _select_feed(feed.index.asi8, feed.values[:,0], name, start, end)
     
     return feed
 
+
+def read_index(filepath, records=None, index_dir=INDEX_DIR):
+    """
+    Read the sparse sidecar index of a feeds .MYD file, or build it if it does not 
+    exist or is outdated. The index holds the lowest and highest valid timestamp
+    for every block of INDEX_BLOCK_SIZE records.
+
+    Indexes are stored in a separate directory, to never write to the original 
+    data, addressed by the hash of the files path, size and modification time, 
+    like the references of the feed cache. If the index can not be written, e.g. 
+    to a read-only directory, it is built again for every read.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the feeds .MYD file
+    records : numpy.ndarray, default None
+        Memory-mapped records of the feed, to be used if the index needs to be built
+    index_dir : str, default 'feed_cache/index'
+        Directory of the sparse feed indexes
+
+    Returns
+    ----------
+    feed_index: dict of numpy.ndarray
+        Lower and upper timestamp boundaries of all record blocks
+
+    """
+    stat = os.stat(filepath)
+    fingerprint = '{}:{}:{}'.format(os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+    index_file = os.path.join(index_dir, hashlib.sha256(fingerprint.encode('utf-8')).hexdigest() + '.npz')
+    try:
+        with np.load(index_file) as index_data:
+            feed_index = dict(index_data)
+        
+        if feed_index['size'] == stat.st_size and \
+                feed_index['mtime'] == stat.st_mtime_ns and \
+                feed_index['block'] == INDEX_BLOCK_SIZE:
+            return feed_index
+        
+    except (IOError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+    
+    if records is None:
+        records = _map_feed(filepath)
+    
+    feed_index = _build_index(records)
+    feed_index.update(size=stat.st_size, mtime=stat.st_mtime_ns, block=INDEX_BLOCK_SIZE)
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        
+        index_temp = index_file + '.' + str(os.getpid()) + '.tmp'
+        with open(index_temp, 'wb') as f:
+            np.savez(f, **feed_index)
+        
+        os.replace(index_temp, index_file)
+        
+    except IOError:
+        logger.debug('Unable to write sidecar index %s', index_file)
+    
+    return feed_index
+
+
+def _build_index(records):
+    timestamps = records['timestamp']
+    valid = timestamps >= MYD_EPOCH
+    blocks = np.arange(0, len(timestamps), INDEX_BLOCK_SIZE)
+    
+    # Blocks without any valid record will get empty boundaries with lower > upper
+    lower = np.minimum.reduceat(np.where(valid, timestamps, np.iinfo(np.uint32).max), blocks)
+    upper = np.maximum.reduceat(np.where(valid, timestamps, 0), blocks)
+    
+    return {'lower': lower, 'upper': upper}
+
+
+def _index_range(feed_index, start, end):
+    overlap = feed_index['lower'] <= feed_index['upper']
+    if start is not None:
+        overlap &= feed_index['upper'] >= start
+    if end is not None:
+        overlap &= feed_index['lower'] <= end
+    
+    blocks = np.flatnonzero(overlap)
+    if len(blocks) == 0:
+        return slice(0, 0)
+    
+    return slice(blocks[0]*INDEX_BLOCK_SIZE, (blocks[-1] + 1)*INDEX_BLOCK_SIZE)
+
+
+def _map_feed(filepath):
+    count = os.path.getsize(filepath)//MYD_DTYPE.itemsize
+    if count == 0:
+        return np.empty(0, dtype=MYD_DTYPE)
+    
+    return np.memmap(filepath, dtype=MYD_DTYPE, mode='r', shape=(count,))
+
+
+def _decode_feed(records, name, start=None, end=None):
+    timestamps = np.asarray(records['timestamp'])
+    
+    # Drop records before 1971, including empty records with a timestamp of 0
+    valid = timestamps >= MYD_EPOCH
+    if start is not None:
+        valid &= timestamps >= start
+    if end is not None:
+        valid &= timestamps <= end
+    
+    # Drop rows with duplicate index, as this produces problems with reindexing
+    valid[_duplicated(timestamps, valid)] = False
+    
+    times = timestamps[valid].astype(np.int64)*10**9
+    values = np.asarray(records['value'])[valid].astype(np.float64)
+    
+    return _feed_frame(times, values, name)
+
+
+def _select_feed(times, values, name, start=None, end=None):
+    if start is None and end is None:
+        return _feed_frame(times, values, name)
+    
+    valid = np.ones(len(times), dtype=bool)
+    if start is not None:
+        valid &= times >= start*10**9
+    if end is not None:
+        valid &= times <= end*10**9
+    
+    return _feed_frame(times[valid], values[valid], name)
+
+
+def _feed_frame(times, values, name):
+    index = pd.DatetimeIndex(times.view('datetime64[ns]'), name='timestamp').tz_localize(pytz.utc)
+    
+    return pd.DataFrame(data=values, index=index, columns=[name])
+
+def _duplicated(timestamps, valid):
+    """
+    Mark all but the last occurrence of each timestamp, considering only the
+    positions that are flagged as valid.
+    """
+    positions = np.flatnonzero(valid)
+    
+    # Find the last position of each unique timestamp, by searching the reversed array
+    _, last = np.unique(timestamps[positions][::-1], return_index=True)
+    
+    duplicated = np.ones(len(timestamps), dtype=bool)
+    duplicated[positions[len(positions) - 1 - last]] = False
+    duplicated[~valid] = False
+    
+    return duplicated
@@ -0,0 +1,122 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+resampling.py : resample the household data to several resolutions.
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pandas as pd
+
+from pandas.api.types import is_unsigned_integer_dtype
+from .telemetry import Telemetry
+
+
+def resample(data, resolutions, telemetry=None):
+    '''
+    Resample the data to several resolutions in one pass over its bins.
+
+    Each value of a resampled row is the last valid value within its interval,
+    equivalent to data.resample(resolution).last(), while marker columns are
+    reduced with a bitwise OR, to mark all feeds interpolated within the interval.
+    Intervals are aligned to midnight of the first day and resolutions are
+    aggregated from the coarsest finer resolution they are a multiple of,
+    so each additional resolution only reduces already resampled rows.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        DataFrame with the data to resample, e.g. the 1-minute data of all households
+    resolutions : list of str
+        Resolutions to resample the data to, e.g. ['15min', '60min', '1D']
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the resampling of each resolution, 
+        from the rows of the resolution it was aggregated from
+
+    Returns
+    ----------
+    data_sets : dict of pandas.DataFrame
+        Resampled DataFrames with their resolutions as keys
+
+    '''
+    data_sets = {}
+    if data.empty:
+        return data_sets
+
+    if telemetry is None:
+        telemetry = Telemetry()
+
+    origin = data.index[0].normalize().value
+    times = data.index.asi8
+
+    markers = [is_unsigned_integer_dtype(dtype) for dtype in data.dtypes]
+    columns = [data.iloc[:, i].values for i in range(len(data.columns))]
+
+    bins = {}
+    for resolution in sorted(resolutions, key=lambda r: pd.Timedelta(r)):
+        with telemetry.measure('resample', resolution=resolution) as record:
+            period = pd.Timedelta(resolution).value
+
+            # Reduce the coarsest resampled resolution that fits into the bins of this one
+            source = max((r for r in bins if period % pd.Timedelta(r).value == 0),
+                         key=lambda r: pd.Timedelta(r), default=None)
+            if source is not None:
+                source_times, source_columns = bins[source]
+            else:
+                source_times, source_columns = times, columns
+
+            bins_pos = (source_times - origin)//period
+            bins_start = np.flatnonzero(np.diff(bins_pos, prepend=bins_pos[0]-1))
+            bins_times = origin + np.arange(bins_pos[0], bins_pos[-1]+1)*period
+            bins_rows = bins_pos[bins_start] - bins_pos[0]
+
+            bins_columns = []
+            for column, marker in zip(source_columns, markers):
+                if marker:
+                    values = np.zeros(len(bins_times), dtype=column.dtype)
+                    values[bins_rows] = np.bitwise_or.reduceat(column, bins_start)
+                else:
+                    values = _resample_last(column, bins_start, bins_rows, len(bins_times))
+
+                bins_columns.append(values)
+
+            bins[resolution] = (bins_times, bins_columns)
+            logger.debug('Resampled %i rows to %i rows of %s resolution', len(source_times), len(bins_times), resolution)
+
+            record['rows_in'] = len(source_times)
+            record['rows_out'] = len(bins_times)
+
+    for resolution in resolutions:
+        bins_times, bins_columns = bins[resolution]
+        index = pd.DatetimeIndex(bins_times.view('datetime64[ns]'), name=data.index.name)
+        if data.index.tz is not None:
+            index = index.tz_localize('UTC').tz_convert(data.index.tz)
+        index.freq = resolution
+
+        resampled = pd.DataFrame(dict(enumerate(bins_columns)), index=index)
+        resampled.columns = data.columns
+
+        data_sets[resolution] = resampled
+
+    return data_sets
+
+
+def _resample_last(column, bins_start, bins_rows, bins_count):
+    # Find the position of the last valid value in each bin
+    valid = pd.notnull(column)
+    valid_pos = np.where(valid, np.arange(len(column)), -1)
+    valid_last = np.maximum.reduceat(valid_pos, bins_start)
+
+    if column.dtype.kind == 'f':
+        values = np.full(bins_count, np.NaN, dtype=column.dtype)
+    else:
+        values = np.full(bins_count, np.NaN, dtype=object)
+
+    values_valid = valid_last >= 0
+    values[bins_rows[values_valid]] = column[valid_last[values_valid]]
+
+    return values
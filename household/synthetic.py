@@ -0,0 +1,151 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+synthetic.py : generate synthetic feeds, to process without the original data
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import numpy as np
+import pandas as pd
+
+from .read import MYD_DTYPE
+
+FEEDS = ['grid_import', 'grid_export', 'pv', 'heat_pump', 'ev', 'storage_charge', 'storage_discharge',
+         'dishwasher', 'washing_machine', 'refrigerator', 'freezer', 'circulation_pump', 'ventilation']
+
+
+def write_feed(filepath, start='2015-01-01', days=30, interval=30, jitter=10, power=1.,
+               outages=4, resets=1, dips=10, invalid=5, seed=None):
+    '''
+    Write a synthetic energy feed to a .MYD file of the phptimeseries format.
+
+    The energy counter accumulates a power with a daily profile and random noise,
+    sampled with a jittered interval. Optionally, the feed contains outages without
+    any samples, resets of the counter to zero, short dips of the counter and
+    invalid records with timestamps of the year 1970.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the .MYD file to write
+    start : str or datetime, default '2015-01-01'
+        Start of the feed in UTC
+    days : int, default 30
+        Length of the feed in days
+    interval : float, default 30
+        Mean interval between two samples in seconds
+    jitter : float, default 10
+        Standard deviation of the sampling interval in seconds
+    power : float, default 1.
+        Mean power of the feed in kW
+    outages : int, default 4
+        Number of outages, lasting from a few minutes to several days
+    resets : int, default 1
+        Number of counter resets
+    dips : int, default 10
+        Number of short dips of the counter
+    invalid : int, default 5
+        Number of invalid records
+    seed : int, default None
+        Seed of the random number generator
+
+    Returns
+    ----------
+    count : int
+        Number of written records
+
+    '''
+    rng = np.random.default_rng(seed)
+    start = int(pd.Timestamp(start, tz='UTC').timestamp())
+
+    count = int(days*86400/interval)
+    intervals = np.maximum(rng.normal(interval, jitter, count), 1).round().astype(np.int64)
+    for outage in rng.integers(0, count, outages):
+        intervals[outage] += int(rng.choice([600, 3600, 6*3600, 86400, 3*86400]))
+
+    times = start + np.cumsum(intervals)
+    times = times[times < start + days*86400]
+    count = len(times)
+
+    # Power with a daily profile, that is accumulated to the energy counter in kWh
+    hours = (times % 86400)/3600.
+    profile = np.maximum(np.sin((hours - 6)/12*np.pi), 0)
+    powers = power*np.maximum(profile + rng.normal(0, .2, count), 0)
+    energy = np.cumsum(powers*np.diff(times, prepend=times[0])/3600.)
+
+    for reset in np.sort(rng.integers(1, max(count, 2), resets)):
+        energy[reset:] -= energy[reset]
+
+    values = energy.astype(np.float32)
+    for dip in rng.integers(3, max(count-5, 4), dips):
+        values[dip:dip+rng.integers(1, 5)] *= .99
+
+    records = np.zeros(count, dtype=MYD_DTYPE)
+    records['timestamp'] = times
+    records['value'] = values
+    records['timestamp'][rng.integers(0, max(count, 1), invalid if count > 0 else 0)] = 0
+
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    records.tofile(filepath)
+
+    return count
+
+
+def write_households(source, households=1, feeds=3, start='2015-01-01', days=30, seed=None, **kwargs):
+    '''
+    Write the feeds of several synthetic households to a directory,
+    laid out like the original data.
+
+    Parameters
+    ----------
+    source : str
+        Directory of the original data to write
+    households : int, default 1
+        Number of households
+    feeds : int, default 3
+        Number of feeds of each household
+    start : str or datetime, default '2015-01-01'
+        Start of the feeds in UTC
+    days : int, default 30
+        Length of the feeds in days
+    seed : int, default None
+        Seed of the random number generator
+    kwargs :
+        Further parameters of the feeds, see write_feed()
+
+    Returns
+    ----------
+    households : list of dict
+        Configuration dictionaries of the households, as read from the households.yml file
+
+    '''
+    rng = np.random.default_rng(seed)
+
+    configs = []
+    for h in range(households):
+        household = {
+            'id': 'residential{}'.format(h+1),
+            'name': 'Residential {}'.format(h+1),
+            'dir': 'DE_KN_residential_{:03d}'.format(h+1),
+            'region': 'DE_KN',
+            'type': 'residential_building_suburb',
+            'series': {}
+        }
+        for f in range(feeds):
+            feed_id = h*feeds + f + 1
+            feed_name = FEEDS[f % len(FEEDS)] + ('' if f < len(FEEDS) else '_' + str(f//len(FEEDS) + 1))
+            household['series'][feed_name] = {'id': feed_id, 'unit': 'kWh'}
+
+            feed_file = os.path.join(source, household['dir'], 'phptimeseries', 'feed_{}.MYD'.format(feed_id))
+            write_feed(feed_file, start=start, days=days, power=rng.uniform(.1, 5.),
+                       seed=int(rng.integers(2**31)), **kwargs)
+
+        configs.append(household)
+        logger.debug('Wrote %i synthetic feeds of %s', feeds, household['name'])
+
+    return configs
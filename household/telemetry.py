@@ -0,0 +1,365 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+telemetry.py : timing, memory and row count records of the processing stages
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import sys
+import time
+import json
+
+from datetime import datetime, timezone
+from functools import partial
+from contextlib import contextmanager
+from .profiling import Profiler
+
+# Keys of every record, followed by optional keys of specific stages, e.g. the resolution
+RECORD_KEYS = ['stage', 'household', 'feed', 'wall_time', 'cpu_time', 'peak_rss', 'peak_rss_growth',
+               'rows_in', 'rows_out', 'rows_dropped', 'rows_imputed']
+
+
+class Telemetry(object):
+    '''
+    Collection of records, measuring the processing stages of households and their feeds.
+
+    Each record contains the stage, household and feed, its wall time and CPU time
+    in seconds, the peak resident set size of the process in bytes and the number
+    of rows in and out, as well as the rows dropped or imputed by the stage.
+    The peak resident set size is the high-water mark of the whole process, which 
+    never decreases, so it can not be attributed to a stage run after a larger one. 
+    The growth of the peak during a stage is recorded as well, which is only 
+    positive, if the stage needed more memory than any stage of its process before.
+    Records of whole households have no feed and their rows dropped or imputed are
+    the sum of their feeds, while records of all households, e.g. of the resampling,
+    have neither household nor feed. Every record and the progress of each stage
+    is passed to the configured sinks. Without any sink, the records are only collected.
+    Optionally, selected stages, households and feeds are profiled while they are measured.
+
+    Parameters
+    ----------
+    sinks : list of household.telemetry.Sink, default None
+        Sinks to pass every record and the progress of each stage to
+    context : dict, default None
+        Additional values of every record, e.g. the version of the data set
+    profiler : household.profiling.Profiler, default None
+        Profiler of selected stages, households and feeds. If None, a profiler
+        will only be created if enabled by the HOUSEHOLD_PROFILE environment variable
+
+    '''
+    def __init__(self, sinks=None, context=None, profiler=None):
+        self.sinks = sinks if sinks is not None else []
+        self.context = context if context is not None else {}
+        self.profiler = profiler if profiler is not None else Profiler.from_env()
+        self.records = []
+
+    @contextmanager
+    def measure(self, stage, household=None, feed=None, **values):
+        '''
+        Measure the wall time, CPU time and peak memory of a block.
+
+        The yielded record may be updated within the block, e.g. with the rows out,
+        and is recorded after the block finished. Measurements of tasks executed
+        in other processes, e.g. of single feeds, may be added to it with add().
+        If the block is selected by the profiler, it is profiled as well.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, e.g. 'read' or 'fill_nan'
+        household : str, default None
+            Id of the measured household
+        feed : str, default None
+            Name of the measured feed
+        values :
+            Further values of the record, e.g. rows_in=1000
+
+        '''
+        record = _record(stage, household, feed, **values)
+        record['wall_time'] = 0.
+        record['cpu_time'] = 0.
+
+        peak_rss = get_peak_rss()
+        wall_time = time.perf_counter()
+        cpu_time = time.process_time()
+        if self.profiler is not None:
+            with self.profiler.profile(stage, household, feed, **values):
+                yield record
+        else:
+            yield record
+
+        record['wall_time'] += time.perf_counter() - wall_time
+        record['cpu_time'] += time.process_time() - cpu_time
+        peak_rss_end = get_peak_rss()
+        record['peak_rss'] = _max(record['peak_rss'], peak_rss_end)
+        if peak_rss is not None and peak_rss_end is not None:
+            record['peak_rss_growth'] = _max(record['peak_rss_growth'], peak_rss_end - peak_rss)
+
+        self.record(**record)
+
+    def profiled(self, func, stage, household=None, feed=None):
+        '''
+        Wrap a function to be profiled, if the stage, household and feed are selected,
+        e.g. to profile tasks executed in other processes.
+
+        Returns
+        ----------
+        func : callable
+            The function itself, or a picklable wrapper profiling it
+
+        '''
+        if self.profiler is None or not self.profiler.selects(stage, household, feed):
+            return func
+
+        return partial(self.profiler.run, stage, household, feed, func)
+
+    def record(self, stage, household=None, feed=None, **values):
+        '''
+        Record the values of a stage and pass them to all sinks.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, e.g. 'read' or 'fill_nan'
+        household : str, default None
+            Id of the household
+        feed : str, default None
+            Name of the feed
+        values :
+            Values of the record, e.g. wall_time=1.5 or rows_out=1000
+
+        Returns
+        ----------
+        record : dict
+            The recorded values
+
+        '''
+        record = _record(stage, household, feed, **values)
+        record.update(self.context)
+        record['time'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        self.records.append(record)
+        for sink in self.sinks:
+            sink.emit(record)
+
+        return record
+
+    def progress(self, stage, count, total):
+        '''
+        Pass the progress of a stage to all sinks.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, e.g. 'read' or 'fill_nan'
+        count : int
+            Number of feeds processed so far
+        total : int
+            Total number of feeds
+
+        '''
+        for sink in self.sinks:
+            sink.progress(stage, count, total)
+
+    def write(self, path):
+        '''
+        Write all collected records to a JSON lines file.
+
+        Parameters
+        ----------
+        path : str
+            Path to the file to write, with one JSON object per line
+
+        '''
+        with open(path, 'w', encoding='utf-8') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+
+    def to_frame(self):
+        '''
+        Return all collected records as a DataFrame.
+
+        Returns
+        ----------
+        records : pandas.DataFrame
+            DataFrame with a row for each record
+
+        '''
+        import pandas as pd
+
+        return pd.DataFrame(self.records, columns=RECORD_KEYS +
+                            [k for k in dict.fromkeys(k for r in self.records for k in r) if k not in RECORD_KEYS])
+
+
+class Sink(object):
+    '''
+    Sink of telemetry records, which ignores all of them.
+    Subclasses may override emit() and progress() to handle records and the progress.
+
+    '''
+    def emit(self, record):
+        pass
+
+    def progress(self, stage, count, total):
+        pass
+
+
+class LogSink(Sink):
+    '''
+    Sink, logging a summary of each record.
+
+    Parameters
+    ----------
+    level : int, default logging.DEBUG
+        Level of the logged messages
+    households : boolean, default True
+        Flag, if records of households will be logged
+    feeds : boolean, default False
+        Flag, if records of single feeds will be logged
+
+    '''
+    def __init__(self, level=logging.DEBUG, households=True, feeds=False):
+        self.level = level
+        self.households = households
+        self.feeds = feeds
+
+    def emit(self, record):
+        if record['feed'] is not None and not self.feeds or \
+                record['feed'] is None and record['household'] is not None and not self.households:
+            return
+
+        name = ' '.join(str(record[k]) for k in ['household', 'feed'] if record[k] is not None)
+        logger.log(self.level, '%s %s: %.2fs wall, %.2fs cpu, %s MB peak (+%s MB), %s rows in, %s rows out, '
+                               '%s dropped, %s imputed', record['stage'], name or 'all',
+                   record['wall_time'] or 0, record['cpu_time'] or 0,
+                   *['{:.1f}'.format(record[k]/1024**2) if record.get(k) is not None else '-'
+                     for k in ['peak_rss', 'peak_rss_growth']],
+                   *[record[k] if record[k] is not None else '-'
+                     for k in ['rows_in', 'rows_out', 'rows_dropped', 'rows_imputed']])
+
+
+class ProgressSink(Sink):
+    '''
+    Sink, displaying a console progress bar of each stage.
+
+    Parameters
+    ----------
+    stream : file, default sys.stdout
+        Stream to write the progress bar to
+    length : int, default 50
+        Number of characters of the progress bar
+
+    '''
+    def __init__(self, stream=None, length=50):
+        self.stream = stream
+        self.length = length
+
+    def progress(self, stage, count, total):
+        stream = self.stream if self.stream is not None else sys.stdout
+        progress = min(count/total, 1.) if total > 0 else 1.
+        status = "Done...\r\n" if progress >= 1 else ""
+        block = int(round(self.length*progress))
+        stream.write("{0:<16} [{1}] {2}/{3} feeds {4}\r".format(
+            stage.replace('_', ' ').capitalize(), "#"*block + "-"*(self.length - block), count, total, status))
+        stream.flush()
+
+
+class JsonLinesSink(Sink):
+    '''
+    Sink, appending each record as a line of JSON to a file, e.g. to track
+    the stages across several runs and versions of the data set.
+
+    Parameters
+    ----------
+    path : str, default 'telemetry.jsonl'
+        Path to the file to append the records to
+
+    '''
+    def __init__(self, path='telemetry.jsonl'):
+        self.path = path
+
+    def emit(self, record):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def measure(func, *args, **kwargs):
+    '''
+    Call a function and measure its wall time, CPU time and the peak memory of the process,
+    e.g. to measure tasks in a worker process, which can be recorded by the parent.
+
+    Parameters
+    ----------
+    func : callable
+        Function to call with the passed arguments
+
+    Returns
+    ----------
+    result :
+        Result of the function
+    values : dict
+        Wall time, CPU time, peak resident set size and its growth during the call
+
+    '''
+    peak_rss = get_peak_rss()
+    wall_time = time.perf_counter()
+    cpu_time = time.process_time()
+    result = func(*args, **kwargs)
+
+    values = {
+        'wall_time': time.perf_counter() - wall_time,
+        'cpu_time': time.process_time() - cpu_time,
+        'peak_rss': get_peak_rss()
+    }
+    if peak_rss is not None:
+        values['peak_rss_growth'] = values['peak_rss'] - peak_rss
+
+    return result, values
+
+
+def get_peak_rss():
+    '''
+    Return the peak resident set size of the current process in bytes,
+    or None if it is not available on the platform.
+
+    '''
+    try:
+        import resource
+
+    except ImportError:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports the size in kilobytes, macOS in bytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss*1024
+
+
+def add(record, values):
+    '''
+    Add the time of a separate measurement to a record, e.g. of its feeds, and
+    keep the maximum peak memory of both, as well as the maximum growth of the peak.
+
+    '''
+    record['wall_time'] = (record['wall_time'] or 0) + values['wall_time']
+    record['cpu_time'] = (record['cpu_time'] or 0) + values['cpu_time']
+    record['peak_rss'] = _max(record['peak_rss'], values['peak_rss'])
+    record['peak_rss_growth'] = _max(record.get('peak_rss_growth'), values.get('peak_rss_growth'))
+
+
+def _record(stage, household=None, feed=None, **values):
+    record = dict.fromkeys(RECORD_KEYS)
+    record.update(stage=stage, household=household, feed=feed)
+    for key, value in values.items():
+        # Convert numpy scalars, to be serializable as JSON
+        record[key] = value.item() if hasattr(value, 'item') else value
+
+    return record
+
+
+def _max(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if len(values) > 0 else None
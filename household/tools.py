@@ -6,11 +6,14 @@ Household Datapackage
 tools.py : module independent tools
 
 """
-import sys
-
 import numpy as np
 import pandas as pd
 
+from pandas.api.types import is_bool_dtype, is_float_dtype, is_numeric_dtype, is_unsigned_integer_dtype
+
+# Decimals of the published values, that need to be kept by values stored as float32 in the lean mode
+LEAN_DECIMALS = 3
+
 
 def update_sets(key, data, data_sets):
     '''
@@ -21,8 +24,9 @@ def update_sets(key, data, data_sets):
     key : str
         Key for the data set to merge, e.g. 
         
-    data : pandas.DataFrame
-        DataFrame with the household data to merge with the set
+    data : pandas.DataFrame or list of pandas.DataFrame
+        DataFrame with the household data to merge with the set.
+        Several DataFrames will be merged in a single pass
         
     data_sets : pandas.DataFrame
         DataFrame with the set of household data
@@ -33,43 +37,192 @@ def update_sets(key, data, data_sets):
         Subset of household data, available for the Household
 
     '''
-    if not key in data_sets:
-        data_sets[key] = data
-    elif not data.empty:
-        data_sets[key] = data_sets[key].combine_first(data)
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+    
+    if key in data_sets:
+        data = [data_sets[key]] + [d for d in data if not d.empty]
+    else:
+        data = data[:1] + [d for d in data[1:] if not d.empty]
+    
+    data_sets[key] = assemble(data)
+    
+    # Markers of households take precedence over the markers of later households,
+    # in the same way as the single marker column of all households was combined
+    markers = [c for d in data for c in d.columns if c[0] == 'interpolated']
+    if len(markers) > 1:
+        marked = np.zeros(len(data_sets[key].index), dtype=bool)
+        for marker in dict.fromkeys(markers):
+            marker_values = np.where(marked, 0, data_sets[key][marker].values).astype(np.uint64)
+            data_sets[key][marker] = marker_values
+            marked |= marker_values != 0
 
 
-def update_progress(count, total):
+def assemble(frames):
     '''
-    Display or updates a console progress bar.
+    Combine several DataFrames into one in a single pass, equivalent to 
+    repeatedly calling combine_first on the first DataFrame.
+    
+    The union of all indexes and columns is built once and every frame is 
+    written into a preallocated block, so that the peak memory stays close 
+    to the size of the combined DataFrame.
+    Values of earlier DataFrames take precedence over values of later ones,
+    unless they are missing.
 
     Parameters
     ----------
-    count : int
-        number of feeds that have been read so far
-    total : int
-        total number of feeds
+    frames : list of pandas.DataFrame
+        DataFrames to be combined
 
     Returns
     ----------
-    None
+    combined : pandas.DataFrame
+        DataFrame with the union of all indexes and columns
 
     '''
-    barLength = 50  # Modify this to change the length of the progress bar
-    status = ""
-    progress = count / total
-    if isinstance(progress, int):
-        progress = float(progress)
-    if progress >= 1:
-        progress = 1
-        status = "Done...\r\n"
-    block = int(round(barLength * progress))
-    text = "Progress: [{0}] {1}/{2} feeds {3}\r".format(
-        "#" * block + "-" * (barLength - block), count, total, status)
-    sys.stdout.write(text)
-    sys.stdout.flush()
-
-    return
+    frames = list(frames)
+    if len(frames) > 1:
+        frames = [f for f in frames if len(f.columns) > 0] or frames[:1]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    
+    index = _union([f.index for f in frames])
+    columns = _union([f.columns for f in frames])
+    
+    # Determine the resulting data type of each column, to group them into blocks
+    columns_dtypes = {}
+    for frame in frames:
+        for column, dtype in frame.dtypes.items():
+            columns_dtypes.setdefault(column, []).append(dtype)
+    
+    dtypes = [_assemble_dtype(columns_dtypes[column]) for column in columns]
+    blocks = {}
+    for dtype in dtypes:
+        if dtype not in blocks:
+            blocks[dtype] = np.full((dtypes.count(dtype), len(index)), 
+                                    0 if is_unsigned_integer_dtype(dtype) else np.NaN, dtype=dtype)
+    
+    blocks_pos = []
+    blocks_count = dict.fromkeys(blocks, 0)
+    for dtype in dtypes:
+        blocks_pos.append(blocks_count[dtype])
+        blocks_count[dtype] += 1
+    
+    # Write the frames in reverse order, so that values of earlier frames overwrite later ones
+    for frame in reversed(frames):
+        rows = _indexer(index, frame.index)
+        cols = _indexer(columns, frame.columns)
+        for i, col in enumerate(cols):
+            values = frame.iloc[:, i]
+            if dtypes[col] == object:
+                values = values.astype(object)
+            values = values.values
+            valid = pd.notnull(values) if not is_unsigned_integer_dtype(dtypes[col]) else values != 0
+            blocks[dtypes[col]][blocks_pos[col], rows[valid]] = values[valid]
+    
+    # Create the DataFrame from the largest block without copying it and
+    # insert the columns of the remaining blocks at their positions
+    block_dtype = max(blocks, key=lambda dtype: blocks_count[dtype])
+    block_columns = [col for col, dtype in enumerate(dtypes) if dtype == block_dtype]
+    combined = pd.DataFrame(blocks[block_dtype].T, index=index, 
+                            columns=columns[block_columns], copy=False)
+    for col, dtype in enumerate(dtypes):
+        if dtype != block_dtype:
+            combined.insert(col, columns[col], blocks[dtype][blocks_pos[col]])
+    
+    return combined
+
+
+def _union(indexes):
+    if all(index.equals(indexes[0]) for index in indexes[1:]):
+        return indexes[0]
+    
+    if _is_datetime(indexes):
+        # Sort the timestamps directly as integers, which is a lot faster than hashing them
+        names = set(index.name for index in indexes)
+        union = np.unique(np.concatenate([index.asi8 for index in indexes]))
+        union = pd.DatetimeIndex(union.view('datetime64[ns]'), 
+                                 name=names.pop() if len(names) == 1 else None)
+        if indexes[0].tz is not None:
+            union = union.tz_localize('UTC').tz_convert(indexes[0].tz)
+        
+        return union
+    
+    union = indexes[0].append(indexes[1:]).unique()
+    try:
+        union = union.sort_values()
+        
+    except TypeError:
+        pass
+    
+    return union
+
+
+def _indexer(union, index):
+    if _is_datetime([union, index]) and union.is_monotonic_increasing:
+        return np.searchsorted(union.asi8, index.asi8)
+    
+    return union.get_indexer(index)
+
+
+def _is_datetime(indexes):
+    return all(isinstance(index, pd.DatetimeIndex) for index in indexes) and \
+           len(set(str(index.tz) for index in indexes)) == 1
+
+
+def _assemble_dtype(dtypes):
+    if all(is_float_dtype(dtype) for dtype in dtypes):
+        return np.result_type(*dtypes)
+    
+    # Bitmasks, e.g. of markers, stay unsigned and are missing where they are 0
+    if all(is_unsigned_integer_dtype(dtype) for dtype in dtypes):
+        return np.dtype(np.uint64)
+    
+    if all(is_numeric_dtype(dtype) and not is_bool_dtype(dtype) for dtype in dtypes):
+        return np.dtype(np.float64)
+    
+    return np.dtype(object)
+
+
+def restore_dtype(data, dtype, decimals=LEAN_DECIMALS):
+    '''
+    Convert processed values back to the float32 dtype of their input in the lean mode,
+    if their magnitude allows to keep the given number of decimals.
+
+    The float32 values deviate by less than half of the last decimal, which still rounds
+    values close to a tie to the neighbouring decimal. Lean output is therefore not identical
+    to the published files and their checksums, e.g. larger energy counters differ by 0.001
+    in a few percent of their values.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame or numpy.ndarray
+        Processed values, e.g. as float64 
+    dtype : numpy.dtype
+        Data type of the input values. Values are only converted, if it is float32
+    decimals : int, default 3
+        Number of decimals, that need to be kept
+
+    Returns
+    ----------
+    data : pandas.DataFrame or numpy.ndarray
+        The values as float32, if their precision allows it
+
+    '''
+    if np.dtype(dtype) != np.float32:
+        return data
+    
+    values = np.asarray(data, dtype=np.float64)
+    values = np.abs(values[~np.isnan(values)])
+    
+    # The rounding error of float32 values is up to 2**-24 of their magnitude,
+    # which needs to stay below half of the last decimal to deviate by at most one decimal
+    if len(values) > 0 and values.max() >= 2**23/10**decimals:
+        return data
+    
+    return data.astype(np.float32)
 
 
 def derive_power(feed):
@@ -87,13 +240,35 @@ def derive_power(feed):
         DataFrame with the power series of the feed
 
     '''
-    feed_energy = feed.iloc[:,0].astype('float64')
-    delta_energy = feed_energy.diff()
-    delta_index = pd.Series(delta_energy.index, index=delta_energy.index)
-    delta_index = (delta_index - delta_index.shift(1))/np.timedelta64(1, 'h')
-    
-    feed_power = pd.DataFrame(delta_energy/delta_index, index=feed.index)
-    feed_power.columns = ["Power [kW]"]
+    feed_power = derive_power_values(feed.index.asi8, feed.iloc[:,0].values)
+    feed_power = pd.DataFrame(feed_power, index=feed.index, columns=["Power [kW]"])
     
     return feed_power.dropna()
 
+
+def derive_power_values(times, values):
+    '''
+    Derive the power in kW from the energy values in kWh of a series,
+    directly on the timestamps as integers.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Timestamps of the values in nanoseconds since the epoch
+    values : numpy.ndarray
+        Energy values of the timestamps
+
+    Returns
+    ----------
+    power: numpy.ndarray
+        Power between each value and its predecessor, NaN for the first one
+
+    '''
+    power = np.full(len(values), np.NaN)
+    if len(values) > 1:
+        hours = np.diff(np.asarray(times, dtype=np.int64)).view('m8[ns]')/np.timedelta64(1, 'h')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(np.diff(np.asarray(values, dtype=np.float64)), hours, out=power[1:])
+    
+    return power
+
@@ -16,10 +16,18 @@ import numpy as np
 import pandas as pd
 
 from datetime import datetime, timedelta
-from .tools import update_progress, derive_power
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .tools import derive_power, derive_power_values, restore_dtype
+from .chunking import Spill
+from .telemetry import Telemetry, measure, add
 
+# Number of records, the detection of decreasing values needs to see after a time window,
+# as well as the number of records without decrease before a window, that isolate the 
+# detection within the window from all earlier decreasing values
+DECREASING_HALO = 16
 
-def validate(household, household_data, config_dir='conf', verbose=False):
+
+def validate(household, household_data, config_dir='conf', verbose=False, workers=None, telemetry=None):
     '''
     Search for measurement faults in several data series of a DataFrame and remove them
 
@@ -33,6 +41,11 @@ def validate(household, household_data, config_dir='conf', verbose=False):
          directory path where all configurations can be found
     output : boolean
         Flag, if the validated feeds should be printed as human readable CSV files
+    workers : int, default None
+        Number of processes to validate the feeds in parallel.
+        If None or 1, all feeds will be validated sequentially
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the validation of each feed and the household
 
     Returns
     ----------    
@@ -40,110 +53,555 @@ def validate(household, household_data, config_dir='conf', verbose=False):
         Adjusted DataFrame with result series
 
     '''
-    result = pd.DataFrame()
+    results, _ = validate_households([household], {household['id']: household_data}, 
+                                     config_dir=config_dir, verbose=verbose, workers=workers, 
+                                     telemetry=telemetry)
+    
+    return results[household['id']]
+
+def validate_households(households, households_data, config_dir='conf', verbose=False, workers=None, 
+                        telemetry=None):
+    '''
+    Search for measurement faults in the data series of several households and remove them.
+    All feeds of all households are validated as independent tasks, optionally fanned
+    out to a pool of worker processes.
+
+    Parameters
+    ----------
+    households : list of dict
+        Configuration dictionaries of the households
+    households_data : dict of pandas.DataFrame
+        DataFrames to inspect and possibly fix measurement errors, by household id
+    config_dir : str
+         directory path where all configurations can be found
+    verbose : boolean
+        Flag, if the validated feeds should be printed as human readable CSV files
+    workers : int, default None
+        Number of processes to validate the feeds in parallel.
+        If None or 1, all feeds will be validated sequentially
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the validation of each feed and household, with the 
+        rows dropped as measurement faults
+
+    Returns
+    ----------    
+    results: dict of pandas.DataFrame
+        Adjusted DataFrames with result series, by household id
+    errors: pandas.DataFrame
+        Number of deleted values per household and feed, due to the standard deviation, 
+        decreasing energy values and the power quantile, as well as the indices of unusual behaviour
+
+    '''
+    if telemetry is None:
+        telemetry = Telemetry()
     
-    logger.info('Validate %s series', household['name'])
+    tasks = []
+    for household in households:
+        logger.info('Validate %s series', household['name'])
+        
+        household_data = households_data[household['id']]
+        feeds_columns = household_data.columns.get_level_values('feed')
+        feeds_configs = _read_adjustments(household['id'], config_dir)
+        
+        for feed_name in household['series'].keys():
+            feed = household_data.loc[:, feeds_columns==feed_name].dropna()
+            tasks.append((household, feed_name, feed, feeds_configs, verbose))
     
-    feeds_columns = household_data.columns.get_level_values('feed')
-    feeds_configs = _read_adjustments(household['id'], config_dir)
-    feeds_output = pd.DataFrame()
-    feeds_existing = len(household_data.columns)
+    feeds_validated, feeds_values = _validate_feeds(tasks, workers, telemetry)
+    
+    results = {}
+    errors = []
+    for household in households:
+        # The household is measured by the time of its feeds, that may have been validated in parallel
+        with telemetry.measure('validate', household=household['id'], 
+                               rows_in=len(households_data[household['id']].index)) as record:
+            result = pd.DataFrame()
+            feeds_output = pd.DataFrame()
+            feeds_dropped = 0
+            for feed_name in household['series'].keys():
+                feed_fixed, feed_output, feed_errors = feeds_validated[(household['id'], feed_name)]
+                feeds_dropped += feed_errors['std'] + feed_errors['inc'] + feed_errors['qnt']
+                add(record, feeds_values[(household['id'], feed_name)])
+                
+                result = pd.concat([result, feed_fixed], axis=1)
+                if verbose:
+                    feeds_output = pd.concat([feeds_output, feed_output], axis=1)
+                
+                errors.append(dict(household=household['name'], feed=feed_name, **feed_errors))
+            
+            if verbose:
+                from household.visualization import plot
+                feeds_columns = households_data[household['id']].columns.get_level_values('feed')
+                plot(feeds_output, feeds_columns, household['name']) #, days=1)
+            
+            results[household['id']] = result
+            record['rows_out'] = len(result.index)
+            record['rows_dropped'] = feeds_dropped
+    
+    errors = pd.DataFrame(errors, columns=['household', 'feed', 'std', 'inc', 'qnt', 'unusual'])
+    
+    return results, errors.set_index(['household', 'feed'])
+
+def _validate_feeds(tasks, workers, telemetry):
+    feeds_validated = {}
+    feeds_values = {}
+    feeds_existing = len(tasks)
     feeds_success = 0
     
-    for feed_name in household['series'].keys():
-        feed = household_data.loc[:, feeds_columns==feed_name].dropna()
+    def record_feed(task, feed_validated, feed_values):
+        household, feed_name, feed = task[:3]
+        feed_fixed, _, feed_errors = feed_validated
         
-        #Take specific actions, depending on one-time occurrences for the specific feed
-        if feed_name in feeds_configs:
-            for feed_configs in feeds_configs[feed_name]:
-                feed = _series_adjustment(feed_configs, feed, feed_name)
+        feeds_validated[(household['id'], feed_name)] = feed_validated
+        feeds_values[(household['id'], feed_name)] = feed_values
+        telemetry.record('validate', household=household['id'], feed=feed_name, 
+                         rows_in=feed.count().sum(), 
+                         rows_out=feed_fixed.count().sum(), 
+                         rows_dropped=feed_errors['std'] + feed_errors['inc'] + feed_errors['qnt'], 
+                         **feed_values)
+    
+    if workers is None or workers <= 1:
+        for task in tasks:
+            record_feed(task, *measure(telemetry.profiled(_validate_feed, 'validate', task[0]['id'], task[1]), *task))
+            
+            feeds_success += 1
+            telemetry.progress('validate', feeds_success, feeds_existing)
         
-        # Keep only the rows where the energy values are within +3 to -3 times the standard deviation.
-        error_std = np.abs(feed - feed.mean()) > 3*feed.std()
+        return feeds_validated, feeds_values
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(measure, telemetry.profiled(_validate_task, 'validate', task[0]['id'], task[1]), *task)
+                   for task in tasks]
         
-        if np.count_nonzero(error_std) > 0:
-            logger.debug("Deleted %s %s values: %s energy values 3 times the standard deviation", 
-                         household['name'], feed_name, str(np.count_nonzero(error_std)))
+        for _ in as_completed(futures):
+            feeds_success += 1
+            telemetry.progress('validate', feeds_success, feeds_existing)
+        
+        # Emit the logged messages of all feeds in the order of the tasks, to keep them deterministic
+        for task, future in zip(tasks, futures):
+            (feed_validated, feed_records), feed_values = future.result()
+            for record in feed_records:
+                record_logger = logging.getLogger(record.name)
+                if record_logger.isEnabledFor(record.levelno):
+                    record_logger.handle(record)
+            
+            record_feed(task, feed_validated, feed_values)
+    
+    return feeds_validated, feeds_values
+
+def _validate_task(household, feed_name, feed, feeds_configs, verbose):
+    # Capture all messages logged by the package in the worker process, to be emitted by the parent
+    package_logger = logging.getLogger(__name__.split('.')[0])
+    package_level = package_logger.level
+    package_propagate = package_logger.propagate
+    
+    records = _RecordsHandler()
+    package_logger.addHandler(records)
+    package_logger.setLevel(logging.DEBUG)
+    package_logger.propagate = False
+    try:
+        return _validate_feed(household, feed_name, feed, feeds_configs, verbose), records.records
+    
+    finally:
+        package_logger.removeHandler(records)
+        package_logger.setLevel(package_level)
+        package_logger.propagate = package_propagate
+
+class _RecordsHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+    
+    def emit(self, record):
+        # Format the message in advance, to allow the record to be pickled
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+def _validate_feed(household, feed_name, feed, feeds_configs, verbose):
+    feed_errors = {'std': 0, 'inc': 0, 'qnt': 0, 'unusual': []}
+    feed_output = None
+    
+    # Validate lean float32 values with full precision
+    feed_dtype = feed.dtypes.iloc[0] if len(feed.columns) > 0 else np.float64
+    feed = feed.astype(np.float64, copy=False)
+    
+    #Take specific actions, depending on one-time occurrences for the specific feed
+    if feed_name in feeds_configs:
+        for feed_configs in feeds_configs[feed_name]:
+            feed = _series_adjustment(feed_configs, feed, feed_name)
+    
+    # Keep only the rows where the energy values are within +3 to -3 times the standard deviation.
+    error_std = np.abs(feed - feed.mean()) > 3*feed.std()
+    
+    feed_errors['std'] = np.count_nonzero(error_std)
+    if np.count_nonzero(error_std) > 0:
+        logger.debug("Deleted %s %s values: %s energy values 3 times the standard deviation", 
+                     household['name'], feed_name, str(np.count_nonzero(error_std)))
+    
+    # Keep only the rows where the energy values is increasing
+    feed_fixed = feed[~error_std]
+    error_inc, error_flags = _decreasing_errors(feed_fixed.values[:,0])
+    error_inc = pd.DataFrame(error_inc, index=feed_fixed.index, columns=feed_fixed.columns)
+    
+    for error_flag in feed_fixed.index[error_flags]:
+        feed_errors['unusual'].append(error_flag)
+        logger.warn('Unusual behaviour at index %s for %s: %s', error_flag.strftime('%d.%m.%Y %H:%M'), household['name'], feed_name)
+    
+    feed_errors['inc'] = np.count_nonzero(error_inc)
+    if np.count_nonzero(error_inc) > 0:
+        feed_fixed = feed_fixed[~error_inc]
+        logger.debug("Deleted %s %s values: %s decreasing energy values", 
+                     household['name'], feed_name, str(np.count_nonzero(error_inc)))
+    
+    # Notify about rows where the derived power is significantly larger than the standard deviation value
+    feed_power = derive_power_values(feed_fixed.index.asi8, feed_fixed.values[:,0])
+    feed_power = pd.DataFrame(feed_power, index=feed_fixed.index, columns=["Power [kW]"])
+    
+    quantile = feed_power[feed_power > 0].quantile(.99)[0]
+    error_qnt = (feed_power.dropna().abs() > 3*quantile).shift(-1).fillna(False)
+    error_qnt.columns = feed_fixed.columns
+    
+    feed_errors['qnt'] = np.count_nonzero(error_qnt)
+    if np.count_nonzero(error_qnt) > 0:
+        feed_fixed = feed_fixed[~error_qnt]
+        logger.debug("Deleted %s %s values: %s power values 3 times .99 standard deviation", 
+                     household['name'], feed_name, str(np.count_nonzero(error_qnt)))
+    
+    if not feed_fixed.empty:
+        # Always begin with an energy value of 0
+        feed_fixed -= feed_fixed.dropna().iloc[0,0]
+        feed_fixed = restore_dtype(feed_fixed, feed_dtype)
+    
+    if verbose:
+        os.makedirs("raw_data", exist_ok=True)
         
-        # Keep only the rows where the energy values is increasing
-        feed_fixed = feed[~error_std]
-        error_inc = feed_fixed < feed_fixed.shift(1)
+        error_std = error_std.replace(False, np.NaN)
+        error_inc = error_inc.replace(False, np.NaN)
+        error_qnt = error_qnt.replace(False, np.NaN)
         
-        feed_size = len(feed_fixed.index)
-        for time in error_inc.replace(False, np.NaN).dropna().index:
-            i = feed_fixed.index.get_loc(time)
-            if i > 2 and i < feed_size:
-                error_flag = None
-                
-                # If a rounding or transmission error results in a single value being too big,
-                # fix that single data point, else flag all decreasing values
-                if feed_fixed.iloc[i,0] >= feed_fixed.iloc[i-2,0] and not error_inc.iloc[i-2,0]:
-                    error_inc.iloc[i,0] = False
-                    error_inc.iloc[i-1,0] = True
-                    
-                elif all(feed_fixed.iloc[i-1,0] > feed_fixed.iloc[i:min(feed_size-1,i+10),0]):
-                    error_flag = feed_fixed.index[i]
-                    
-                else:
-                    j = i+1
-                    while j < feed_size and feed_fixed.iloc[i-1,0] > feed_fixed.iloc[j,0]:
-                        if error_flag is None and j-i > 10:
-                            error_flag = feed_fixed.index[i]
-                        
-                        error_inc.iloc[j,0] = True
-                        j = j+1
-                
-                if error_flag is not None:
-                    logger.warn('Unusual behaviour at index %s for %s: %s', error_flag.strftime('%d.%m.%Y %H:%M'), household['name'], feed_name)
-                
-        if np.count_nonzero(error_inc) > 0:
-            feed_fixed = feed_fixed[~error_inc]
+        feed_columns = [feed_name+"_energy", feed_name+"_power", feed_name+'_error_std', feed_name+'_error_inc', feed_name+'_error_qnt']
+        # The validated values only differ from the adjusted ones, if any were deleted
+        if feed_errors['std'] + feed_errors['inc'] > 0:
+            feed_csv_power = derive_power(feed)
+        else:
+            feed_csv_power = feed_power.dropna()
+        
+        feed_csv = pd.concat([feed, feed_csv_power, error_std, error_inc, error_qnt], axis=1)
+        feed_csv.columns = feed_columns
+        feed_csv.to_csv(os.path.join("raw_data", household['id']+'_'+feed_name+'.csv'), 
+                        sep=',', decimal='.', encoding='utf-8')
+        
+        feed_output = pd.concat([feed_fixed, derive_power(feed_fixed), error_std, error_inc, error_qnt], axis=1)
+        feed_output.columns = feed_columns
+    
+    return feed_fixed, feed_output, feed_errors
+
+def validate_chunks(household, feed_name, feed, windows, path, config_dir='conf', telemetry=None):
+    '''
+    Search for measurement faults in a feed and remove them in time windows, 
+    equivalent to validate_households(), without keeping the feed in memory.
+
+    The adjustments of the feed are resolved into steps, which are applied to each 
+    window as it is read. The mean and standard deviation are merged from the moments 
+    of all windows, while the power quantile is selected from the largest power values 
+    of all windows. Decreasing values are detected with the records of a window, the 
+    records back to the last steady increase before it and a few records after it.
+
+    Parameters
+    ----------
+    household : dict
+        Configuration dictionary of the household
+    feed_name : str
+        Name of the feed to validate
+    feed : household.read.FeedReader
+        Reader of the feeds records
+    windows : list of tuple
+        Consecutive time windows, see household.chunking.get_windows()
+    path : str
+        Path of the spill files of the feed, without their extension
+    config_dir : str
+         directory path where all configurations can be found
+    telemetry : household.telemetry.Telemetry, default None
+        Telemetry to record the validation of the feed
+
+    Returns
+    ----------    
+    feed_fixed: household.chunking.Spill
+        Validated records of the feed
+    feed_errors: dict
+        Number of deleted values, due to the standard deviation, decreasing energy values 
+        and the power quantile, as well as the indices of unusual behaviour
+
+    '''
+    if telemetry is None:
+        telemetry = Telemetry()
+    
+    feed_errors = {'std': 0, 'inc': 0, 'qnt': 0, 'unusual': []}
+    feeds_configs = _read_adjustments(household['id'], config_dir)
+    
+    with telemetry.measure('validate', household=household['id'], feed=feed_name, rows_in=0) as record:
+        feed_adjusted = _AdjustedFeed(feed, feeds_configs.get(feed_name, []), feed_name)
+        
+        # Merge the count, mean and sum of squared deviations of all windows
+        count, mean, squares = 0, 0., 0.
+        for start, end in windows:
+            times, values = feed.read(start, end-1)
+            record['rows_in'] += len(times)
+            
+            times, values = feed_adjusted.adjust(times, values, start, end-1)
+            if len(values) == 0:
+                continue
+            
+            window_mean = values.mean()
+            window_squares = ((values - window_mean)**2).sum()
+            window_delta = window_mean - mean
+            window_count = count + len(values)
+            
+            mean += window_delta*len(values)/window_count
+            squares += window_squares + window_delta**2*count*len(values)/window_count
+            count = window_count
+        
+        std = np.sqrt(squares/(count - 1)) if count > 1 else np.NaN
+        
+        # Keep only the rows where the energy values are within +3 to -3 times the standard deviation
+        # and increasing, while counting the positive power values to select their quantile from
+        windows_read = {}
+        def read_window(i):
+            if i not in windows_read:
+                times, values = feed_adjusted.read(windows[i][0], windows[i][1]-1)
+                error_std = np.abs(values - mean) > 3*std
+                windows_read[i] = (times, np.where(error_std, np.NaN, values), error_std)
+            
+            return windows_read[i]
+        
+        feed_checked = Spill(path + '_checked')
+        feed_halo = np.empty(0)
+        feed_prev = None
+        power_count = 0
+        for i in range(len(windows)):
+            times, values, error_std = read_window(i)
+            del windows_read[i]
+            
+            values_next = []
+            for j in range(i+1, len(windows)):
+                if sum(len(v) for v in values_next) >= DECREASING_HALO:
+                    break
+                values_next.append(read_window(j)[1])
+            
+            error_inc, error_flags = _decreasing_errors(np.concatenate([feed_halo, values] + values_next))
+            error_inc = error_inc[len(feed_halo):len(feed_halo)+len(values)]
+            error_flags = error_flags[(error_flags >= len(feed_halo)) & 
+                                      (error_flags < len(feed_halo)+len(values))] - len(feed_halo)
+            
+            for error_flag in times[error_flags]:
+                error_flag = pd.Timestamp(error_flag, tz='UTC')
+                feed_errors['unusual'].append(error_flag)
+                logger.warn('Unusual behaviour at index %s for %s: %s', error_flag.strftime('%d.%m.%Y %H:%M'), household['name'], feed_name)
+            
+            feed_errors['std'] += np.count_nonzero(error_std)
+            feed_errors['inc'] += np.count_nonzero(error_inc)
+            
+            feed_halo = np.concatenate((feed_halo, values))
+            feed_halo = feed_halo[_decreasing_halo(feed_halo):]
+            
+            values = np.where(error_inc, np.NaN, values)
+            feed_checked.append(times, values)
+            
+            power = _window_power(times, values, feed_prev)
+            power_count += np.count_nonzero(power > 0)
+            if len(times) > 0:
+                feed_prev = (times[-1], values[-1])
+        
+        if feed_errors['std'] > 0:
+            logger.debug("Deleted %s %s values: %s energy values 3 times the standard deviation", 
+                         household['name'], feed_name, str(feed_errors['std']))
+        if feed_errors['inc'] > 0:
             logger.debug("Deleted %s %s values: %s decreasing energy values", 
-                         household['name'], feed_name, str(np.count_nonzero(error_inc)))
+                         household['name'], feed_name, str(feed_errors['inc']))
         
-        # Notify about rows where the derived power is significantly larger than the standard deviation value
-        feed_power = derive_power(feed_fixed)
+        # Select the quantile of the positive power values, interpolated like pandas does, 
+        # from only the largest values above the rank of the quantile
+        quantile = np.NaN
+        if power_count > 0:
+            quantile_index = (power_count - 1)*np.true_divide(.99*100., 100)
+            quantile_rank = int(np.floor(quantile_index))
+            quantile_count = power_count - quantile_rank
+            
+            power_largest = np.empty(0)
+            feed_prev = None
+            for i in range(len(windows)):
+                times, values = feed_checked.read_window(i)
+                power = _window_power(times, values, feed_prev)
+                if len(times) > 0:
+                    feed_prev = (times[-1], values[-1])
+                
+                power_largest = np.concatenate((power_largest, power[power > 0]))
+                if len(power_largest) > quantile_count:
+                    power_largest = np.partition(power_largest, len(power_largest) - quantile_count)
+                    power_largest = power_largest[len(power_largest) - quantile_count:]
+            
+            quantile = np.quantile(np.sort(power_largest)[:2], quantile_index - quantile_rank)
         
-        quantile = feed_power[feed_power > 0].quantile(.99)[0]
-        error_qnt = (feed_power.abs() > 3*quantile).shift(-1).fillna(False)
-        error_qnt.columns = feed_fixed.columns
+        # Flag the power values, that are followed by one larger than 3 times the quantile.
+        # The last power value of each window may be flagged by the first one of a later window
+        errors_last = np.zeros(len(windows), dtype=bool)
+        errors_pending = None
+        feed_prev = None
+        for i in range(len(windows)):
+            times, values = feed_checked.read_window(i)
+            power = _window_power(times, values, feed_prev)
+            if len(times) > 0:
+                feed_prev = (times[-1], values[-1])
+            
+            power = power[~np.isnan(power)]
+            if len(power) == 0:
+                continue
+            
+            error_qnt = np.abs(power) > 3*quantile
+            if errors_pending is not None:
+                errors_last[errors_pending] = error_qnt[0]
+                feed_errors['qnt'] += int(error_qnt[0])
+            
+            feed_errors['qnt'] += np.count_nonzero(error_qnt[1:])
+            errors_pending = i
         
-        if np.count_nonzero(error_qnt) > 0:
-            feed_fixed = feed_fixed[~error_qnt]
+        if feed_errors['qnt'] > 0:
             logger.debug("Deleted %s %s values: %s power values 3 times .99 standard deviation", 
-                         household['name'], feed_name, str(np.count_nonzero(error_qnt)))
+                         household['name'], feed_name, str(feed_errors['qnt']))
         
-        if not feed_fixed.empty:
-            # Always begin with an energy value of 0
-            feed_fixed -= feed_fixed.dropna().iloc[0,0]
-        
-        if verbose:
-            os.makedirs("raw_data", exist_ok=True)
+        feed_fixed = Spill(path + '_fixed')
+        feed_first = None
+        feed_prev = None
+        for i in range(len(windows)):
+            times, values = feed_checked.read_window(i)
+            power = _window_power(times, values, feed_prev)
+            if len(times) > 0:
+                feed_prev = (times[-1], values[-1])
+            
+            if feed_errors['qnt'] > 0:
+                power_rows = np.flatnonzero(~np.isnan(power))
+                error_qnt = np.append(np.abs(power[power_rows[1:]]) > 3*quantile, errors_last[i])
+                valid = np.zeros(len(times), dtype=bool)
+                valid[power_rows[~error_qnt[:len(power_rows)]]] = True
+            else:
+                valid = ~np.isnan(values)
             
-            error_std = error_std.replace(False, np.NaN)
-            error_inc = error_inc.replace(False, np.NaN)
-            error_qnt = error_qnt.replace(False, np.NaN)
+            times, values = times[valid], values[valid]
             
-            feed_columns = [feed_name+"_energy", feed_name+"_power", feed_name+'_error_std', feed_name+'_error_inc', feed_name+'_error_qnt']
-            feed_csv = pd.concat([feed, derive_power(feed), error_std, error_inc, error_qnt], axis=1)
-            feed_csv.columns = feed_columns
-            feed_csv.to_csv(os.path.join("raw_data", household['id']+'_'+feed_name+'.csv'), 
-                            sep=',', decimal='.', encoding='utf-8')
+            # Always begin with an energy value of 0
+            if feed_first is None and len(values) > 0:
+                feed_first = values[0]
+            if feed_first is not None:
+                values = values - feed_first
             
-            feed_output = pd.concat([feed_fixed, derive_power(feed_fixed), error_std, error_inc, error_qnt], axis=1)
-            feed_output.columns = feed_columns
-            feeds_output = pd.concat([feeds_output, feed_output], axis=1)
+            feed_fixed.append(times, values)
         
-        result = pd.concat([result, feed_fixed], axis=1)
+        record['rows_out'] = len(feed_fixed)
+        record['rows_dropped'] = feed_errors['std'] + feed_errors['inc'] + feed_errors['qnt']
+    
+    return feed_fixed, feed_errors
+
+def _window_power(times, values, previous=None):
+    # Derive the power of each record of a window, from the last record of the previous window on
+    if previous is not None:
+        times = np.concatenate(([previous[0]], times))
+        values = np.concatenate(([previous[1]], values))
+    
+    power = derive_power_values(times, values)
+    
+    if previous is not None:
+        power = power[1:]
+    
+    return power
+
+def _decreasing_halo(values):
+    # Keep the values from the last position on, after which they did not decrease for 
+    # DECREASING_HALO-1 records, as no dip or its recovery reaches back beyond it
+    if len(values) < DECREASING_HALO:
+        return 0
+    
+    values_prev = np.concatenate(([np.NaN], values[:-1]))
+    decreasing = np.concatenate(([0], np.cumsum(values < values_prev)))
+    
+    starts = np.arange(len(values) - DECREASING_HALO + 1)
+    steady = np.flatnonzero(decreasing[starts + DECREASING_HALO] == decreasing[starts + 1])
+    
+    return steady[-1] if len(steady) > 0 else 0
+
+def _decreasing_errors(values):
+    '''
+    Detect decreasing energy values, that are not caused by a single value being too big,
+    e.g. due to rounding or transmission errors. All decreasing values will be flagged, 
+    while for single values being too big only that single data point will be flagged.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Energy values of the feed
+
+    Returns
+    ----------
+    errors: numpy.ndarray
+        Boolean mask of the values to be removed
+    flags: numpy.ndarray
+        Positions of unusual behaviour, where values stay decreased for a longer period
+
+    '''
+    size = len(values)
+    values_prev = np.concatenate(([np.NaN], values[:-1]))
+    errors_dec = values < values_prev
+    
+    dips = np.flatnonzero(errors_dec)
+    dips = dips[dips > 2]
+    if len(dips) == 0:
+        return errors_dec, dips
+    
+    # Compare the value before each dip with up to 10 following values. The values stay 
+    # decreased, if all of them are smaller, otherwise they recover at the first larger one
+    window = dips[:,None] + np.arange(10)
+    window_valid = window < size-1
+    window_dec = (values[dips-1,None] > values[np.minimum(window, size-1)]) | ~window_valid
+    dips_flag = window_dec.all(axis=1)
+    dips_end = dips + np.argmax(~window_dec, axis=1)
+    
+    # A dip, where the value recovers to the value two points before, marks the single value 
+    # before as too big, if that value was not flagged as an error itself. This is the case 
+    # if it did not decrease or recovered, while lying not within the range of another dip.
+    dips_single = values[dips] >= values[dips-2]
+    dips_pos = np.full(size, -1)
+    dips_pos[dips] = np.arange(len(dips))
+    dips_prev = dips_pos[dips-2]
+    
+    dips_chain = dips_single & errors_dec[dips-2] & (dips_prev >= 0)
+    dips_range = dips_single & ~errors_dec[dips-2]
+    
+    # Chained dips recover, if the dip two points before recovered as well
+    dips_root = np.where(dips_chain, dips_prev, np.arange(len(dips)))
+    while True:
+        dips_next = dips_root[dips_root]
+        if np.array_equal(dips_next, dips_root):
+            break
+        dips_root = dips_next
+    
+    dips_fixed = np.zeros(len(dips), dtype=bool)
+    while True:
+        dips_range_start = dips[~dips_fixed & ~dips_flag] + 1
+        dips_range_end = dips_end[~dips_fixed & ~dips_flag]
+        errors_range = np.cumsum(np.bincount(dips_range_start, minlength=size+1) - 
+                                 np.bincount(dips_range_end, minlength=size+1))[:size] > 0
         
-        feeds_success += 1
-        update_progress(feeds_success, feeds_existing)
+        dips_next = (dips_range & ~errors_range[dips-2])[dips_root]
+        if np.array_equal(dips_next, dips_fixed):
+            break
+        dips_fixed = dips_next
     
-    if verbose:
-        from household.visualization import plot
-        plot(feeds_output, feeds_columns, household['name']) #, days=1)
+    errors = errors_dec | errors_range
+    errors[dips[dips_fixed]] = False
+    errors[dips[dips_fixed]-1] = True
     
-    return result
+    return errors, dips[~dips_fixed & dips_flag]
 
 def _read_adjustments(household_id, config_dir):
     adjustments = {}
@@ -155,6 +613,125 @@ def _read_adjustments(household_id, config_dir):
     
     return adjustments
 
+class _AdjustedFeed(object):
+    '''
+    Records of a feed in time windows, with the adjustments of the feed applied, 
+    as _series_adjustment() applies them to the whole feed.
+
+    Each adjustment is resolved into steps, removing records, adding an offset to the 
+    records of a period or inserting records. All values the steps depend on are read 
+    from the records around the boundaries of the adjustment, as adjusted by all 
+    preceding steps.
+    '''
+    def __init__(self, feed, adjustments, feed_name):
+        self.feed = feed
+        self.steps = []
+        for adjustment in adjustments:
+            self._resolve(adjustment, feed_name)
+    
+    def read(self, start, end):
+        times, values = self.feed.read(start, end)
+        return self.adjust(times, values, start, end)
+    
+    def adjust(self, times, values, start, end):
+        for step in self.steps:
+            if step[0] == 'remove':
+                step_valid = (times < step[1]) | (times > step[2])
+                times, values = times[step_valid], values[step_valid]
+            
+            elif step[0] == 'add':
+                step_period = (times >= step[1]) & (times <= step[2])
+                values = values.copy()
+                values[step_period] = values[step_period] + step[3]
+            
+            elif step[0] == 'insert':
+                step_period = (step[1] >= start) & (step[1] <= end)
+                times = np.concatenate((times, step[1][step_period]))
+                values = np.concatenate((values, step[2][step_period]))
+                
+                step_order = np.argsort(times, kind='stable')
+                times, values = times[step_order], values[step_order]
+        
+        return times, values
+    
+    def _resolve(self, adjustment, feed_name):
+        if 'start' in adjustment:
+            adj_start = _adjustment_time(adjustment['start'])
+            if len(self.read(adj_start, adj_start)[0]) == 0:
+                logger.warning("Skipping adjustment outside index for in %s at %s", feed_name, 
+                               pd.Timestamp(adj_start, tz=pytz.utc))
+                return
+        else:
+            adj_start = self._search(self.feed.start, 1)[0]
+        
+        if 'end' in adjustment:
+            adj_end = _adjustment_time(adjustment['end'])
+        else:
+            adj_end = self._search(self.feed.end, -1)[0]
+        
+        adj_type = adjustment['type']
+        if adj_type == 'remove':
+            # A whole time period needs to be removed due to very unstable transmission
+            self.steps.append(('remove', adj_start, adj_end))
+        
+        elif adj_type == 'difference':
+            # Changed smart meters, resulting in a lower counter value.
+            # The first record is adjusted relative to the last one, as the feed would be
+            adj_prev = self._search(adj_start - 1, -1)
+            if adj_prev[0] is None:
+                adj_prev = self._search(self.feed.end, -1)
+            
+            adj_delta = adj_prev[1] - self._value(adj_start)
+            self.steps.append(('add', adj_start, adj_end, adj_delta))
+        
+        elif adj_type == 'fill':
+            fill_hours = int(adjustment['hours']) if 'hours' in adjustment else 24
+            fill_offset = pd.Timedelta(hours=fill_hours).value
+            if 'from' not in adjustment or adjustment['from'] == 'before':
+                fill_offset *= -1
+            
+            fill_times, fill_values = self.read(adj_start + fill_offset, adj_end + fill_offset)
+            
+            fill_values = fill_values - fill_values[0] + self._value(adj_start)
+            fill_times = fill_times - fill_offset
+            fill_delta = fill_values[-1] - self._value(adj_end)
+            
+            self.steps.append(('insert', fill_times[1:-2], fill_values[1:-2]))
+            self.steps.append(('add', adj_end + 1, np.iinfo(np.int64).max, fill_delta))
+        
+        logger.debug("Adjusted %s values (%s) from %s to %s", feed_name, adj_type, 
+                     pd.Timestamp(adj_start, tz=pytz.utc), pd.Timestamp(adj_end, tz=pytz.utc))
+    
+    def _search(self, time, direction):
+        # Search the adjusted records for the first one from a time on in the given direction, 
+        # reading windows of doubling length
+        length = pd.Timedelta(hours=1).value
+        while self.feed.start <= time <= self.feed.end:
+            if direction > 0:
+                times, values = self.read(time, time + length - 1)
+                if len(times) > 0:
+                    return times[0], values[0]
+                time += length
+            else:
+                times, values = self.read(time - length + 1, time)
+                if len(times) > 0:
+                    return times[-1], values[-1]
+                time -= length
+            
+            length *= 2
+        
+        return None, None
+    
+    def _value(self, time):
+        times, values = self.read(time, time)
+        if len(times) == 0:
+            raise KeyError(pd.Timestamp(time, tz=pytz.utc))
+        
+        return values[0]
+
+def _adjustment_time(time):
+    return pd.Timestamp(pytz.timezone('UTC').localize(datetime.strptime(time, '%Y-%m-%d %H:%M:%S'))).value
+
 def _series_adjustment(adjustment, feed, feed_name):
     '''
     Adjust the energy data series, to take actions against e.g. energy meter counter reset
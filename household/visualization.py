@@ -14,11 +14,16 @@ import pandas as pd
 
 import datetime as dt
 from household.tools import derive_power
+from household.imputation import get_marker_feeds
 
 
 def visualize(data):
-    for household_name in data.columns.get_level_values('household').drop_duplicates().drop(''):
-        household_data = data.loc[:,(data.columns.get_level_values('household') == household_name)]
+    households = data.columns.get_level_values('household')
+    markers = data.columns.get_level_values(0) == 'interpolated'
+    for household_name in households[~markers].drop_duplicates().drop('', errors='ignore'):
+        household_data = data.loc[:,(households == household_name) & ~markers]
+        household_feeds = get_marker_feeds(data.columns, household_name)
+        household_marker = data.loc[:,(households == household_name) & markers].iloc[:,0]
         
         feeds_data = pd.DataFrame()
         feeds_columns = household_data.columns.get_level_values('feed')
@@ -27,12 +32,13 @@ def visualize(data):
             if feed.empty:
                 continue
             
+            feed_bit = np.uint64(1 << household_feeds.get_loc(feed.columns[0]))
             feed.columns = [feed_name+"_energy"]
             feed_power = derive_power(feed)
             feed_power.columns = [feed_name+"_power"]
             feeds_data = pd.concat([feeds_data, feed, feed_power], axis=1)
-            feeds_data.loc[:, feed_name+"_interpolated"] = data.loc[:, 'interpolated']\
-                                                               .apply(lambda x: True if isinstance(x, str) and feed_name in x else np.NaN)
+            feeds_data.loc[:, feed_name+"_interpolated"] = (household_marker & feed_bit).astype(bool)\
+                                                               .where(lambda marked: marked)
         
         plot(feeds_data, feeds_columns, household_name)
 
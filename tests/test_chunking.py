@@ -0,0 +1,72 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+test_chunking.py : parity of the processing in time windows with the in-memory pipeline
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from household.synthetic import write_households
+from household.read import read_households
+from household.validation import validate_households
+from household.imputation import make_equidistant, fill_nan
+from household.chunking import process_chunks
+
+HEADERS = ['region', 'household', 'type', 'unit', 'feed']
+
+
+class TestChunking(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # The sparse feed indexes are cached relative to the working directory
+        cls.cwd = os.getcwd()
+        cls.path = tempfile.mkdtemp()
+        cls.source = os.path.join(cls.path, 'original_data')
+        os.chdir(cls.path)
+
+        # Several months with outages of up to 3 days, so that regions of missing values
+        # lie further into a time window than the halo of the imputation reaches back
+        cls.households = write_households(cls.source, households=1, feeds=4, days=90, seed=0, outages=8)
+        cls.household = cls.households[0]
+
+        data = read_households(cls.households, HEADERS, cache=False, source=cls.source)
+        data, cls.errors = validate_households(cls.households, data, config_dir=cls.path)
+        for household_data in data.values():
+            household_data.columns.names = HEADERS
+
+        data = make_equidistant(cls.household, data[cls.household['id']], 1)
+        cls.data_filled, cls.data_nan = fill_nan(data, cls.household['name'], HEADERS, config_dir=cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.path)
+
+    def _assert_chunks(self, chunk):
+        chunks, data_nan, errors = process_chunks(self.household, HEADERS, chunk=chunk,
+                                                  config_dir=self.path, source=self.source)
+
+        pd.testing.assert_frame_equal(pd.concat(list(chunks)), self.data_filled, check_freq=False)
+        pd.testing.assert_frame_equal(data_nan, self.data_nan)
+        pd.testing.assert_frame_equal(errors, self.errors)
+
+    def test_day(self):
+        self._assert_chunks('1D')
+
+    def test_week(self):
+        self._assert_chunks('7D')
+
+    def test_month(self):
+        self._assert_chunks('30D')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+test_download.py : download of the archive from a local stand-in HTTP server
+
+"""
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from household.download import download, download_file, _download_range
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    '''
+    Serve the content of the server by its path, with support for range
+    requests conditional on the entity tag in an If-Range header.
+    '''
+    def do_HEAD(self):
+        self._send(head=True)
+
+    def do_GET(self):
+        self._send(head=False)
+
+    def _send(self, head):
+        server = self.server
+        server.requests.append((self.command, self.headers.get('Range'), self.headers.get('If-Range')))
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+
+        content = server.files[self.path]
+        etag = '"{}"'.format(hashlib.sha256(content).hexdigest()[:16])
+
+        ranged = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if_range = self.headers.get('If-Range')
+        if ranged and (if_range is None or if_range == etag):
+            start = int(ranged.group(1))
+            end = int(ranged.group(2)) if ranged.group(2) else len(content) - 1
+            body = content[start:end+1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(content)))
+        else:
+            body = content
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+        self.server.files = {}
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+        self.path = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.path, 'original_data.zip')
+
+        self.content = os.urandom(100000)
+        self.server.files['/original_data.zip'] = self.content
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def _read(self):
+        with open(self.filepath, 'rb') as f:
+            return f.read()
+
+    def _ranges(self):
+        return [request[1] for request in self.server.requests if request[0] == 'GET']
+
+    def test_download(self):
+        download_file(self.url + 'original_data.zip', self.filepath,
+                      checksum=hashlib.sha256(self.content).hexdigest())
+
+        self.assertEqual(self._read(), self.content)
+        self.assertEqual(os.listdir(self.path), ['original_data.zip'])
+
+    def test_resume(self):
+        # Interrupt the download after the first 30000 bytes of the file
+        self._interrupted()
+        with open(self.filepath + '.part', 'wb') as f:
+            f.write(self.content[:30000])
+
+        download_file(self.url + 'original_data.zip', self.filepath,
+                      checksum=hashlib.sha256(self.content).hexdigest())
+
+        self.assertEqual(self._read(), self.content)
+        self.assertEqual(self._ranges(), ['bytes=30000-'])
+
+    def test_resume_changed(self):
+        self._interrupted()
+        with open(self.filepath + '.part', 'wb') as f:
+            f.write(self.content[:30000])
+
+        # The file on the server was replaced by a different one of the same size
+        self.content = os.urandom(len(self.content))
+        self.server.files['/original_data.zip'] = self.content
+
+        download_file(self.url + 'original_data.zip', self.filepath)
+
+        self.assertEqual(self._read(), self.content)
+        self.assertEqual(self._ranges(), [None])
+
+    def test_resume_if_range(self):
+        with open(self.filepath + '.part', 'wb') as f:
+            f.write(b'\0'*30000)
+
+        # The file changed after its validator was retrieved, so the complete file is sent again
+        _download_range(self.url + 'original_data.zip', self.filepath + '.part', 0, None, validator='"previous"')
+
+        with open(self.filepath + '.part', 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(self.server.requests[-1][1:], ('bytes=30000-', '"previous"'))
+
+    def test_segments(self):
+        download_file(self.url + 'original_data.zip', self.filepath, segments=4,
+                      checksum=hashlib.sha256(self.content).hexdigest())
+
+        self.assertEqual(self._read(), self.content)
+        self.assertEqual(sorted(self._ranges()), ['bytes=0-24999', 'bytes=25000-49999',
+                                                  'bytes=50000-74999', 'bytes=75000-99999'])
+        self.assertEqual(os.listdir(self.path), ['original_data.zip'])
+
+    def test_segments_resume(self):
+        self._interrupted(segments=4)
+        with open(self.filepath + '.part0', 'wb') as f:
+            f.write(self.content[:10000])
+        with open(self.filepath + '.part2', 'wb') as f:
+            f.write(self.content[50000:75000])
+
+        download_file(self.url + 'original_data.zip', self.filepath, segments=4,
+                      checksum=hashlib.sha256(self.content).hexdigest())
+
+        self.assertEqual(self._read(), self.content)
+        self.assertEqual(sorted(self._ranges()), ['bytes=10000-24999', 'bytes=25000-49999', 'bytes=75000-99999'])
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(IOError):
+            download_file(self.url + 'original_data.zip', self.filepath, checksum=hashlib.sha256(b'').hexdigest())
+
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_checksum_required(self):
+        with self.assertRaises(IOError):
+            download(self.path, version='2020-04-15', extract=False, server=self.url, require_checksum=True)
+
+        self.assertFalse(os.path.exists(self.filepath))
+
+    def _interrupted(self, segments=1):
+        # Retrieve the state of the file on the server, as an interrupted download would have left it
+        etag = '"{}"'.format(hashlib.sha256(self.content).hexdigest()[:16])
+        with open(self.filepath + '.part.state', 'w') as f:
+            f.write(json.dumps({'validator': etag, 'segments': segments}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Open Power System Data
+
+Household Datapackage
+
+test_export.py : CSV files of the writer compared to the output of pandas
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from household.export import write_csv, get_singleindex_columns
+from household.imputation import expand_markers
+
+HEADERS = ['region', 'household', 'type', 'unit', 'feed']
+
+INFO_COLS = {'utc': 'utc_timestamp',
+             'cet': 'cet_timestamp',
+             'marker': 'interpolated'}
+
+FLOAT_FORMAT = '%.3f'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+        index = pd.date_range('2015-03-29 00:00', periods=12, freq='15min', tz='UTC', name=INFO_COLS['utc'])
+        columns = pd.MultiIndex.from_tuples([
+            (INFO_COLS['cet'], '', '', '', ''),
+            ('DE_KN', 'residential1', 'residential_building', 'kWh', 'grid_import'),
+            ('DE_KN', 'residential1', 'residential_building', 'kWh', 'pv'),
+            ('DE_KN', 'residential1', 'residential_building', 'kWh', 'storage, "charge"'),
+            ('interpolated', 'residential1', '', '', ''),
+            ('DE_KN', 'industrial2', 'industrial_building', 'kWh', 'grid_import'),
+            ('interpolated', 'industrial2', '', '', ''),
+        ], names=HEADERS)
+
+        # Signed zeros, rounding ties, infinities and missing values in every column
+        self.data = pd.DataFrame({
+            columns[0]: index.tz_convert('Europe/Berlin').strftime('%Y-%m-%dT%H:%M:%S%z'),
+            columns[1]: [np.NaN, -0.0, 0.0, 0.0005, 0.0015, 0.0025, -0.0005, 1.0005, 2.675, 1e12, -1234.5675, 7.],
+            columns[2]: [np.inf, -np.inf, np.NaN, -0.0004, 0.1235, 9.9995, 0.125, 1e-10, -1e-10, 3.14159, 0., 1.],
+            columns[3]: [np.NaN]*6 + [0.0045, 123456.7895, -0.0, 5e-4, np.NaN, np.NaN],
+            columns[4]: np.array([0, 1, 2, 3, 4, 5, 6, 7, 0, 0, 1, 4], dtype=np.uint64),
+            columns[5]: [1.5, np.NaN, 2.5, np.NaN, -np.inf, 0.0005, 0.0015, np.NaN, 4., 5., 6., -0.0],
+            columns[6]: np.array([0, 1, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0], dtype=np.uint64),
+        }, index=index)
+        self.data.columns = columns
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, data, chunk_size=5):
+        filenames = {shape: os.path.join(self.path, shape + '.csv')
+                     for shape in ['singleindex', 'multiindex', 'stacked']}
+        write_csv(data, filenames, INFO_COLS, float_format=FLOAT_FORMAT, date_format=DATE_FORMAT,
+                  chunk_size=chunk_size)
+
+        files = {}
+        for shape, filename in filenames.items():
+            with open(filename, 'rb') as f:
+                files[shape] = f.read()
+        return files
+
+    def _expected(self, data):
+        # Shapes as derived by pandas before the writer existed
+        data = expand_markers(data)
+        singleindex = data.copy()
+        singleindex.columns = get_singleindex_columns(data, INFO_COLS)
+
+        stacked = data.copy()
+        stacked.drop(INFO_COLS['cet'], axis=1, inplace=True)
+        stacked.columns = stacked.columns.droplevel(['region', 'type', 'unit'])
+        stacked = stacked.transpose().stack(dropna=True).to_frame(name='data')
+
+        return {shape: df.to_csv(float_format=FLOAT_FORMAT, date_format=DATE_FORMAT).encode('utf-8')
+                for shape, df in [('singleindex', singleindex), ('multiindex', data), ('stacked', stacked)]}
+
+    def _assert_files(self, data):
+        files = self._write(data)
+        expected = self._expected(data)
+        for shape in ['singleindex', 'multiindex', 'stacked']:
+            self.assertEqual(files[shape], expected[shape], shape)
+
+    def test_markers(self):
+        self._assert_files(self.data)
+
+    def test_expanded_markers(self):
+        self._assert_files(expand_markers(self.data))
+
+    def test_floats(self):
+        # Without markers, the stacked values are formatted as floats as well
+        markers = [col for col in self.data.columns if col[0] == INFO_COLS['marker']]
+        self._assert_files(self.data.drop(columns=markers))
+
+    def test_dates(self):
+        # Timestamps as column instead of strings, with missing values
+        data = self.data.copy()
+        data[data.columns[0]] = data.index.tz_convert('Europe/Berlin')
+        data.iloc[[2, 5], 0] = pd.NaT
+        self._assert_files(data)
+
+    def test_chunks(self):
+        files = self._write(self.data, chunk_size=1)
+        self.assertEqual(files, self._write(self.data, chunk_size=len(self.data.index)))
+
+    def test_unknown_shape(self):
+        with self.assertRaises(ValueError):
+            write_csv(self.data, {'wide': os.path.join(self.path, 'wide.csv')}, INFO_COLS)
+
+
+if __name__ == '__main__':
+    unittest.main()